@@ -238,6 +238,30 @@ var app = new Vue({
                     webrtc._setError('Failed to read clipboard contents: ' + err);
                 });
         },
+        uploadFiles(files) {
+            for (const file of files) {
+                webrtc.transfer.send(TRANSFER_KIND_FILE, file.name, file)
+                    .then(sent => {
+                        webrtc._setStatus((sent ? "uploaded file: " : "failed to upload file: ") + file.name);
+                    });
+            }
+        },
+        downloadFile() {
+            var name = window.prompt("Name of the file in the transfer directory");
+            if (name) {
+                webrtc.sendDataChannelMessage("fd," + stringToBase64(name));
+            }
+        },
+        typeClipboard() {
+            // Types the text for applications that do not read the clipboard, like remote consoles.
+            navigator.clipboard.readText()
+                .then(text => {
+                    webrtc.sendDataChannelMessage("kt," + stringToBase64(text));
+                })
+                .catch(err => {
+                    webrtc._setError('Failed to read clipboard contents: ' + err);
+                });
+        },
         publish() {
             var data = {
                 name: this.publishingAppName,
@@ -372,10 +396,12 @@ if (audioElement === null) {
 var pathname = window.location.pathname;
 pathname = pathname.slice(0, pathname.lastIndexOf("/") + 1);
 var protocol = (location.protocol == "http:" ? "ws://" : "wss://");
+// Additional viewers of a shared session select their peer ids with the "viewer" query parameter.
+var viewer = parseInt(new URLSearchParams(window.location.search).get("viewer")) || 0;
 var signalling = new WebRTCDemoSignalling(new URL(protocol + window.location.host + pathname + app.appName + "/signalling/"));
-var webrtc = new WebRTCDemo(signalling, videoElement, 1);
+var webrtc = new WebRTCDemo(signalling, videoElement, 1 + 4 * viewer);
 var audio_signalling = new WebRTCDemoSignalling(new URL(protocol + window.location.host + pathname + app.appName + "/signalling/"));
-var audio_webrtc = new WebRTCDemo(audio_signalling, audioElement, 3);
+var audio_webrtc = new WebRTCDemo(audio_signalling, audioElement, 3 + 4 * viewer);
 
 // Function to add timestamp to logs.
 var applyTimestamp = (msg) => {
@@ -637,6 +663,28 @@ window.addEventListener('focus', () => {
     webrtc.sendDataChannelMessage("kr");
 
     // Send clipboard contents.
+    sendClipboardContents();
+});
+
+// Sends the clipboard contents, streamed through the transfer channel when the server opened one.
+// Images are only sent through the transfer channel.
+function sendClipboardContents() {
+    if (webrtc.transfer.isOpen() && navigator.clipboard.read) {
+        navigator.clipboard.read()
+            .then(items => {
+                for (const item of items) {
+                    const image = item.types.find(type => type.startsWith("image/"));
+                    const type = image || (item.types.includes("text/plain") ? "text/plain" : null);
+                    if (type !== null) {
+                        return item.getType(type).then(blob => webrtc.transfer.send(image ? TRANSFER_KIND_CLIPBOARD_IMAGE : TRANSFER_KIND_CLIPBOARD_TEXT, type, blob));
+                    }
+                }
+            })
+            .catch(err => {
+                webrtc._setStatus('Failed to read clipboard contents: ' + err);
+            });
+        return;
+    }
     navigator.clipboard.readText()
         .then(text => {
             webrtc.sendDataChannelMessage("cw," + stringToBase64(text))
@@ -644,6 +692,15 @@ window.addEventListener('focus', () => {
         .catch(err => {
             webrtc._setStatus('Failed to read clipboard contents: ' + err);
         });
+}
+
+// Upload files dropped on the stream.
+videoElement.addEventListener('dragover', (event) => {
+    event.preventDefault();
+});
+videoElement.addEventListener('drop', (event) => {
+    event.preventDefault();
+    app.uploadFiles(event.dataTransfer.files);
 });
 window.addEventListener('blur', () => {
     // reset keyboard to avoid stuck keys.
@@ -659,6 +716,22 @@ webrtc.onclipboardcontent = (content) => {
     }
 }
 
+webrtc.transfer.onclipboardtext = webrtc.onclipboardcontent;
+
+// Save files downloaded from the transfer directory.
+webrtc.transfer.onfile = (name, blob) => {
+    const url = URL.createObjectURL(blob);
+    const link = document.createElement("a");
+    link.href = url;
+    link.download = name;
+    link.click();
+    setTimeout(() => URL.revokeObjectURL(url), 1000);
+}
+
+webrtc.transfer.onerror = (message) => {
+    webrtc._setError(message);
+}
+
 webrtc.oncursorchange = (handle, curdata, hotspot, override) => {
     if (parseInt(handle) === 0) {
         videoElement.style.cursor = "auto";
@@ -669,8 +742,13 @@ webrtc.oncursorchange = (handle, curdata, hotspot, override) => {
         return;
     }
     if (!webrtc.cursor_cache.has(handle)) {
-        // Add cursor to cache.
-        const cursor_url = "url('data:image/png;base64," + curdata + "')";
+        if (!curdata) {
+            // Image left out for a cursor that is not cached anymore.
+            videoElement.style.cursor = "auto";
+            return;
+        }
+        // Add cursor to cache, the image is a PNG blob with the binary protocol and base64 otherwise.
+        const cursor_url = (curdata instanceof Blob) ? "url('" + URL.createObjectURL(curdata) + "')" : "url('data:image/png;base64," + curdata + "')";
         webrtc.cursor_cache.set(handle, cursor_url);
     }
     var cursor_url = webrtc.cursor_cache.get(handle);
@@ -682,6 +760,13 @@ webrtc.oncursorchange = (handle, curdata, hotspot, override) => {
     videoElement.style.cursor = cursor_url;
 }
 
+// Cache cursors of the server cursor theme before they are first shown.
+webrtc.oncursorpreload = (handle, curdata) => {
+    if (!webrtc.cursor_cache.has(handle)) {
+        webrtc.cursor_cache.set(handle, "url('" + URL.createObjectURL(curdata) + "')");
+    }
+}
+
 webrtc.onsystemaction = (action) => {
     webrtc._setStatus("Executing system action: " + action);
     if (action === 'reload') {
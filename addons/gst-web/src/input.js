@@ -23,6 +23,31 @@
 /*global GamepadManager*/
 /*eslint no-unused-vars: ["error", { "vars": "local" }]*/
 
+/**
+ * Binary input protocol version and opcodes, must match webrtc_input.py.
+ * Every message is an opcode followed by a fixed little-endian layout.
+ */
+const INPUT_PROTOCOL_VERSION = 1;
+const INPUT_OP_KEY_DOWN = 0x01;
+const INPUT_OP_KEY_UP = 0x02;
+const INPUT_OP_MOUSE = 0x03;
+const INPUT_OP_MOUSE_RELATIVE = 0x04;
+const INPUT_OP_JS_BUTTON = 0x05;
+const INPUT_OP_JS_AXIS = 0x06;
+const INPUT_OP_MOTION = 0x07;
+const INPUT_OP_MOTION_RELATIVE = 0x08;
+const INPUT_OP_JS_AXIS_MOTION = 0x09;
+// Set on the opcode of messages followed by the client timestamp
+const INPUT_OP_TIMESTAMP_FLAG = 0x80;
+
+/**
+ * Monotonic client time in seconds since the epoch, used for pongs and input timestamps.
+ * @returns {number}
+ */
+function inputClientTime() {
+    return (performance.timeOrigin + performance.now()) / 1000;
+}
+
 class Input {
     /**
      * Input handling for WebRTC web application
@@ -32,8 +57,10 @@ class Input {
      *    Video element to attach events to
      * @param {function} [send]
      *    Function used to send input events to server.
+     * @param {function} [sendMotion]
+     *    Function used to send binary pointer motion and gamepad axes to server, defaults to send.
      */
-    constructor(element, send) {
+    constructor(element, send, sendMotion) {
         /**
          * @type {Element}
          */
@@ -44,6 +71,18 @@ class Input {
          */
         this.send = send;
 
+        /**
+         * @type {function}
+         */
+        this.sendMotion = sendMotion || send;
+
+        /**
+         * Last sequence number of absolute motion updates by target, lets the server drop late updates.
+         * The server compares sequence numbers per target, so each target has its own counter.
+         * @type {Map<String, Integer>}
+         */
+        this._motionSeqs = new Map();
+
         /**
          * @type {boolean}
          */
@@ -59,6 +98,18 @@ class Input {
          */
         this.buttonMask = 0;
 
+        /**
+         * Send key, mouse and gamepad events with the binary protocol, set once negotiated with the server.
+         * @type {boolean}
+         */
+        this.binaryProtocol = false;
+
+        /**
+         * Append the client time to binary messages, set when the server measures input latency.
+         * @type {boolean}
+         */
+        this.timestamps = false;
+
         /**
          * @type {Guacamole.Keyboard}
          */
@@ -160,6 +211,127 @@ class Input {
         this.cursorScaleFactor = Math.sqrt((serverWidth ** 2) + (serverHeight ** 2)) / Math.sqrt((clientResolution[0] ** 2) + (clientResolution[1] ** 2));
     }
 
+    /**
+     * Creates a binary input message with room for the client timestamp when enabled.
+     * @param {number} op - opcode
+     * @param {number} size - size of the message layout including the opcode
+     * @returns {DataView}
+     */
+    _newMessage(op, size) {
+        var view = new DataView(new ArrayBuffer(size + (this.timestamps ? 8 : 0)));
+        view.setUint8(0, this.timestamps ? op | INPUT_OP_TIMESTAMP_FLAG : op);
+        return view;
+    }
+
+    /**
+     * Sends a binary input message, appending the client timestamp when enabled.
+     * @param {function} send - send or sendMotion
+     * @param {DataView} view
+     */
+    _sendMessage(send, view) {
+        if (this.timestamps) {
+            view.setFloat64(view.byteLength - 8, inputClientTime(), true);
+        }
+        send(view.buffer);
+    }
+
+    /**
+     * Sends a mouse event to the WebRTC app.
+     * @param {String} mtype - "m" for absolute or "m2" for relative motion
+     * @param {number} x
+     * @param {number} y
+     * @param {number} buttonMask
+     * @param {number} magnitude - scroll magnitude
+     */
+    _sendMouse(mtype, x, y, buttonMask, magnitude) {
+        if (this.binaryProtocol) {
+            var view = this._newMessage(mtype === "m2" ? INPUT_OP_MOUSE_RELATIVE : INPUT_OP_MOUSE, 11);
+            view.setInt32(1, x, true);
+            view.setInt32(5, y, true);
+            view.setUint8(9, buttonMask);
+            view.setUint8(10, magnitude);
+            this._sendMessage(this.send, view);
+        } else {
+            this.send([mtype, x, y, buttonMask, magnitude].join(","));
+        }
+    }
+
+    /**
+     * Sends pointer motion without button changes to the WebRTC app, on the motion channel with the binary protocol.
+     * @param {String} mtype - "m" for absolute or "m2" for relative motion
+     * @param {number} x
+     * @param {number} y
+     */
+    _sendMotion(mtype, x, y) {
+        if (!this.binaryProtocol) {
+            this._sendMouse(mtype, x, y, this.buttonMask, 0);
+            return;
+        }
+        var view;
+        if (mtype === "m2") {
+            view = this._newMessage(INPUT_OP_MOTION_RELATIVE, 9);
+            view.setInt32(1, x, true);
+            view.setInt32(5, y, true);
+        } else {
+            view = this._newMessage(INPUT_OP_MOTION, 11);
+            view.setUint16(1, this._nextMotionSeq("pointer"), true);
+            view.setInt32(3, x, true);
+            view.setInt32(7, y, true);
+        }
+        this._sendMessage(this.sendMotion, view);
+    }
+
+    /**
+     * Returns the next sequence number of absolute motion updates of a target.
+     * @param {String} target - "pointer" or the gamepad and axis
+     */
+    _nextMotionSeq(target) {
+        var seq = ((this._motionSeqs.get(target) || 0) + 1) & 0xFFFF;
+        this._motionSeqs.set(target, seq);
+        return seq;
+    }
+
+    /**
+     * Sends a key event to the WebRTC app.
+     * @param {boolean} down
+     * @param {number} keysym
+     */
+    _sendKey(down, keysym) {
+        if (this.binaryProtocol) {
+            var view = this._newMessage(down ? INPUT_OP_KEY_DOWN : INPUT_OP_KEY_UP, 5);
+            view.setUint32(1, keysym, true);
+            this._sendMessage(this.send, view);
+        } else {
+            this.send((down ? "kd," : "ku,") + keysym);
+        }
+    }
+
+    /**
+     * Sends a gamepad button or axis event to the WebRTC app.
+     * @param {String} jtype - "b" for buttons or "a" for axes
+     * @param {number} gp_num
+     * @param {number} num - button or axis number
+     * @param {number} val
+     */
+    _sendGamepad(jtype, gp_num, num, val) {
+        if (this.binaryProtocol && jtype === "a") {
+            var axisView = this._newMessage(INPUT_OP_JS_AXIS_MOTION, 9);
+            axisView.setUint16(1, this._nextMotionSeq("axis," + gp_num + "," + num), true);
+            axisView.setUint8(3, gp_num);
+            axisView.setUint8(4, num);
+            axisView.setFloat32(5, val, true);
+            this._sendMessage(this.sendMotion, axisView);
+        } else if (this.binaryProtocol) {
+            var view = this._newMessage(jtype === "b" ? INPUT_OP_JS_BUTTON : INPUT_OP_JS_AXIS, 7);
+            view.setUint8(1, gp_num);
+            view.setUint8(2, num);
+            view.setFloat32(3, val, true);
+            this._sendMessage(this.send, view);
+        } else {
+            this.send("js," + jtype + "," + gp_num + "," + num + "," + val);
+        }
+    }
+
     /**
      * Handles mouse button and motion events and sends them to WebRTC app.
      * @param {MouseEvent} event
@@ -221,15 +393,11 @@ class Input {
             }
         }
 
-        var toks = [
-            mtype,
-            this.x,
-            this.y,
-            this.buttonMask,
-            0
-        ];
-
-        this.send(toks.join(","));
+        if (event.type === 'mousemove') {
+            this._sendMotion(mtype, this.x, this.y);
+        } else {
+            this._sendMouse(mtype, this.x, this.y, this.buttonMask, 0);
+        }
 
         event.preventDefault();
     }
@@ -253,15 +421,7 @@ class Input {
         this.x = this._clientToServerX(event.changedTouches[0].clientX);
         this.y = this._clientToServerY(event.changedTouches[0].clientY);
 
-        var toks = [
-            mtype,
-            this.x,
-            this.y,
-            this.buttonMask,
-            0
-        ];
-
-        this.send(toks.join(","));
+        this._sendMouse(mtype, this.x, this.y, this.buttonMask, 0);
     }
 
     /**
@@ -348,21 +508,13 @@ class Input {
         var magnitude = Math.min(deltaY, this._scrollMagnitude);
 
         var mask = 1 << button;
-        var toks;
         // Simulate button press and release.
         for (var i = 0; i < 2; i++) {
             if (i === 0)
                 this.buttonMask |= mask;
             else
                 this.buttonMask &= ~mask;
-            toks = [
-                mtype,
-                this.x,
-                this.y,
-                this.buttonMask,
-                magnitude
-            ];
-            this.send(toks.join(","));
+            this._sendMouse(mtype, this.x, this.y, this.buttonMask, magnitude);
         }
 
         event.preventDefault();
@@ -535,7 +687,7 @@ class Input {
      * @param {number} val - the button value, 1 or 0 for pressed or not-pressed.
      */
     _gamepadButton(gp_num, btn_num, val) {
-        this.send("js,b," + gp_num + "," + btn_num + "," + val);
+        this._sendGamepad("b", gp_num, btn_num, val);
     }
 
     /**
@@ -546,7 +698,7 @@ class Input {
      * @param {number} val - the normalize value between [0, 255]
      */
     _gamepadAxis(gp_num, axis_num, val) {
-        this.send("js,a," + gp_num + "," + axis_num + "," + val)
+        this._sendGamepad("a", gp_num, axis_num, val);
     }
 
     /**
@@ -647,10 +799,10 @@ class Input {
         // Using guacamole keyboard because it has the keysym translations.
         this.keyboard = new Guacamole.Keyboard(window);
         this.keyboard.onkeydown = (keysym) => {
-            this.send("kd," + keysym);
+            this._sendKey(true, keysym);
         };
         this.keyboard.onkeyup = (keysym) => {
-            this.send("ku," + keysym);
+            this._sendKey(false, keysym);
         };
 
         if (document.fullscreenElement !== null && document.pointerLockElement === null) {
@@ -14,6 +14,7 @@ var filesToCache = [
   'app.js?ts=CACHE_VERSION',
   'input.js?ts=CACHE_VERSION',
   'signalling.js?ts=CACHE_VERSION',
+  'transfer.js?ts=CACHE_VERSION',
   'webrtc.js?ts=CACHE_VERSION'
 ];
 
@@ -0,0 +1,250 @@
+/*
+ * This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at https://mozilla.org/MPL/2.0/.
+ */
+
+/*eslint no-unused-vars: ["error", { "vars": "local" }]*/
+
+/**
+ * Transfer channel message opcodes and kinds, must match bulk_transfer.py.
+ * A transfer is a start message, chunks in order and an end message with the CRC32 of the data,
+ * either side can abort it. Server transfer ids are even and client transfer ids are odd.
+ */
+const TRANSFER_OP_START = 0x01;
+const TRANSFER_OP_CHUNK = 0x02;
+const TRANSFER_OP_END = 0x03;
+const TRANSFER_OP_ABORT = 0x04;
+
+const TRANSFER_KIND_CLIPBOARD_TEXT = 1;
+const TRANSFER_KIND_CLIPBOARD_IMAGE = 2;
+const TRANSFER_KIND_FILE = 3;
+
+// Data in each chunk, SCTP messages of this size are accepted by all browsers.
+const TRANSFER_CHUNK_SIZE = 16 * 1024;
+
+// Buffered bytes above which sending waits until the channel drained to the low threshold.
+const TRANSFER_BUFFER_HIGH = 1024 * 1024;
+const TRANSFER_BUFFER_LOW = 256 * 1024;
+
+const CRC32_TABLE = (() => {
+    var table = new Uint32Array(256);
+    for (var n = 0; n < 256; n++) {
+        var c = n;
+        for (var k = 0; k < 8; k++) {
+            c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+/**
+ * Updates a CRC32 with more data, compatible with zlib.crc32().
+ *
+ * @param {number} crc - CRC32 of the previous data, 0 to start
+ * @param {Uint8Array} data
+ */
+function crc32(crc, data) {
+    crc = (crc ^ 0xFFFFFFFF) >>> 0;
+    for (var i = 0; i < data.length; i++) {
+        crc = CRC32_TABLE[(crc ^ data[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+class BulkTransfer {
+    /**
+     * Streams clipboard contents and files over the "transfer" data channel.
+     */
+    constructor() {
+        /**
+         * @type {RTCDataChannel}
+         */
+        this.channel = null;
+
+        /**
+         * @type {function}
+         */
+        this.onclipboardtext = null;
+
+        /**
+         * @type {function}
+         */
+        this.onfile = null;
+
+        /**
+         * @type {function}
+         */
+        this.onerror = null;
+
+        this._nextId = 1;
+        this._incoming = new Map();
+        this._outgoing = new Set();
+        this._drainWaiters = [];
+    }
+
+    /**
+     * Uses a data channel opened by the server for transfers.
+     *
+     * @param {RTCDataChannel} channel
+     */
+    attach(channel) {
+        this.channel = channel;
+        this._incoming = new Map();
+        this._outgoing = new Set();
+        channel.binaryType = "arraybuffer";
+        channel.bufferedAmountLowThreshold = TRANSFER_BUFFER_LOW;
+        channel.onbufferedamountlow = () => this._wakeDrainWaiters();
+        channel.onclose = () => {
+            this._incoming = new Map();
+            this._outgoing = new Set();
+            this._wakeDrainWaiters();
+        };
+        channel.onmessage = (event) => this._onMessage(event.data);
+    }
+
+    isOpen() {
+        return this.channel !== null && this.channel.readyState === 'open';
+    }
+
+    /**
+     * Sends data to the server in chunks, waiting for the channel to drain when too much is buffered.
+     *
+     * @param {number} kind - one of TRANSFER_KIND_*
+     * @param {String} name - file name or MIME type
+     * @param {Blob} blob
+     * @returns {Promise<boolean>} true if the transfer completed
+     */
+    async send(kind, name, blob) {
+        if (!this.isOpen()) {
+            return false;
+        }
+        var id = this._nextId;
+        this._nextId += 2;
+        this._outgoing.add(id);
+
+        var nameBytes = new TextEncoder().encode(name);
+        var start = new Uint8Array(14 + nameBytes.length);
+        var view = new DataView(start.buffer);
+        view.setUint8(0, TRANSFER_OP_START);
+        view.setUint32(1, id, true);
+        view.setUint8(5, kind);
+        view.setBigUint64(6, BigInt(blob.size), true);
+        start.set(nameBytes, 14);
+        this.channel.send(start.buffer);
+
+        var crc = 0;
+        for (var offset = 0; offset < blob.size; offset += TRANSFER_CHUNK_SIZE) {
+            if (this.isOpen() && this.channel.bufferedAmount > TRANSFER_BUFFER_HIGH) {
+                await new Promise((resolve) => this._drainWaiters.push(resolve));
+            }
+            var data = new Uint8Array(await blob.slice(offset, offset + TRANSFER_CHUNK_SIZE).arrayBuffer());
+            if (!this._outgoing.has(id) || !this.isOpen()) {
+                return false;
+            }
+            crc = crc32(crc, data);
+            var chunk = new Uint8Array(13 + data.length);
+            view = new DataView(chunk.buffer);
+            view.setUint8(0, TRANSFER_OP_CHUNK);
+            view.setUint32(1, id, true);
+            view.setBigUint64(5, BigInt(offset), true);
+            chunk.set(data, 13);
+            this.channel.send(chunk.buffer);
+        }
+
+        var end = new DataView(new ArrayBuffer(9));
+        end.setUint8(0, TRANSFER_OP_END);
+        end.setUint32(1, id, true);
+        end.setUint32(5, crc, true);
+        this.channel.send(end.buffer);
+        this._outgoing.delete(id);
+        return true;
+    }
+
+    _wakeDrainWaiters() {
+        var waiters = this._drainWaiters;
+        this._drainWaiters = [];
+        waiters.forEach((resolve) => resolve());
+    }
+
+    _abort(id, reason) {
+        this._incoming.delete(id);
+        if (this.onerror !== null) {
+            this.onerror("transfer " + id + " aborted: " + reason);
+        }
+        if (this.isOpen()) {
+            var reasonBytes = new TextEncoder().encode(reason);
+            var msg = new Uint8Array(5 + reasonBytes.length);
+            var view = new DataView(msg.buffer);
+            view.setUint8(0, TRANSFER_OP_ABORT);
+            view.setUint32(1, id, true);
+            msg.set(reasonBytes, 5);
+            this.channel.send(msg.buffer);
+        }
+    }
+
+    /**
+     * Handles a message from the transfer channel.
+     *
+     * @param {ArrayBuffer} data
+     */
+    _onMessage(data) {
+        var view = new DataView(data);
+        var op = view.getUint8(0);
+        var id = view.getUint32(1, true);
+        var transfer = this._incoming.get(id);
+
+        if (op === TRANSFER_OP_START) {
+            this._incoming.set(id, {
+                kind: view.getUint8(5),
+                size: Number(view.getBigUint64(6, true)),
+                name: new TextDecoder().decode(data.slice(14)),
+                chunks: [],
+                received: 0,
+                crc: 0,
+            });
+        } else if (op === TRANSFER_OP_CHUNK) {
+            if (transfer === undefined) {
+                this._abort(id, "transfer not started");
+                return;
+            }
+            var offset = Number(view.getBigUint64(5, true));
+            if (offset !== transfer.received) {
+                this._abort(id, "chunk at offset " + offset + ", expected " + transfer.received);
+                return;
+            }
+            var chunk = new Uint8Array(data, 13);
+            transfer.crc = crc32(transfer.crc, chunk);
+            transfer.received += chunk.length;
+            transfer.chunks.push(chunk);
+        } else if (op === TRANSFER_OP_END) {
+            if (transfer === undefined) {
+                this._abort(id, "transfer not started");
+                return;
+            }
+            if (transfer.received !== transfer.size || view.getUint32(5, true) !== transfer.crc) {
+                this._abort(id, "received " + transfer.received + " of " + transfer.size + " bytes or CRC32 mismatch");
+                return;
+            }
+            this._incoming.delete(id);
+            var blob = new Blob(transfer.chunks, {type: (transfer.kind === TRANSFER_KIND_FILE) ? "application/octet-stream" : transfer.name});
+            if (transfer.kind === TRANSFER_KIND_CLIPBOARD_TEXT) {
+                blob.text().then((text) => {
+                    if (this.onclipboardtext !== null) {
+                        this.onclipboardtext(text);
+                    }
+                });
+            } else if (transfer.kind === TRANSFER_KIND_FILE && this.onfile !== null) {
+                this.onfile(transfer.name, blob);
+            }
+        } else if (op === TRANSFER_OP_ABORT) {
+            // Either a transfer from the server or one sent to it.
+            this._incoming.delete(id);
+            this._outgoing.delete(id);
+            if (this.onerror !== null) {
+                this.onerror("transfer " + id + " aborted by server: " + new TextDecoder().decode(data.slice(5)));
+            }
+        }
+    }
+}
@@ -20,7 +20,16 @@
  *   limitations under the License.
  */
 
-/*global GamepadManager, Input*/
+/*global GamepadManager, Input, BulkTransfer, INPUT_PROTOCOL_VERSION, inputClientTime*/
+
+/**
+ * Binary server message opcodes, must match gstwebrtc_app.py.
+ */
+const DATA_OP_CURSOR = 0x81;
+const DATA_OP_CLIPBOARD = 0x82;
+const DATA_OP_SYSTEM_STATS = 0x83;
+const DATA_OP_GPU_STATS = 0x84;
+const DATA_OP_CURSOR_PRELOAD = 0x85;
 
 /*eslint no-unused-vars: ["error", { "vars": "local" }]*/
 
@@ -151,6 +160,11 @@ class WebRTCDemo {
          */
         this.oncursorchange = null;
 
+        /**
+         * @type {function}
+         */
+        this.oncursorpreload = null;
+
          /**
           * @type {Map}
           */
@@ -175,6 +189,18 @@ class WebRTCDemo {
          */
         this._send_channel = null;
 
+        /**
+         * Unordered channel without retransmits for pointer motion and gamepad axes.
+         * @type {RTCDataChannel}
+         */
+        this._motion_channel = null;
+
+        /**
+         * Clipboard contents and files streamed over the "transfer" channel.
+         * @type {BulkTransfer}
+         */
+        this.transfer = new BulkTransfer();
+
         /**
          * @type {Input}
          */
@@ -183,6 +209,12 @@ class WebRTCDemo {
                 this._setDebug("data channel: " + data);
                 this._send_channel.send(data);
             }
+        }, (data) => {
+            if (this._connected && this._motion_channel !== null && this._motion_channel.readyState === 'open') {
+                this._motion_channel.send(data);
+            } else if (this._connected && this._send_channel !== null && this._send_channel.readyState === 'open') {
+                this._send_channel.send(data);
+            }
         });
     }
 
@@ -350,8 +382,21 @@ class WebRTCDemo {
     _onPeerdDataChannel(event) {
         this._setStatus("Peer data channel created: " + event.channel.label);
 
+        if (event.channel.label === "motion") {
+            this._motion_channel = event.channel;
+            return;
+        }
+        if (event.channel.label === "transfer") {
+            this.transfer.attach(event.channel);
+            return;
+        }
+
         // Bind the data channel event handlers.
         this._send_channel = event.channel;
+        this._send_channel.binaryType = "arraybuffer";
+        // Use the text input protocol until the server announces the binary protocol.
+        this.input.binaryProtocol = false;
+        this.input.timestamps = false;
         this._send_channel.onmessage = this._onPeerDataChannelMessage.bind(this);
         this._send_channel.onopen = () => {
             if (this.ondatachannelopen !== null)
@@ -369,6 +414,11 @@ class WebRTCDemo {
      * @param {MessageEvent} event
      */
     _onPeerDataChannelMessage(event) {
+        if (event.data instanceof ArrayBuffer) {
+            this._onPeerDataChannelBinaryMessage(event.data);
+            return;
+        }
+
         // Attempt to parse message as JSON
         var msg;
         try {
@@ -419,12 +469,24 @@ class WebRTCDemo {
             }
         } else if (msg.type === 'ping') {
             this._setDebug("received server ping: " + JSON.stringify(msg.data));
-            this.sendDataChannelMessage("pong," + new Date().getTime() / 1000);
+            this.sendDataChannelMessage("pong," + inputClientTime());
         } else if (msg.type === 'system_stats') {
             this._setDebug("received systems stats: " + JSON.stringify(msg.data));
             if (this.onsystemstats !== null) {
                 this.onsystemstats(msg.data);
             }
+        } else if (msg.type === 'input_protocol') {
+            // Switch input events to the binary protocol when the server speaks the same version.
+            if (msg.data.version === INPUT_PROTOCOL_VERSION) {
+                this.sendDataChannelMessage("_proto," + INPUT_PROTOCOL_VERSION);
+                this.input.binaryProtocol = true;
+                this.input.timestamps = msg.data.timestamps === true;
+                this._setDebug("using binary input protocol version " + INPUT_PROTOCOL_VERSION);
+            } else {
+                this.input.binaryProtocol = false;
+                this.input.timestamps = false;
+                this._setDebug("server binary input protocol version " + msg.data.version + " not supported, using text protocol");
+            }
         } else if (msg.type === 'latency_measurement') {
             if (this.onlatencymeasurement !== null) {
                 this.onlatencymeasurement(msg.data.latency_ms);
@@ -434,6 +496,68 @@ class WebRTCDemo {
         }
     }
 
+    /**
+     * Handles binary messages from the peer data channel, sent once the binary protocol was accepted.
+     *
+     * @param {ArrayBuffer} data
+     */
+    _onPeerDataChannelBinaryMessage(data) {
+        var view = new DataView(data);
+        var op = view.getUint8(0);
+        if (op === DATA_OP_CURSOR) {
+            if (this.oncursorchange !== null) {
+                var handle = view.getUint32(1, true);
+                var hotspot = {x: view.getInt16(5, true), y: view.getInt16(7, true)};
+                var override = view.getUint8(9) ? "none" : null;
+                // The image is left out when the client already received it.
+                var curdata = (data.byteLength > 10) ? new Blob([data.slice(10)], {type: "image/png"}) : null;
+                this._setDebug(`received new cursor contents, handle: ${handle}, hotspot: ${JSON.stringify(hotspot)} image length: ${curdata ? curdata.size : 0}`);
+                this.oncursorchange(handle, curdata, hotspot, override);
+            }
+        } else if (op === DATA_OP_CURSOR_PRELOAD) {
+            // Handle and image length of each cursor followed by its image.
+            var offset = 1;
+            var count = 0;
+            while (offset + 8 <= data.byteLength) {
+                var preloadHandle = view.getUint32(offset, true);
+                var length = view.getUint32(offset + 4, true);
+                var image = new Blob([data.slice(offset + 8, offset + 8 + length)], {type: "image/png"});
+                offset += 8 + length;
+                count++;
+                if (this.oncursorpreload !== null) {
+                    this.oncursorpreload(preloadHandle, image);
+                }
+            }
+            this._setDebug("received preloaded cursors: " + count);
+        } else if (op === DATA_OP_CLIPBOARD) {
+            var text = new TextDecoder().decode(data.slice(1));
+            this._setDebug("received clipboard contents, length: " + text.length);
+            if (this.onclipboardcontent !== null) {
+                this.onclipboardcontent(text);
+            }
+        } else if (op === DATA_OP_SYSTEM_STATS) {
+            var stats = {
+                cpu_percent: view.getFloat64(1, true),
+                mem_total: Number(view.getBigUint64(9, true)),
+                mem_used: Number(view.getBigUint64(17, true)),
+            };
+            this._setDebug("received systems stats: " + JSON.stringify(stats));
+            if (this.onsystemstats !== null) {
+                this.onsystemstats(stats);
+            }
+        } else if (op === DATA_OP_GPU_STATS) {
+            if (this.ongpustats !== null) {
+                this.ongpustats({
+                    load: view.getFloat64(1, true),
+                    memory_total: view.getFloat64(9, true),
+                    memory_used: view.getFloat64(17, true),
+                });
+            }
+        } else {
+            this._setError("Unhandled binary message received: " + op);
+        }
+    }
+
     /**
      * Handler for peer connection state change.
      * Possible values for state:
@@ -750,6 +874,12 @@ class WebRTCDemo {
         if (this._send_channel !== null && this._send_channel.readyState === "open") {
             this._send_channel.close();
         }
+        if (this._motion_channel !== null && this._motion_channel.readyState === "open") {
+            this._motion_channel.close();
+        }
+        if (this.transfer.isOpen()) {
+            this.transfer.channel.close();
+        }
         if (this.peerConnection !== null) this.peerConnection.close();
         if (signalState !== "stable") {
             setTimeout(() => {
@@ -21,6 +21,8 @@
 
 import argparse
 import asyncio
+import base64
+import binascii
 import http.client
 import json
 import logging
@@ -37,13 +39,17 @@ logger.setLevel(logging.INFO)
 
 from watchdog.observers import Observer
 from watchdog.events import FileClosedEvent, FileSystemEventHandler
-from webrtc_input import WebRTCInput
+from webrtc_input import WebRTCInput, InputSession, INPUT_PROTOCOL_VERSION
 from webrtc_signalling import WebRTCSignalling, WebRTCSignallingErrorNoPeer
 from gstwebrtc_app import GSTWebRTCApp
+from encoder_profiles import load_encoder_profiles
+from damage_monitor import DamageMonitor, DamageMonitorError
+from bulk_transfer import TransferReceiver, TransferError, resolve_download_path
 from gpu_monitor import GPUMonitor
 from system_monitor import SystemMonitor
 from metrics import Metrics
-from resize import resize_display, get_new_res, set_dpi, set_cursor_size
+from resize import XRandRResizer, XRandRError, set_dpi, set_cursor_size
+from xsettings import XSettingsManager, XSETTINGS_DPI_SCALE
 from signalling_web import WebRTCSimpleServer, generate_rtc_config
 
 DEFAULT_RTC_CONFIG = """{
@@ -450,12 +456,21 @@ async def main():
     parser.add_argument('--uinput_mouse_socket',
                         default=os.environ.get('SELKIES_UINPUT_MOUSE_SOCKET', ''),
                         help='Path to the uinput mouse socket, if not provided uinput is used directly')
+    parser.add_argument('--input_motion_coalesce_ms',
+                        default=os.environ.get('SELKIES_INPUT_MOTION_COALESCE_MS', '4'),
+                        help='Window in milliseconds to merge pointer motion events in before injecting them into the X server, button and key events inject pending motion first, set to 0 to inject every event')
+    parser.add_argument('--text_typing_key_delay_ms',
+                        default=os.environ.get('SELKIES_TEXT_TYPING_KEY_DELAY_MS', '0.1'),
+                        help='Pacing in milliseconds between keys when typing text sent by the client as key presses, increase for applications dropping fast input, delays up to 1 are applied to batches of keys')
     parser.add_argument('--js_socket_path',
                         default=os.environ.get('SELKIES_JS_SOCKET_PATH', '/tmp'),
                         help='Directory to write the Selkies Joystick Interposer communication sockets to, default: /tmp, results in socket files: /tmp/selkies_js{0-3}.sock')
     parser.add_argument('--encoder',
                         default=os.environ.get('SELKIES_ENCODER', 'x264enc'),
                         help='GStreamer video encoder to use')
+    parser.add_argument('--encoder_profiles_json',
+                        default=os.environ.get('SELKIES_ENCODER_PROFILES_JSON', '/etc/selkies/encoder_profiles.json'),
+                        help='JSON file with per-host encoder profile overrides (element properties, threads, presets, VBV multipliers) merged into the built-in encoder profiles, ignored if the file does not exist')
     parser.add_argument('--gpu_id',
                         default=os.environ.get('SELKIES_GPU_ID', '0'),
                         help='GPU ID for GStreamer hardware video encoders, will use enumerated GPU ID (0, 1, ..., n) for NVIDIA and /dev/dri/renderD{128 + n} for VA-API')
@@ -486,15 +501,36 @@ async def main():
     parser.add_argument('--enable_clipboard',
                         default=os.environ.get('SELKIES_ENABLE_CLIPBOARD', 'true'),
                         help='Enable or disable the clipboard features, supported values: true, false, in, out')
+    parser.add_argument('--file_transfer_dir',
+                        default=os.environ.get('SELKIES_FILE_TRANSFER_DIR', ''),
+                        help='Directory files uploaded by the client are written to and downloaded from, leave empty to disable file transfers')
+    parser.add_argument('--file_transfer_max_size_mb',
+                        default=os.environ.get('SELKIES_FILE_TRANSFER_MAX_SIZE_MB', '1024'),
+                        help='Maximum size in megabytes of a file or clipboard content received from the client')
     parser.add_argument('--enable_resize',
                         default=os.environ.get('SELKIES_ENABLE_RESIZE', 'false'),
                         help='Enable dynamic resizing to match browser size')
+    parser.add_argument('--resize_debounce_ms',
+                        default=os.environ.get('SELKIES_RESIZE_DEBOUNCE_MS', '250'),
+                        help='Time in milliseconds without new resize requests before the last requested resolution is applied, so resizing the browser window applies only the final size, also used for DPI scale changes')
+    parser.add_argument('--video_resize_mode',
+                        default=os.environ.get('SELKIES_VIDEO_RESIZE_MODE', 'renegotiate'),
+                        help='How the video follows display resizes, "renegotiate" encodes at the new size which restarts the encoder session, "scale" keeps the encoder at a fixed coded size and scales the display to fit with borders, supported values: renegotiate, scale')
+    parser.add_argument('--video_coded_size',
+                        default=os.environ.get('SELKIES_VIDEO_CODED_SIZE', ''),
+                        help='Size as WxH of the encoded video with --video_resize_mode=scale, leave empty to use the display size when the pipeline starts')
     parser.add_argument('--enable_cursors',
                         default=os.environ.get('SELKIES_ENABLE_CURSORS', 'true'),
                         help='Enable passing remote cursors to client')
     parser.add_argument('--debug_cursors',
                         default=os.environ.get('SELKIES_DEBUG_CURSORS', 'false'),
                         help='Enable cursor debug logging')
+    parser.add_argument('--enable_xsettings_manager',
+                        default=os.environ.get('SELKIES_ENABLE_XSETTINGS_MANAGER', 'false'),
+                        help='Publish the DPI and cursor size as the XSETTINGS manager of the display when no settings daemon owns it, enable only for desktops without a settings daemon as one started later cannot take over, xfconf-query is used otherwise')
+    parser.add_argument('--enable_cursor_preload',
+                        default=os.environ.get('SELKIES_ENABLE_CURSOR_PRELOAD', 'true'),
+                        help='Convert the common shapes of the cursor theme at session start and send them to the client when it connects, so cursor changes only send a handle')
     parser.add_argument('--cursor_size',
                         default=os.environ.get('SELKIES_CURSOR_SIZE', os.environ.get('XCURSOR_SIZE', '-1')),
                         help='Cursor size in points for the local cursor, set instead XCURSOR_SIZE without of this argument to configure the cursor size for both the local and remote cursors')
@@ -504,6 +540,39 @@ async def main():
     parser.add_argument('--webrtc_statistics_dir',
                         default=os.environ.get('SELKIES_WEBRTC_STATISTICS_DIR', '/tmp'),
                         help='Directory to save WebRTC Statistics CSV from client with filenames selkies-stats-video-[timestamp].csv and selkies-stats-audio-[timestamp].csv')
+    parser.add_argument('--max_viewers',
+                        default=os.environ.get('SELKIES_MAX_VIEWERS', '1'),
+                        help='Maximum number of simultaneous viewers of the same desktop, viewers above one share a single capture and encode pipeline and connect with the "viewer" URL query parameter set to 1, 2, ..., n-1')
+    parser.add_argument('--enable_fast_reconnect',
+                        default=os.environ.get('SELKIES_ENABLE_FAST_RECONNECT', 'false'),
+                        help='Keep the capture and encode pipeline running across viewer reconnects and only replace webrtcbin, the pipeline is rebuilt after the display is resized or the pipeline fails')
+    parser.add_argument('--fast_reconnect_timeout_s',
+                        default=os.environ.get('SELKIES_FAST_RECONNECT_TIMEOUT_S', '30'),
+                        help='Stop the capture and encode pipeline kept running by --enable_fast_reconnect when no viewer reconnected within this time in seconds, set to 0 to keep it running')
+    parser.add_argument('--enable_pipeline_preroll',
+                        default=os.environ.get('SELKIES_ENABLE_PIPELINE_PREROLL', 'false'),
+                        help='Start the capture and encode pipeline at startup so the first viewer does not wait for encoder initialization, requires --enable_fast_reconnect')
+    parser.add_argument('--video_queue_max_time_ms',
+                        default=os.environ.get('SELKIES_VIDEO_QUEUE_MAX_TIME_MS', '16'),
+                        help='Maximum time in milliseconds of video frames held in the leaky queues between capture, colorspace conversion and encoding, which run in separate threads, set to 0 to run them in one thread without queues')
+    parser.add_argument('--video_max_latency_ms',
+                        default=os.environ.get('SELKIES_VIDEO_MAX_LATENCY_MS', '0'),
+                        help='Drop captured video frames older than this latency budget in milliseconds before encoding, set to 0 to disable')
+    parser.add_argument('--capture_idle_timeout_ms',
+                        default=os.environ.get('SELKIES_CAPTURE_IDLE_TIMEOUT_MS', '2000'),
+                        help='Stop encoding captured frames after the screen did not change for this time in milliseconds, changes are reported by the X11 DAMAGE extension or detected by comparing frames, set to 0 to encode every frame')
+    parser.add_argument('--capture_keepalive_ms',
+                        default=os.environ.get('SELKIES_CAPTURE_KEEPALIVE_MS', '1000'),
+                        help='Interval in milliseconds of frames still encoded while the screen is idle, set to 0 to encode no frames until the screen changes')
+    parser.add_argument('--enable_latency_tracing',
+                        default=os.environ.get('SELKIES_ENABLE_LATENCY_TRACING', 'false'),
+                        help='Measure the processing time of each pipeline element and the queue levels and export them as Prometheus metrics, adds overhead to every buffer')
+    parser.add_argument('--enable_input_latency_metrics',
+                        default=os.environ.get('SELKIES_ENABLE_INPUT_LATENCY_METRICS', 'false'),
+                        help='Ask clients to timestamp binary input events and export the network, event loop queueing and injection time as Prometheus metrics, the client clock offset is estimated from pings')
+    parser.add_argument('--enable_local_signalling',
+                        default=os.environ.get('SELKIES_ENABLE_LOCAL_SIGNALLING', 'true'),
+                        help='Connect the streaming app to the signalling server of the same process through in-process queues instead of a loopback websocket, skipping TLS and basic authentication')
     parser.add_argument('--enable_metrics_http',
                         default=os.environ.get('SELKIES_ENABLE_METRICS_HTTP', 'false'),
                         help='Enable the Prometheus HTTP metrics port')
@@ -551,6 +620,38 @@ async def main():
     my_audio_id = 2
     audio_peer_id = 3
 
+    # Additional viewers n = 1, 2, ... use the peer ids offset by 4 * n
+    max_viewers = max(1, int(args.max_viewers))
+    using_fanout = max_viewers > 1
+
+    # Keep the capture and encode pipeline alive between viewers, viewers attach their webrtcbin to it like additional viewers
+    using_fast_reconnect = args.enable_fast_reconnect.lower() == 'true'
+    using_pipeline_preroll = using_fast_reconnect and args.enable_pipeline_preroll.lower() == 'true'
+
+    # Per-element latency tracing
+    using_latency_tracing = args.enable_latency_tracing.lower() == 'true'
+
+    # Skip encoding captured frames while the screen is idle
+    capture_idle_timeout_ms = float(args.capture_idle_timeout_ms)
+
+    # Scale captured frames to a fixed coded size instead of renegotiating the encoder on display resizes
+    video_resize_mode = args.video_resize_mode.lower()
+    if video_resize_mode not in ("renegotiate", "scale"):
+        logger.warning("unsupported video resize mode: %s, using renegotiate" % args.video_resize_mode)
+        video_resize_mode = "renegotiate"
+    video_coded_size = None
+    if video_resize_mode == "scale" and args.video_coded_size:
+        video_coded_size = tuple(int(i) for i in args.video_coded_size.lower().split('x'))
+
+    # Input latency from client timestamps
+    using_input_latency_metrics = args.enable_input_latency_metrics.lower() == 'true'
+
+    # File uploads and downloads through the transfer data channel
+    file_transfer_dir = os.path.expanduser(args.file_transfer_dir) if args.file_transfer_dir else None
+    if file_transfer_dir:
+        os.makedirs(file_transfer_dir, exist_ok=True)
+    file_transfer_max_size = int(float(args.file_transfer_max_size_mb) * 1024 * 1024)
+
     # Initialize metrics server
     using_metrics_http = args.enable_metrics_http.lower() == 'true'
     using_webrtc_csv = args.enable_webrtc_statistics.lower() == 'true'
@@ -576,7 +677,7 @@ async def main():
     # Handle errors from the signalling server
     async def on_signalling_error(e):
         if isinstance(e, WebRTCSignallingErrorNoPeer):
-            # Waiting for peer to connect, retry in 1 second.
+            # Signalling servers without SESSION_WAIT report a missing peer, retry in 1 second.
             await asyncio.sleep(1.0)
             await signalling.setup_call()
         else:
@@ -584,7 +685,7 @@ async def main():
             await app.stop_pipeline()
     async def on_audio_signalling_error(e):
         if isinstance(e, WebRTCSignallingErrorNoPeer):
-            # Waiting for peer to connect, retry in 1 second.
+            # Signalling servers without SESSION_WAIT report a missing peer, retry in 1 second.
             await asyncio.sleep(1.0)
             await audio_signalling.setup_call()
         else:
@@ -662,6 +763,7 @@ async def main():
     enable_cursors = args.enable_cursors.lower() == "true"
     cursor_debug = args.debug_cursors.lower() == "true"
     cursor_size = int(args.cursor_size)
+    cursor_preload = args.enable_cursor_preload.lower() == "true"
     keyframe_distance = float(args.keyframe_distance)
     congestion_control = args.congestion_control.lower() == "true"
     video_packetloss_percent = float(args.video_packetloss_percent)
@@ -670,8 +772,11 @@ async def main():
     # Create instance of app
     # Only use asynchronous event loops directly when synchronous functions are absolutely necessary (such as GStreamer signals)
     event_loop = asyncio.get_running_loop()
-    app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent)
-    audio_app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent)
+
+    # Load the encoder profiles with overrides for this host
+    encoder_profiles = load_encoder_profiles(args.encoder_profiles_json)
+    app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent, fanout=using_fanout or using_fast_reconnect, encoder_profiles=encoder_profiles, keep_alive=using_fast_reconnect, keep_alive_timeout_s=float(args.fast_reconnect_timeout_s), latency_tracing=using_latency_tracing, video_queue_max_time_ms=float(args.video_queue_max_time_ms), video_max_latency_ms=float(args.video_max_latency_ms), capture_idle_timeout_ms=capture_idle_timeout_ms, capture_keepalive_ms=float(args.capture_keepalive_ms), video_resize_scaling=video_resize_mode == "scale", video_coded_size=video_coded_size)
+    audio_app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent, fanout=using_fanout or using_fast_reconnect, encoder_profiles=encoder_profiles, keep_alive=using_fast_reconnect, keep_alive_timeout_s=float(args.fast_reconnect_timeout_s), latency_tracing=using_latency_tracing, video_queue_max_time_ms=float(args.video_queue_max_time_ms), video_max_latency_ms=float(args.video_max_latency_ms))
 
     # [END main_setup]
 
@@ -691,6 +796,109 @@ async def main():
     signalling.on_ice = app.set_ice
     audio_signalling.on_ice = audio_app.set_ice
 
+    # Handle text data channel messages of a viewer, switching its server messages
+    # to the binary protocol once the viewer accepted it.
+    def data_message_handler(viewer_app):
+        async def on_data_message(msg):
+            if msg.startswith("_proto,"):
+                viewer_app.binary_messages = msg == "_proto,%d" % INPUT_PROTOCOL_VERSION
+                # Clients of the binary protocol receive the theme cursors ahead of their first use
+                if viewer_app.binary_messages and webrtc_input.preloaded_cursors:
+                    viewer_app.send_cursor_preload(webrtc_input.preloaded_cursors)
+            elif msg.startswith("fd,"):
+                # File download from the transfer directory, streamed through the transfer data channel
+                try:
+                    name = base64.b64decode(msg[3:]).decode()
+                except (binascii.Error, UnicodeDecodeError) as e:
+                    logger.warning("rejecting file download with invalid name: %s" % e)
+                    viewer_app.send_transfer_error("invalid file name")
+                    return
+                try:
+                    path = resolve_download_path(file_transfer_dir, name)
+                except TransferError as e:
+                    logger.warning("rejecting file download: %s" % e)
+                    viewer_app.send_transfer_error(str(e))
+                    return
+                asyncio.create_task(viewer_app.send_file(path))
+                return
+            await webrtc_input.on_message(viewer_app.input_session, msg)
+        return on_data_message
+
+    # Input state of the data channel of a viewer, pings are answered to the same viewer.
+    def new_input_session(viewer_app):
+        session = InputSession()
+        session.on_ping_response = lambda latency: viewer_app.send_latency_time(latency)
+        viewer_app.input_session = session
+
+    # Handle the input of a viewer with its own input state, renewed when its data channel opens.
+    def bind_input(viewer_app):
+        new_input_session(viewer_app)
+        viewer_app.on_data_open = lambda: data_channel_ready(viewer_app)
+        viewer_app.on_data_message = data_message_handler(viewer_app)
+        viewer_app.on_data_binary_message = lambda data, receive_time: webrtc_input.on_binary_message(viewer_app.input_session, data, receive_time)
+
+    # Receive clipboard contents and files from the transfer data channel of a viewer.
+    def bind_transfer(viewer_app):
+        receiver = TransferReceiver(file_transfer_dir, file_transfer_max_size)
+
+        def on_clipboard_text(text):
+            if webrtc_input.enable_clipboard in ["true", "in"]:
+                webrtc_input.write_clipboard(text)
+                logger.info("set clipboard content, length: %d" % len(text))
+            else:
+                logger.warning("rejecting clipboard transfer because inbound clipboard is disabled.")
+        receiver.on_clipboard_text = on_clipboard_text
+
+        def on_clipboard_image(mime_type, data):
+            if webrtc_input.enable_clipboard in ["true", "in"]:
+                webrtc_input.write_clipboard_image(mime_type, data)
+            else:
+                logger.warning("rejecting clipboard transfer because inbound clipboard is disabled.")
+        receiver.on_clipboard_image = on_clipboard_image
+
+        receiver.on_file = lambda path: logger.info("received file: %s" % path)
+        receiver.on_abort = viewer_app.send_transfer_abort
+        receiver.on_peer_abort = viewer_app.abort_transfer
+        viewer_app.on_transfer_message = receiver.on_message
+        viewer_app.on_transfer_close = receiver.close
+
+    # Bind the signalling and app callbacks of an additional viewer.
+    def bind_viewer(viewer_app, viewer_signalling, audio_only=False):
+        viewer_app.on_sdp = viewer_signalling.send_sdp
+        viewer_app.on_ice = viewer_signalling.send_ice
+        viewer_signalling.on_sdp = viewer_app.set_sdp
+        viewer_signalling.on_ice = viewer_app.set_ice
+
+        async def on_viewer_signalling_error(e):
+            if isinstance(e, WebRTCSignallingErrorNoPeer):
+                # Signalling servers without SESSION_WAIT report a missing peer, retry in 1 second.
+                await asyncio.sleep(1.0)
+                await viewer_signalling.setup_call()
+            else:
+                logger.error("viewer signalling error: %s", str(e))
+                await viewer_app.stop_pipeline()
+        viewer_signalling.on_error = on_viewer_signalling_error
+        viewer_signalling.on_disconnect = lambda: viewer_app.stop_pipeline()
+        viewer_signalling.on_connect = viewer_signalling.setup_call
+
+        def on_viewer_session_handler(session_peer_id, meta=None):
+            logger.info("starting {} pipeline for viewer peer id {}".format("audio" if audio_only else "video", session_peer_id))
+            viewer_app.start_pipeline(audio_only=audio_only)
+            observe_session_start(session_peer_id, "audio" if audio_only else "video")
+        viewer_signalling.on_session = on_viewer_session_handler
+
+        if not audio_only:
+            bind_input(viewer_app)
+            bind_transfer(viewer_app)
+
+    # Time the browser peers registered with the signalling server, used to measure the time to pipeline start.
+    peer_hello_times = {}
+
+    def observe_session_start(session_peer_id, pipeline):
+        hello_time = peer_hello_times.pop(str(session_peer_id), None)
+        if hello_time is not None:
+            metrics.observe_session_start_time(pipeline, (time.monotonic() - hello_time) * 1000)
+
     # Start the pipeline once the session is established.
     def on_session_handler(session_peer_id, meta=None):
         logger.info("starting session for peer id {} with meta: {}".format(session_peer_id, meta))
@@ -698,23 +906,50 @@ async def main():
             if meta:
                 if enable_resize:
                     if meta["res"]:
-                        on_resize_handler(meta["res"])
+                        # Applied right away, the pipeline captures the new size from the start
+                        resize_now(meta["res"])
                     if meta["scale"]:
-                        on_scaling_ratio_handler(meta["scale"])
+                        # Applied right away like the resolution
+                        apply_scaling_ratio(meta["scale"])
                 else:
                     logger.info("setting cursor to default size")
-                    set_cursor_size(16)
+                    set_display_settings(cursor_size=16)
             logger.info("starting video pipeline")
             app.start_pipeline()
+            observe_session_start(session_peer_id, "video")
         elif str(session_peer_id) == str(audio_peer_id):
             logger.info("starting audio pipeline")
             audio_app.start_pipeline(audio_only=True)
+            observe_session_start(session_peer_id, "audio")
         else:
             logger.error("failed to start pipeline for peer_id: %s" % peer_id)
 
     signalling.on_session = on_session_handler
     audio_signalling.on_session = on_session_handler
 
+    # Additional viewers attach their own webrtcbin to the shared capture and encode pipelines of the primary apps.
+    viewers = []
+    for viewer_num in range(1, max_viewers):
+        viewer_app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent, source_app=app, encoder_profiles=encoder_profiles)
+        viewer_audio_app = GSTWebRTCApp(event_loop, stun_servers, turn_servers, audio_channels, curr_fps, args.encoder, gpu_id, curr_video_bitrate, curr_audio_bitrate, keyframe_distance, congestion_control, video_packetloss_percent, audio_packetloss_percent, source_app=audio_app, encoder_profiles=encoder_profiles)
+        viewer_signalling = WebRTCSignalling('%s//127.0.0.1:%s/ws' % (ws_protocol, args.port), my_id + 4 * viewer_num, peer_id + 4 * viewer_num,
+            enable_https=using_https,
+            enable_basic_auth=using_basic_auth,
+            basic_auth_user=args.basic_auth_user,
+            basic_auth_password=args.basic_auth_password)
+        viewer_audio_signalling = WebRTCSignalling('%s//127.0.0.1:%s/ws' % (ws_protocol, args.port), my_audio_id + 4 * viewer_num, audio_peer_id + 4 * viewer_num,
+            enable_https=using_https,
+            enable_basic_auth=using_basic_auth,
+            basic_auth_user=args.basic_auth_user,
+            basic_auth_password=args.basic_auth_password)
+        bind_viewer(viewer_app, viewer_signalling)
+        bind_viewer(viewer_audio_app, viewer_audio_signalling, audio_only=True)
+        viewers.append((viewer_app, viewer_audio_app, viewer_signalling, viewer_audio_signalling))
+
+    # Apps with a data channel to a viewer
+    def video_apps():
+        return [app] + [viewer[0] for viewer in viewers]
+
     # Initialize the X11 input instance
     cursor_scale = 1.0
     webrtc_input = WebRTCInput(
@@ -724,27 +959,45 @@ async def main():
         enable_cursors,
         cursor_size,
         cursor_scale,
-        cursor_debug)
+        cursor_debug,
+        motion_coalesce_ms=float(args.input_motion_coalesce_ms),
+        typing_key_delay_ms=float(args.text_typing_key_delay_ms),
+        cursor_preload=enable_cursors and cursor_preload)
+
+    # Map pointer positions in the scaled video to the display
+    app.on_video_size = webrtc_input.set_video_size
+
+    # Send injected pointer motion to metrics
+    webrtc_input.on_motion_injected = metrics.inc_motion_events
+
+    # Send input latency to metrics
+    if using_input_latency_metrics:
+        webrtc_input.on_input_latency = metrics.observe_input_latency
 
     # Handle changed cursors
-    webrtc_input.on_cursor_change = lambda data: app.send_cursor_data(data)
+    def on_cursor_change(data):
+        for viewer_app in video_apps():
+            viewer_app.send_cursor_data(data)
+    webrtc_input.on_cursor_change = on_cursor_change
+    webrtc_input.on_cursor_latency = metrics.observe_cursor_latency
 
     # Log message when data channel is open
-    def data_channel_ready():
+    def data_channel_ready(viewer_app=app):
         logger.info(
             "opened peer data channel for user input to X11")
+        new_input_session(viewer_app)
 
-        app.send_framerate(app.framerate)
-        app.send_video_bitrate(app.video_bitrate)
-        app.send_audio_bitrate(audio_app.audio_bitrate)
-        app.send_resize_enabled(enable_resize)
-        app.send_encoder(app.encoder)
-        app.send_cursor_data(app.last_cursor_sent)
-
-    app.on_data_open = lambda: data_channel_ready()
+        viewer_app.send_framerate(app.framerate)
+        viewer_app.send_video_bitrate(app.video_bitrate)
+        viewer_app.send_audio_bitrate(audio_app.audio_bitrate)
+        viewer_app.send_resize_enabled(enable_resize)
+        viewer_app.send_encoder(app.encoder)
+        viewer_app.send_cursor_data(app.last_cursor_sent)
+        viewer_app.send_input_protocol(INPUT_PROTOCOL_VERSION, using_input_latency_metrics)
 
     # Send incoming messages from data channel to input handler
-    app.on_data_message = webrtc_input.on_message
+    bind_input(app)
+    bind_transfer(app)
 
     # Send video bitrate messages to app
     webrtc_input.on_video_encoder_bit_rate = lambda bitrate: set_json_app_argument(args.json_config, "video_bitrate", bitrate) and (app.set_video_bitrate(int(bitrate)))
@@ -757,7 +1010,10 @@ async def main():
         visible)
 
     # Send clipboard contents when requested
-    webrtc_input.on_clipboard_read = lambda data: app.send_clipboard_data(data)
+    def on_clipboard_read(data):
+        for viewer_app in video_apps():
+            viewer_app.send_clipboard_data(data)
+    webrtc_input.on_clipboard_read = on_clipboard_read
 
     # Write framerate argument to local configuration and then tell client to reload.
     def set_fps_handler(fps):
@@ -767,17 +1023,52 @@ async def main():
 
     # Handler for resize events.
     app.last_resize_success = True
-    def on_resize_handler(res):
+    resizer = XRandRResizer()
+    try:
+        resizer.connect()
+    except XRandRError as e:
+        logger.error("display resizing is unavailable: %s" % e)
+        resizer = None
+    if resizer is not None:
+        app.set_display_size(*[int(i) for i in resizer.get_current_res().split('x')])
+
+    def resize_now(res):
+        # A debounced resize still pending is older than this one, it must not undo it.
+        if app.pending_resize is not None:
+            app.pending_resize.cancel()
+            app.pending_resize = None
         # Trigger resize and reload if it changed.
-        curr_res, new_res, _, __, ___ = get_new_res(res)
+        if resizer is None:
+            logger.warning("skipping resize to %s because RANDR is unavailable" % res)
+            return
+        curr_res, new_res = resizer.get_new_res(res)
         if curr_res != new_res:
             if not app.last_resize_success:
                 logger.warning("skipping resize because last resize failed.")
                 return
             logger.warning("resizing display from {} to {}".format(curr_res, new_res))
-            if resize_display(res):
+            if resizer.resize(res):
+                # The capture size changed, rebuild a kept alive pipeline before the next viewer attaches
+                app.invalidate_shared_pipeline()
+                app.resize_capture(*[int(i) for i in new_res.split('x')])
                 app.send_remote_resolution(res)
 
+    # Resize requests arrive in bursts while the browser window is resized,
+    # only the last one is applied once no request came for the debounce time.
+    resize_debounce_s = float(args.resize_debounce_ms) / 1000.0
+    app.pending_resize = None
+    def on_resize_handler(res):
+        if app.pending_resize is not None:
+            app.pending_resize.cancel()
+            app.pending_resize = None
+        if resize_debounce_s <= 0:
+            resize_now(res)
+            return
+        def apply_resize():
+            app.pending_resize = None
+            resize_now(res)
+        app.pending_resize = asyncio.get_running_loop().call_later(resize_debounce_s, apply_resize)
+
     # Initial binding of enable resize handler.
     if enable_resize:
         webrtc_input.on_resize = on_resize_handler
@@ -785,20 +1076,60 @@ async def main():
         logger.info("removing handler for on_resize")
         webrtc_input.on_resize = lambda res: logger.warning("remote resize is disabled, skipping resize to %s" % res)
 
-    # Handle for DPI events.
-    def on_scaling_ratio_handler(scale):
+    # DPI and cursor size are published by the built-in XSETTINGS manager when enabled,
+    # or set with xfconf-query when it is disabled or a settings daemon of the desktop owns the XSETTINGS selection.
+    # A settings daemon started after the selection was taken does not take over, so the manager is opt-in.
+    xsettings = XSettingsManager() if args.enable_xsettings_manager.lower() == 'true' else None
+    app.last_dpi = None
+    app.last_cursor_size = None
+    def set_display_settings(dpi=None, cursor_size=None):
+        # Values already applied are not set again
+        if dpi == app.last_dpi:
+            dpi = None
+        if cursor_size == app.last_cursor_size:
+            cursor_size = None
+        settings = {}
+        if dpi is not None:
+            settings["Xft/DPI"] = dpi * XSETTINGS_DPI_SCALE
+        if cursor_size is not None:
+            settings["Gtk/CursorThemeSize"] = cursor_size
+        if not settings:
+            return
+
+        published = xsettings is not None and xsettings.publish(settings)
+        if dpi is not None:
+            if published or set_dpi(dpi):
+                app.last_dpi = dpi
+            else:
+                logger.error("failed to set DPI to {}".format(dpi))
+        if cursor_size is not None:
+            if published or set_cursor_size(cursor_size):
+                app.last_cursor_size = cursor_size
+            else:
+                logger.error("failed to set cursor size to {}".format(cursor_size))
+
+    def apply_scaling_ratio(scale):
         if scale < 0.75 or scale > 2.5:
             logger.error("requested scale ratio out of bounds: {}".format(scale))
             return
         dpi = int(96 * scale)
-        logger.info("Setting DPI to: {}".format(dpi))
-        if not set_dpi(dpi):
-            logger.error("failed to set DPI to {}".format(dpi))
-
         cursor_size = int(16 * scale)
-        logger.info("Setting cursor size to: {}".format(cursor_size))
-        if not set_cursor_size(cursor_size):
-            logger.error("failed to set cursor size to {}".format(cursor_size))
+        logger.info("Setting DPI to: {} and cursor size to: {}".format(dpi, cursor_size))
+        set_display_settings(dpi, cursor_size)
+
+    # Handle for DPI events, coalesced like resize requests as they arrive together while the browser window changes.
+    app.pending_scale = None
+    def on_scaling_ratio_handler(scale):
+        if app.pending_scale is not None:
+            app.pending_scale.cancel()
+            app.pending_scale = None
+        if resize_debounce_s <= 0:
+            apply_scaling_ratio(scale)
+            return
+        def apply_scale():
+            app.pending_scale = None
+            apply_scaling_ratio(scale)
+        app.pending_scale = asyncio.get_running_loop().call_later(resize_debounce_s, apply_scale)
 
     # Bind DPI handler.
     if enable_resize:
@@ -806,8 +1137,6 @@ async def main():
     else:
         webrtc_input.on_scaling_ratio = lambda scale: logger.warning("remote resize is disabled, skipping DPI scale change to %s" % str(scale))
 
-    webrtc_input.on_ping_response = lambda latency: app.send_latency_time(latency)
-
     # Enable resize with resolution handler
     def enable_resize_handler(enabled, enable_res):
         set_json_app_argument(args.json_config, "enable_resize", enabled)
@@ -828,6 +1157,25 @@ async def main():
     # Send client FPS to metrics
     webrtc_input.on_client_fps = lambda fps: metrics.set_fps(fps)
 
+    # Send GStreamer bus message dispatch delay to metrics
+    app.on_bus_dispatch_delay = lambda delay_ms: metrics.observe_bus_dispatch_delay("video", delay_ms)
+    audio_app.on_bus_dispatch_delay = lambda delay_ms: metrics.observe_bus_dispatch_delay("audio", delay_ms)
+
+    # Send dropped video frames to metrics
+    app.on_frames_dropped = metrics.inc_dropped_frames
+
+    # Send the time from display resizes to the first frame at the new size to metrics
+    app.on_resize_first_frame = lambda latency_ms: metrics.observe_resize_first_frame(video_resize_mode, latency_ms)
+
+    # Send idle capture state of every captured frame to metrics
+    if capture_idle_timeout_ms > 0:
+        app.on_capture_frame = metrics.observe_capture_frame
+
+    # Send pipeline element processing times to metrics
+    if using_latency_tracing:
+        app.on_element_latency = metrics.observe_element_latency
+        audio_app.on_element_latency = metrics.observe_element_latency
+
     # Send client latency to metrics
     webrtc_input.on_client_latency = lambda latency_ms: metrics.set_latency(latency_ms)
 
@@ -839,18 +1187,42 @@ async def main():
 
     # Send the GPU stats when available.
     def on_gpu_stats(load, memory_total, memory_used):
-        app.send_gpu_stats(load, memory_total, memory_used)
+        for viewer_app in video_apps():
+            viewer_app.send_gpu_stats(load, memory_total, memory_used)
         metrics.set_gpu_utilization(load * 100)
 
     gpu_mon.on_stats = on_gpu_stats
 
+    # Initialize the damage monitor, resuming the idle capture as soon as the screen changes
+    damage_mon = DamageMonitor()
+    damage_mon.on_damage = app.notify_damage
+
+    # Screen changes are only taken from DAMAGE once the root window is watched
+    def on_damage_monitor_start():
+        app.capture_damage_events = True
+    damage_mon.on_start = on_damage_monitor_start
+
+    async def run_damage_monitor():
+        try:
+            await damage_mon.start()
+        except DamageMonitorError as e:
+            logger.warning("%s, detecting idle screen by comparing captured frames" % e)
+        except Exception as e:
+            logger.error("damage monitor failed, detecting idle screen by comparing captured frames: %s" % e)
+        finally:
+            app.capture_damage_events = False
+
     # Initialize the system monitor
     system_mon = SystemMonitor()
 
     def on_sysmon_timer(t):
-        webrtc_input.ping_start = t
-        app.send_system_stats(system_mon.cpu_percent, system_mon.mem_total, system_mon.mem_used)
-        app.send_ping(t)
+        if using_latency_tracing:
+            metrics.set_queue_levels("video", app.get_queue_levels())
+            metrics.set_queue_levels("audio", audio_app.get_queue_levels())
+        for viewer_app in video_apps():
+            viewer_app.send_system_stats(system_mon.cpu_percent, system_mon.mem_total, system_mon.mem_used)
+            viewer_app.input_session.ping_start = t
+            viewer_app.send_ping(t)
 
     system_mon.on_timer = on_sysmon_timer
 
@@ -885,18 +1257,25 @@ async def main():
     options.stun_host = args.stun_host
     options.stun_port = args.stun_port
     server = WebRTCSimpleServer(options)
+    server.on_peer_hello = lambda uid: peer_hello_times.__setitem__(uid, time.monotonic())
+
+    # Exchange signalling messages of the streaming app with the server through in-process queues
+    if args.enable_local_signalling.lower() == 'true':
+        for local_signalling in [signalling, audio_signalling] + [s for viewer in viewers for s in viewer[2:]]:
+            local_signalling.local_server = server
 
     # Callback method to update TURN servers of a running pipeline.
     def mon_rtc_config(stun_servers, turn_servers, rtc_config):
-        if app.webrtcbin:
-            logger.info("updating STUN server")
-            app.webrtcbin.set_property("stun-server", stun_servers[0])
-            for i, turn_server in enumerate(turn_servers):
-                logger.info("updating TURN server")
-                if i == 0:
-                    app.webrtcbin.set_property("turn-server", turn_server)
-                else:
-                    app.webrtcbin.emit("add-turn-server", turn_server)
+        for viewer_app in video_apps():
+            if viewer_app.webrtcbin:
+                logger.info("updating STUN server")
+                viewer_app.webrtcbin.set_property("stun-server", stun_servers[0])
+                for i, turn_server in enumerate(turn_servers):
+                    logger.info("updating TURN server")
+                    if i == 0:
+                        viewer_app.webrtcbin.set_property("turn-server", turn_server)
+                    else:
+                        viewer_app.webrtcbin.emit("add-turn-server", turn_server)
         server.set_rtc_config(rtc_config)
 
     # Initialize periodic monitor to refresh TURN RTC config when using shared secret.
@@ -930,6 +1309,20 @@ async def main():
         enabled=using_rtc_config_json)
     rtc_file_mon.on_rtc_config = mon_rtc_config
 
+    # Connection loop of an additional viewer, mirrors the loop of the primary viewer.
+    async def run_viewer(viewer_app, viewer_audio_app, viewer_signalling, viewer_audio_signalling):
+        while True:
+            try:
+                await viewer_signalling.connect()
+                await viewer_audio_signalling.connect()
+                asyncio.create_task(viewer_audio_signalling.start())
+                await viewer_signalling.start()
+            except Exception as e:
+                logger.error("viewer connection error: %s" % e)
+                await asyncio.sleep(1.0)
+            await viewer_app.stop_pipeline()
+            await viewer_audio_app.stop_pipeline()
+
     try:
         asyncio.create_task(server.run())
         if using_metrics_http:
@@ -942,6 +1335,14 @@ async def main():
         asyncio.create_task(turn_rest_mon.start())
         asyncio.create_task(rtc_file_mon.start())
         asyncio.create_task(system_mon.start())
+        if capture_idle_timeout_ms > 0:
+            asyncio.create_task(run_damage_monitor())
+        if using_pipeline_preroll:
+            logger.info("pre-rolling capture and encode pipelines")
+            app.start_shared_pipeline()
+            audio_app.start_shared_pipeline(audio_only=True)
+        for viewer in viewers:
+            asyncio.create_task(run_viewer(*viewer))
         while True:
             if using_webrtc_csv:
                 metrics.initialize_webrtc_csv_file(args.webrtc_statistics_dir)
@@ -959,8 +1360,13 @@ async def main():
         traceback.print_exc()
         sys.exit(1)
     finally:
+        for viewer_app, viewer_audio_app, _, __ in viewers:
+            await viewer_app.stop_pipeline()
+            await viewer_audio_app.stop_pipeline()
         await app.stop_pipeline()
         await audio_app.stop_pipeline()
+        await app.stop_shared_pipeline()
+        await audio_app.stop_shared_pipeline()
         webrtc_input.stop_clipboard()
         webrtc_input.stop_cursor_monitor()
         await webrtc_input.stop_js_server()
@@ -970,6 +1376,9 @@ async def main():
         await turn_rest_mon.stop()
         await rtc_file_mon.stop()
         system_mon.stop()
+        damage_mon.stop()
+        if xsettings is not None:
+            xsettings.close()
         await server.stop()
         sys.exit(0)
 
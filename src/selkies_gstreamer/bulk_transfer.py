@@ -0,0 +1,257 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import struct
+import zlib
+
+import logging
+logger = logging.getLogger("bulk_transfer")
+logger.setLevel(logging.INFO)
+
+# Messages of the "transfer" data channel.
+# A transfer is a start message, chunks in order and an end message with the CRC32 of the data,
+# either side can abort it. Server transfer ids are even and client transfer ids are odd.
+TRANSFER_OP_START = 0x01
+TRANSFER_OP_CHUNK = 0x02
+TRANSFER_OP_END = 0x03
+TRANSFER_OP_ABORT = 0x04
+
+TRANSFER_KIND_CLIPBOARD_TEXT = 1
+TRANSFER_KIND_CLIPBOARD_IMAGE = 2
+TRANSFER_KIND_FILE = 3
+
+# opcode, transfer id, kind, total size, followed by the UTF-8 name, the MIME type for clipboard transfers
+TRANSFER_START_STRUCT = struct.Struct("<BIBQ")
+# opcode, transfer id, offset, followed by the data
+TRANSFER_CHUNK_STRUCT = struct.Struct("<BIQ")
+# opcode, transfer id, CRC32 of the data
+TRANSFER_END_STRUCT = struct.Struct("<BII")
+# opcode, transfer id, followed by the UTF-8 reason
+TRANSFER_ABORT_STRUCT = struct.Struct("<BI")
+
+# Data in each chunk, SCTP messages of this size are accepted by all browsers
+TRANSFER_CHUNK_SIZE = 16 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def transfer_messages(transfer_id, kind, name, size, read):
+    """Yields the messages of a transfer
+
+    Arguments:
+        transfer_id {integer} -- id of the transfer
+        kind {integer} -- one of TRANSFER_KIND_*
+        name {string} -- file name or MIME type
+        size {integer} -- total size of the data
+        read {function} -- returns up to the given number of bytes of the data, empty at the end
+    """
+
+    yield TRANSFER_START_STRUCT.pack(TRANSFER_OP_START, transfer_id, kind, size) + name.encode()
+    crc = 0
+    offset = 0
+    while True:
+        data = read(TRANSFER_CHUNK_SIZE)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        yield TRANSFER_CHUNK_STRUCT.pack(TRANSFER_OP_CHUNK, transfer_id, offset) + data
+        offset += len(data)
+    if offset != size:
+        raise TransferError("transfer %d changed size from %d to %d bytes" % (transfer_id, size, offset))
+    yield TRANSFER_END_STRUCT.pack(TRANSFER_OP_END, transfer_id, crc)
+
+
+def abort_message(transfer_id, reason):
+    return TRANSFER_ABORT_STRUCT.pack(TRANSFER_OP_ABORT, transfer_id) + reason.encode()
+
+
+class IncomingTransfer:
+    def __init__(self, transfer_id, kind, name, size):
+        self.transfer_id = transfer_id
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.crc = 0
+        # Clipboard data is kept in memory, files are written to path with a .part suffix until complete
+        self.buffer = None
+        self.path = None
+        self.file = None
+
+
+class TransferReceiver:
+    """Receives the transfers of a client from the "transfer" data channel
+
+    Chunks are checked for their offset, the total size and the CRC32 of the
+    data. Files are written to a directory, without replacing existing files.
+    """
+
+    def __init__(self, directory=None, max_size=1024 * 1024 * 1024):
+        """Initializes the receiver
+
+        Arguments:
+            directory {string} -- directory to write received files to, None rejects files
+            max_size {integer} -- maximum size of a transfer in bytes
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+        self.transfers = {}
+
+        self.on_clipboard_text = lambda text: logger.warning("unhandled on_clipboard_text")
+        self.on_clipboard_image = lambda mime_type, data: logger.warning("unhandled on_clipboard_image")
+        self.on_file = lambda path: logger.warning("unhandled on_file")
+        # Sends an abort message for a client transfer
+        self.on_abort = lambda transfer_id, reason: logger.warning("unhandled on_abort")
+        # The client aborted a transfer sent by the server
+        self.on_peer_abort = lambda transfer_id: logger.warning("unhandled on_peer_abort")
+
+    def on_message(self, data):
+        """Handles a message from the transfer data channel
+
+        Arguments:
+            data {bytes} -- the message
+        """
+
+        if len(data) < TRANSFER_ABORT_STRUCT.size:
+            logger.warning("dropping short transfer message, length: %d" % len(data))
+            return
+        op, transfer_id = TRANSFER_ABORT_STRUCT.unpack_from(data)
+        if op == TRANSFER_OP_ABORT:
+            reason = data[TRANSFER_ABORT_STRUCT.size:].decode(errors="replace")
+            if transfer_id in self.transfers:
+                logger.info("client aborted transfer %d: %s" % (transfer_id, reason))
+                self.__discard(self.transfers.pop(transfer_id))
+            else:
+                self.on_peer_abort(transfer_id)
+            return
+
+        try:
+            if op == TRANSFER_OP_START:
+                self.__start(data)
+            elif op == TRANSFER_OP_CHUNK:
+                self.__chunk(data)
+            elif op == TRANSFER_OP_END:
+                self.__end(data)
+            else:
+                raise TransferError("unknown transfer message: %d" % op)
+        except (TransferError, OSError, struct.error) as e:
+            logger.warning("aborting transfer %d: %s" % (transfer_id, e))
+            transfer = self.transfers.pop(transfer_id, None)
+            if transfer is not None:
+                self.__discard(transfer)
+            self.on_abort(transfer_id, str(e))
+
+    def close(self):
+        """Discards the incomplete transfers, e.g. when the data channel closed
+        """
+
+        for transfer in self.transfers.values():
+            self.__discard(transfer)
+        self.transfers = {}
+
+    def __start(self, data):
+        _, transfer_id, kind, size = TRANSFER_START_STRUCT.unpack_from(data)
+        name = data[TRANSFER_START_STRUCT.size:].decode(errors="replace")
+        if transfer_id in self.transfers:
+            raise TransferError("transfer already started")
+        if size > self.max_size:
+            raise TransferError("size of %d bytes is above the limit of %d bytes" % (size, self.max_size))
+
+        transfer = IncomingTransfer(transfer_id, kind, name, size)
+        if kind in (TRANSFER_KIND_CLIPBOARD_TEXT, TRANSFER_KIND_CLIPBOARD_IMAGE):
+            transfer.buffer = bytearray()
+        elif kind == TRANSFER_KIND_FILE:
+            if not self.directory:
+                raise TransferError("file transfers are disabled")
+            transfer.path = self.__unique_path(name)
+            transfer.file = open(transfer.path + ".part", "wb")
+        else:
+            raise TransferError("unknown transfer kind: %d" % kind)
+        self.transfers[transfer_id] = transfer
+        logger.info("receiving transfer %d: %s, %d bytes" % (transfer_id, name, size))
+
+    def __chunk(self, data):
+        _, transfer_id, offset = TRANSFER_CHUNK_STRUCT.unpack_from(data)
+        transfer = self.__get(transfer_id)
+        chunk = data[TRANSFER_CHUNK_STRUCT.size:]
+        if offset != transfer.received:
+            raise TransferError("chunk at offset %d, expected %d" % (offset, transfer.received))
+        if transfer.received + len(chunk) > transfer.size:
+            raise TransferError("more data than the announced %d bytes" % transfer.size)
+
+        transfer.crc = zlib.crc32(chunk, transfer.crc)
+        transfer.received += len(chunk)
+        if transfer.file is not None:
+            transfer.file.write(chunk)
+        else:
+            transfer.buffer += chunk
+
+    def __end(self, data):
+        _, transfer_id, crc = TRANSFER_END_STRUCT.unpack_from(data)
+        transfer = self.__get(transfer_id)
+        if transfer.received != transfer.size:
+            raise TransferError("received %d of %d bytes" % (transfer.received, transfer.size))
+        if crc != transfer.crc:
+            raise TransferError("CRC32 mismatch")
+
+        del self.transfers[transfer_id]
+        logger.info("received transfer %d: %s" % (transfer_id, transfer.name))
+        if transfer.kind == TRANSFER_KIND_CLIPBOARD_TEXT:
+            self.on_clipboard_text(transfer.buffer.decode(errors="replace"))
+        elif transfer.kind == TRANSFER_KIND_CLIPBOARD_IMAGE:
+            self.on_clipboard_image(transfer.name, bytes(transfer.buffer))
+        else:
+            transfer.file.close()
+            os.rename(transfer.path + ".part", transfer.path)
+            self.on_file(transfer.path)
+
+    def __get(self, transfer_id):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            raise TransferError("transfer not started")
+        return transfer
+
+    def __discard(self, transfer):
+        if transfer.file is not None:
+            transfer.file.close()
+            try:
+                os.remove(transfer.path + ".part")
+            except OSError:
+                pass
+
+    def __unique_path(self, name):
+        """Returns a path in the directory for a file name sent by the client, without replacing existing files
+        """
+
+        name = os.path.basename(name.replace("\\", "/")).strip()
+        if name in ("", ".", ".."):
+            raise TransferError("invalid file name")
+        base, ext = os.path.splitext(name)
+        path = os.path.join(self.directory, name)
+        i = 1
+        while os.path.exists(path) or os.path.exists(path + ".part"):
+            path = os.path.join(self.directory, "%s (%d)%s" % (base, i, ext))
+            i += 1
+        return path
+
+
+def resolve_download_path(directory, name):
+    """Returns the path of a file in the directory requested by the client
+
+    Raises:
+        TransferError -- if the file is outside the directory or does not exist
+    """
+
+    if not directory:
+        raise TransferError("file transfers are disabled")
+    path = os.path.realpath(os.path.join(directory, name))
+    if os.path.commonpath([path, os.path.realpath(directory)]) != os.path.realpath(directory):
+        raise TransferError("file is outside of the transfer directory: %s" % name)
+    if not os.path.isfile(path):
+        raise TransferError("file not found: %s" % name)
+    return path
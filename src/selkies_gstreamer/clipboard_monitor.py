@@ -0,0 +1,153 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import hashlib
+from Xlib import X, display
+from Xlib.ext import xfixes
+
+import logging
+logger = logging.getLogger("clipboard_monitor")
+logger.setLevel(logging.INFO)
+
+
+class ClipboardMonitorError(Exception):
+    pass
+
+
+class ClipboardMonitor:
+    """Watches the CLIPBOARD selection with the XFIXES extension
+
+    The selection is converted to UTF-8 text only when its owner changes and
+    on_clipboard is fired when the text differs from the last one seen. Only a
+    hash of the last text is kept. Large selections are read with the INCR protocol.
+    """
+
+    def __init__(self, display_name=None):
+        self.display_name = display_name
+        self.xdisplay = None
+        self.window = None
+        self.atoms = {}
+        self.last_hash = None
+        self.stopped = None
+
+        # Chunks of an incremental transfer, None when no transfer is running
+        self.incr_chunks = None
+
+        self.on_clipboard = lambda text: logger.warning("unhandled on_clipboard")
+
+    async def start(self):
+        """Starts watching the clipboard until stop() is called
+
+        Raises:
+            ClipboardMonitorError -- if the X server does not support the XFIXES extension
+        """
+
+        self.xdisplay = display.Display(self.display_name)
+        if self.xdisplay.query_extension('XFIXES') is None:
+            self.xdisplay.close()
+            raise ClipboardMonitorError("XFIXES extension not supported, cannot watch clipboard changes")
+        self.xdisplay.xfixes_query_version()
+
+        for name in ("CLIPBOARD", "UTF8_STRING", "INCR", "SELKIES_CLIPBOARD"):
+            self.atoms[name] = self.xdisplay.intern_atom(name)
+
+        # Unmapped window receiving the converted selection
+        root = self.xdisplay.screen().root
+        self.window = root.create_window(0, 0, 1, 1, 0, X.CopyFromParent, event_mask=X.PropertyChangeMask)
+        root.xfixes_select_selection_input(
+            self.atoms["CLIPBOARD"], xfixes.XFixesSetSelectionOwnerNotifyMask)
+
+        # Read the current contents
+        if self.xdisplay.get_selection_owner(self.atoms["CLIPBOARD"]) != X.NONE:
+            self.__convert(X.CurrentTime)
+        self.xdisplay.flush()
+
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        loop.add_reader(self.xdisplay.fileno(), self.__process_events)
+        logger.info("watching for clipboard changes")
+        try:
+            await self.stopped
+        finally:
+            loop.remove_reader(self.xdisplay.fileno())
+            self.window.destroy()
+            self.xdisplay.close()
+            self.xdisplay = None
+            self.window = None
+        logger.info("clipboard monitor stopped")
+
+    def stop(self):
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def set_last_text(self, text):
+        """Sets the text last seen, so a selection set to it is not reported again
+
+        Arguments:
+            text {string} -- clipboard text, e.g. written from the client
+        """
+
+        self.last_hash = hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def __convert(self, timestamp):
+        self.incr_chunks = None
+        self.window.convert_selection(
+            self.atoms["CLIPBOARD"], self.atoms["UTF8_STRING"], self.atoms["SELKIES_CLIPBOARD"], timestamp)
+
+    def __process_events(self):
+        while self.xdisplay.pending_events() > 0:
+            event = self.xdisplay.next_event()
+            if (event.type, 0) == self.xdisplay.extension_event.SetSelectionOwnerNotify:
+                if event.owner != X.NONE:
+                    self.__convert(event.timestamp)
+            elif event.type == X.SelectionNotify:
+                self.__on_selection_notify(event)
+            elif event.type == X.PropertyNotify:
+                self.__on_property_notify(event)
+        self.xdisplay.flush()
+
+    def __on_selection_notify(self, event):
+        if event.property == X.NONE:
+            logger.debug("clipboard owner refused to convert the selection to text")
+            return
+
+        prop = self.window.get_full_property(event.property, X.AnyPropertyType)
+        if prop is None:
+            return
+        if prop.property_type == self.atoms["INCR"]:
+            # Deleting the property asks the owner for the first chunk
+            self.incr_chunks = []
+            self.window.delete_property(event.property)
+            return
+        self.window.delete_property(event.property)
+        self.__set_text(prop.value)
+
+    def __on_property_notify(self, event):
+        if self.incr_chunks is None or event.atom != self.atoms["SELKIES_CLIPBOARD"] or event.state != X.PropertyNewValue:
+            return
+
+        prop = self.window.get_full_property(event.atom, X.AnyPropertyType)
+        self.window.delete_property(event.atom)
+        if prop is None:
+            return
+        if len(prop.value) > 0:
+            self.incr_chunks.append(prop.value)
+            return
+
+        # An empty chunk ends the transfer
+        chunks = self.incr_chunks
+        self.incr_chunks = None
+        self.__set_text(b"".join(chunks))
+
+    def __set_text(self, value):
+        if not isinstance(value, bytes):
+            value = bytes(value)
+        if not value:
+            return
+        value_hash = hashlib.blake2b(value, digest_size=16).digest()
+        if value_hash == self.last_hash:
+            return
+        self.last_hash = value_hash
+        self.on_clipboard(value.decode(errors="replace"))
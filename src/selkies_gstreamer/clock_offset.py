@@ -0,0 +1,50 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+
+
+class ClockOffsetEstimator:
+    """Estimates the offset of a remote clock to the local monotonic clock
+
+    Each ping round trip gives a sample assuming the remote clock was read halfway
+    through the round trip. The error of a sample is at most half its round trip,
+    so the offset of the shortest recent round trip is used.
+    """
+
+    def __init__(self, window=16):
+        """Initializes the estimator
+
+        Arguments:
+            window {integer} -- number of recent samples to pick the shortest round trip from
+        """
+
+        self.samples = collections.deque(maxlen=window)
+        self.offset = None
+
+    def add_sample(self, remote_time, local_time, roundtrip):
+        """Adds a ping round trip
+
+        Arguments:
+            remote_time {float} -- remote time in seconds when the ping was answered
+            local_time {float} -- local monotonic time in seconds when the answer was received
+            roundtrip {float} -- round trip time in seconds
+        """
+
+        self.samples.append((roundtrip, remote_time - (local_time - roundtrip / 2)))
+        self.offset = min(self.samples)[1]
+
+    def to_local(self, remote_time):
+        """Converts a remote time to the local monotonic clock
+
+        Arguments:
+            remote_time {float} -- remote time in seconds
+
+        Returns:
+            float -- local monotonic time in seconds, None until the first sample
+        """
+
+        if self.offset is None:
+            return None
+        return remote_time - self.offset
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+from Xlib import display
+from Xlib.ext import damage
+
+import logging
+logger = logging.getLogger("damage_monitor")
+logger.setLevel(logging.INFO)
+
+
+class DamageMonitorError(Exception):
+    pass
+
+
+class DamageMonitor:
+    """Watches the root window with the X11 DAMAGE extension
+
+    Fires on_damage whenever the screen contents changed since the previous
+    notification. The X connection is read from the event loop, so changes are
+    reported as soon as the X server sends them without polling.
+    """
+
+    def __init__(self, display_name=None):
+        self.display_name = display_name
+        self.xdisplay = None
+        self.damage = None
+        self.damage_notify_type = None
+        self.running = False
+        self.stopped = None
+
+        self.on_damage = lambda: logger.warning("unhandled on_damage")
+        # Fired once the root window is watched, screen changes are reported from then on
+        self.on_start = lambda: logger.warning("unhandled on_start")
+
+    async def start(self):
+        """Starts watching for damage until stop() is called
+
+        Raises:
+            DamageMonitorError -- if the X server does not support the DAMAGE extension
+        """
+
+        self.xdisplay = display.Display(self.display_name)
+        extension = self.xdisplay.query_extension(damage.extname)
+        if extension is None:
+            self.xdisplay.close()
+            raise DamageMonitorError("DAMAGE extension not supported, cannot watch screen changes")
+
+        damage_version = self.xdisplay.damage_query_version()
+        logger.info("Found DAMAGE version %s.%s" % (
+            damage_version.major_version,
+            damage_version.minor_version,
+        ))
+
+        # With the non-empty report level the server sends a single notification
+        # until the damage is subtracted again, no matter how much was drawn.
+        self.damage_notify_type = extension.first_event + damage.DamageNotifyCode
+        self.damage = self.xdisplay.screen().root.damage_create(damage.DamageReportNonEmpty)
+        self.xdisplay.flush()
+
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.running = True
+        loop.add_reader(self.xdisplay.fileno(), self.__process_events)
+        logger.info("watching for screen damage")
+        try:
+            self.on_start()
+            await self.stopped
+        finally:
+            loop.remove_reader(self.xdisplay.fileno())
+            self.running = False
+            self.xdisplay.close()
+            self.xdisplay = None
+        logger.info("damage monitor stopped")
+
+    def __process_events(self):
+        damaged = False
+        while self.xdisplay.pending_events() > 0:
+            event = self.xdisplay.next_event()
+            if event.type == self.damage_notify_type:
+                damaged = True
+        if damaged:
+            self.xdisplay.damage_subtract(self.damage)
+            self.xdisplay.flush()
+            self.on_damage()
+
+    def stop(self):
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
@@ -0,0 +1,480 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Encoder profile registry for the video pipeline
+
+Each profile describes how to build and tune one supported video encoder:
+
+    plugin {string} -- GStreamer plugin providing the encoder, checked at startup.
+    codec {string} -- payload codec: h264, h265, vp8, vp9 or av1.
+    converter {object} -- colorspace conversion stage: type is one of cuda, va or videoconvert, format is the raw format fed to the encoder, threads is the maximum number of conversion threads.
+    name {string} -- element name of the encoder in the pipeline, used by the runtime setters.
+    factories {list} -- candidate element factory names tried in order, each optionally restricted with gpu (true when the GPU ID is above 0) and gst_minor ([min, max] GStreamer 1.x minor version, inclusive, either bound may be null).
+        Factory names may use the {gpu_id} and {render_node} placeholders.
+    properties {object} -- properties set once when the encoder is built.
+        A value of {"threads": n} is replaced with the number of available CPUs minus one, clamped to [1, n].
+    optional_properties {list} -- properties silently skipped when the encoder does not provide them.
+    version_properties {list} -- extra properties applied when the gst_minor range of the entry matches.
+    bitrate {object} -- property receiving the target bitrate in kbps multiplied by scale.
+    keyframe {object} -- property receiving the keyframe distance in frames, set to infinite when keyframes are not periodic.
+    vbv {object} -- VBV/HRD buffer properties, in kbit (sized to one frame of the bitrate) or ms (sized to one frame time), scaled by multiplier, or by periodic_multiplier when keyframes are periodic.
+
+Profiles may be overridden per host with a JSON file of the same layout,
+objects are merged into the built-in profiles and other values replace them.
+
+    Usage example:
+    from encoder_profiles import load_encoder_profiles
+    profiles = load_encoder_profiles("/etc/selkies/encoder_profiles.json")
+    profile = profiles["x264enc"]
+
+"""
+
+import copy
+import json
+import logging
+import os
+
+logger = logging.getLogger("encoder_profiles")
+logger.setLevel(logging.INFO)
+
+
+NVENC_VERSION_PROPERTIES = [
+    {"gst_minor": [21, 24], "properties": {"rate-control": "cbr", "b-frames": 0, "zero-reorder-delay": True}},
+    {"gst_minor": [None, 20], "properties": {"rc-mode": "cbr", "bframes": 0, "zerolatency": True}},
+    {"gst_minor": [25, None], "properties": {"rc-mode": "cbr", "bframes": 0, "zerolatency": True}},
+    {"gst_minor": [21, None], "properties": {"repeat-sequence-header": True}},
+    {"gst_minor": [23, None], "properties": {"preset": "p4", "tune": "ultra-low-latency", "multi-pass": "two-pass-quarter"}},
+    {"gst_minor": [None, 22], "properties": {"preset": "low-latency-hq"}},
+]
+
+
+def nvenc_factories(codec):
+    return [
+        {"name": "nvcuda%sdevice{gpu_id}enc" % codec, "gpu": True, "gst_minor": [21, 24]},
+        {"name": "nv%sdevice{gpu_id}enc" % codec, "gpu": True},
+        {"name": "nvcuda%senc" % codec, "gpu": False, "gst_minor": [21, 24]},
+        {"name": "nv%senc" % codec, "gpu": False},
+    ]
+
+
+def va_factories(codec):
+    return [
+        {"name": "varenderD{render_node}%senc" % codec, "gpu": True},
+        {"name": "varenderD{render_node}%slpenc" % codec, "gpu": True},
+        {"name": "va%senc" % codec, "gpu": False},
+        {"name": "va%slpenc" % codec, "gpu": False},
+    ]
+
+
+# ADD_ENCODER: add new encoder profile to this table
+# Reference configuration for fixing when something is broken in web browsers:
+#   https://gitlab.freedesktop.org/gstreamer/gst-plugins-rs/-/blob/main/net/webrtc/src/webrtcsink/imp.rs
+DEFAULT_ENCODER_PROFILES = {
+    # See this link for details on NVENC parameters recommended for
+    # low-latency streaming (also a setting reference for other encoders):
+    #   https://docs.nvidia.com/video-technologies/video-codec-sdk/12.2/nvenc-video-encoder-api-prog-guide/index.html#recommended-nvenc-settings
+    "nvh264enc": {
+        "plugin": "nvcodec",
+        "codec": "h264",
+        "converter": {"type": "cuda", "format": "NV12"},
+        "name": "nvenc",
+        "factories": nvenc_factories("h264"),
+        "properties": {
+            # Minimize GOP-to-GOP rate fluctuations
+            "strict-gop": True,
+            "aud": False,
+            # Do not automatically add b-frames, disable lookahead
+            "b-adapt": False,
+            "rc-lookahead": 0,
+        },
+        "version_properties": NVENC_VERSION_PROPERTIES + [
+            # CABAC is more bandwidth-efficient compared to CAVLC at a tradeoff of slight increase (<= 1 ms) in decoding time
+            {"gst_minor": [21, None], "properties": {"cabac": True}},
+        ],
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "gop-size", "infinite": -1},
+        "vbv": {"properties": ["vbv-buffer-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "nvh265enc": {
+        "plugin": "nvcodec",
+        "codec": "h265",
+        "converter": {"type": "cuda", "format": "NV12"},
+        "name": "nvenc",
+        "factories": nvenc_factories("h265"),
+        "properties": {
+            "strict-gop": True,
+            "aud": False,
+            "b-adapt": False,
+            "rc-lookahead": 0,
+        },
+        # B-frames in H.265 are only provided with newer GPUs
+        "optional_properties": ["b-adapt", "b-frames", "bframes"],
+        "version_properties": NVENC_VERSION_PROPERTIES,
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "gop-size", "infinite": -1},
+        "vbv": {"properties": ["vbv-buffer-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "nvav1enc": {
+        "plugin": "nvcodec",
+        "codec": "av1",
+        "converter": {"type": "cuda", "format": "NV12"},
+        "name": "nvenc",
+        "factories": nvenc_factories("av1"),
+        "properties": {
+            "strict-gop": True,
+            "b-adapt": False,
+            "rc-lookahead": 0,
+        },
+        "version_properties": [entry for entry in NVENC_VERSION_PROPERTIES if "repeat-sequence-header" not in entry["properties"]],
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "gop-size", "infinite": -1},
+        "vbv": {"properties": ["vbv-buffer-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "vah264enc": {
+        "plugin": "va",
+        "codec": "h264",
+        "converter": {"type": "va", "format": "NV12"},
+        "name": "vaenc",
+        "factories": va_factories("h264"),
+        "properties": {
+            "aud": False,
+            "b-frames": 0,
+            "dct8x8": False,
+            "mbbrc": "disabled",
+            "num-slices": 4,
+            "ref-frames": 1,
+            "rate-control": "cbr",
+            "target-usage": 6,
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 1024},
+        "vbv": {"properties": ["cpb-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "vah265enc": {
+        "plugin": "va",
+        "codec": "h265",
+        "converter": {"type": "va", "format": "NV12"},
+        "name": "vaenc",
+        "factories": va_factories("h265"),
+        "properties": {
+            "aud": False,
+            "b-frames": 0,
+            "mbbrc": "disabled",
+            "num-slices": 4,
+            "ref-frames": 1,
+            "rate-control": "cbr",
+            "target-usage": 6,
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 1024},
+        "vbv": {"properties": ["cpb-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "vavp9enc": {
+        "plugin": "va",
+        "codec": "vp9",
+        "converter": {"type": "va", "format": "NV12"},
+        "name": "vaenc",
+        "factories": va_factories("vp9"),
+        "properties": {
+            "hierarchical-level": 1,
+            "mbbrc": "disabled",
+            "ref-frames": 1,
+            "rate-control": "cbr",
+            "target-usage": 6,
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 1024},
+        "vbv": {"properties": ["cpb-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "vaav1enc": {
+        "plugin": "va",
+        "codec": "av1",
+        "converter": {"type": "va", "format": "NV12"},
+        "name": "vaenc",
+        "factories": va_factories("av1"),
+        "properties": {
+            "hierarchical-level": 1,
+            "mbbrc": "disabled",
+            "ref-frames": 1,
+            "tile-groups": 16,
+            "rate-control": "cbr",
+            "target-usage": 6,
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 1024},
+        "vbv": {"properties": ["cpb-size"], "unit": "kbit", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "x264enc": {
+        "plugin": "x264",
+        "codec": "h264",
+        "converter": {"type": "videoconvert", "format": "NV12", "threads": 4},
+        "name": "x264enc",
+        "factories": [{"name": "x264enc"}],
+        "properties": {
+            # Chromium has issues with more than four encoding slices
+            "threads": {"threads": 4},
+            "aud": False,
+            "b-adapt": False,
+            "bframes": 0,
+            "dct8x8": False,
+            "insert-vui": True,
+            "mb-tree": False,
+            "rc-lookahead": 0,
+            "sync-lookahead": 0,
+            "sliced-threads": True,
+            "byte-stream": True,
+            "pass": "cbr",
+            "speed-preset": "ultrafast",
+            "tune": "zerolatency",
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 2147483647},
+        "vbv": {"properties": ["vbv-buf-capacity"], "unit": "ms", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "openh264enc": {
+        "plugin": "openh264",
+        "codec": "h264",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "openh264enc",
+        "factories": [{"name": "openh264enc"}],
+        "properties": {
+            "adaptive-quantization": False,
+            "background-detection": False,
+            "enable-frame-skip": False,
+            "scene-change-detection": False,
+            "usage-type": "screen",
+            "complexity": "low",
+            "multi-thread": {"threads": 4},
+            "slice-mode": "n-slices",
+            # Chromium has issues with more than four encoding slices
+            "num-slices": {"threads": 4},
+            "rate-control": "bitrate",
+        },
+        "bitrate": {"property": "bitrate", "scale": 1000},
+        "keyframe": {"property": "gop-size", "infinite": 2147483647},
+    },
+    "x265enc": {
+        "plugin": "x265",
+        "codec": "h265",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "x265enc",
+        "factories": [{"name": "x265enc"}],
+        "properties": {
+            "option-string": "b-adapt=0:bframes=0:rc-lookahead=0:repeat-headers:pmode:wpp",
+            "speed-preset": "ultrafast",
+            "tune": "zerolatency",
+        },
+        "bitrate": {"property": "bitrate", "scale": 1},
+        "keyframe": {"property": "key-int-max", "infinite": 2147483647},
+    },
+    "vp8enc": {
+        "plugin": "vpx",
+        "codec": "vp8",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "vpenc",
+        "factories": [{"name": "vp8enc"}],
+        "properties": {
+            "threads": {"threads": 16},
+            "cpu-used": -16,
+            "deadline": 1,
+            "end-usage": "cbr",
+            "error-resilient": "default",
+            "keyframe-mode": "disabled",
+            "lag-in-frames": 0,
+            "max-intra-bitrate": 250,
+            "multipass-mode": "first-pass",
+            "overshoot": 10,
+            "undershoot": 25,
+            "static-threshold": 0,
+            "tuning": "psnr",
+        },
+        "bitrate": {"property": "target-bitrate", "scale": 1000},
+        "keyframe": {"property": "keyframe-max-dist", "infinite": 2147483647},
+        "vbv": {"properties": ["buffer-initial-size", "buffer-optimal-size", "buffer-size"], "unit": "ms", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "vp9enc": {
+        "plugin": "vpx",
+        "codec": "vp9",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "vpenc",
+        "factories": [{"name": "vp9enc"}],
+        "properties": {
+            "frame-parallel-decoding": True,
+            "row-mt": True,
+            "threads": {"threads": 16},
+            "cpu-used": -16,
+            "deadline": 1,
+            "end-usage": "cbr",
+            "error-resilient": "default",
+            "keyframe-mode": "disabled",
+            "lag-in-frames": 0,
+            "max-intra-bitrate": 250,
+            "multipass-mode": "first-pass",
+            "overshoot": 10,
+            "undershoot": 25,
+            "static-threshold": 0,
+            "tuning": "psnr",
+        },
+        "bitrate": {"property": "target-bitrate", "scale": 1000},
+        "keyframe": {"property": "keyframe-max-dist", "infinite": 2147483647},
+        "vbv": {"properties": ["buffer-initial-size", "buffer-optimal-size", "buffer-size"], "unit": "ms", "multiplier": 1.5, "periodic_multiplier": 3},
+    },
+    "svtav1enc": {
+        "plugin": "svtav1",
+        "codec": "av1",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "svtav1enc",
+        "factories": [{"name": "svtav1enc"}],
+        "properties": {
+            "preset": 10,
+            "logical-processors": {"threads": 24},
+            "parameters-string": "rc=2:fast-decode=1:buf-initial-sz=100:buf-optimal-sz=120:maxsection-pct=250:lookahead=0:pred-struct=1",
+        },
+        "bitrate": {"property": "target-bitrate", "scale": 1},
+        "keyframe": {"property": "intra-period-length", "infinite": -1},
+    },
+    "av1enc": {
+        "plugin": "aom",
+        "codec": "av1",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "av1enc",
+        "factories": [{"name": "av1enc"}],
+        "properties": {
+            "cpu-used": 10,
+            "end-usage": "cbr",
+            "lag-in-frames": 0,
+            "overshoot-pct": 10,
+            "row-mt": True,
+            "usage-profile": "realtime",
+            "tile-columns": 2,
+            "tile-rows": 2,
+            "threads": {"threads": 24},
+        },
+        "bitrate": {"property": "target-bitrate", "scale": 1},
+        "keyframe": {"property": "keyframe-max-dist", "infinite": 2147483647},
+    },
+    "rav1enc": {
+        "plugin": "rav1e",
+        "codec": "av1",
+        "converter": {"type": "videoconvert", "format": "I420", "threads": 4},
+        "name": "rav1enc",
+        "factories": [{"name": "rav1enc"}],
+        "properties": {
+            "low-latency": True,
+            "rdo-lookahead-frames": 0,
+            "reservoir-frame-delay": 12,
+            "speed-preset": 10,
+            "tiles": 16,
+            "threads": {"threads": 24},
+        },
+        "bitrate": {"property": "bitrate", "scale": 1000},
+        "keyframe": {"property": "max-key-frame-interval", "infinite": 715827882},
+    },
+}
+
+
+def merge_profile(base, override):
+    """Recursively merges an encoder profile override into a copy of the base profile
+
+    Arguments:
+        base {dict} -- built-in profile
+        override {dict} -- profile values to change
+    Returns:
+        dict -- merged profile
+    """
+
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_profile(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def load_encoder_profiles(profiles_file=None):
+    """Loads the encoder profile registry, applying overrides from a JSON file if it exists
+
+    Arguments:
+        profiles_file {string} -- optional path to a JSON object mapping encoder names to profile overrides
+    Returns:
+        dict -- encoder name to profile
+    """
+
+    profiles = copy.deepcopy(DEFAULT_ENCODER_PROFILES)
+    if not profiles_file:
+        return profiles
+    if not os.path.exists(profiles_file):
+        logger.debug("encoder profiles file not found, using built-in profiles: %s" % profiles_file)
+        return profiles
+
+    try:
+        with open(profiles_file, 'r') as f:
+            overrides = json.load(f)
+    except Exception as e:
+        logger.error("failed to read encoder profiles file %s, using built-in profiles: %s" % (profiles_file, e))
+        return profiles
+
+    for encoder, override in overrides.items():
+        if encoder in profiles:
+            profiles[encoder] = merge_profile(profiles[encoder], override)
+        else:
+            missing = [key for key in ["plugin", "codec", "converter", "name", "factories", "bitrate"] if key not in override]
+            if missing:
+                logger.error("skipping encoder profile {}, missing keys: {}".format(encoder, ", ".join(missing)))
+                continue
+            profiles[encoder] = copy.deepcopy(override)
+        logger.info("loaded encoder profile override for: %s" % encoder)
+    return profiles
+
+
+def gst_minor_matches(gst_minor, version_range):
+    """Checks a GStreamer 1.x minor version against an inclusive [min, max] range
+
+    Arguments:
+        gst_minor {integer} -- GStreamer minor version
+        version_range {list} -- [min, max], either bound may be None
+    Returns:
+        bool -- True if the version is in range
+    """
+
+    if not version_range:
+        return True
+    min_minor, max_minor = version_range
+    return (min_minor is None or gst_minor >= min_minor) and (max_minor is None or gst_minor <= max_minor)
+
+
+def resolve_threads(value):
+    """Replaces a {"threads": n} property value with the number of available CPUs minus one, clamped to [1, n]
+
+    Arguments:
+        value {object} -- property value from a profile
+    Returns:
+        object -- value to set on the element
+    """
+
+    if isinstance(value, dict) and "threads" in value:
+        return min(int(value["threads"]), max(1, len(os.sched_getaffinity(0)) - 1))
+    return value
+
+
+def vbv_buffer_size(profile, bitrate, framerate, periodic_keyframes):
+    """Computes the VBV/HRD buffer size of a profile
+
+    Arguments:
+        profile {dict} -- encoder profile
+        bitrate {integer} -- encoder target bitrate in kbps
+        framerate {integer} -- framerate in frames per second
+        periodic_keyframes {bool} -- True if keyframes/GOP are periodic
+    Returns:
+        integer -- buffer size in the unit of the profile, or None if the profile has no VBV properties
+    """
+
+    vbv = profile.get("vbv")
+    if not vbv:
+        return None
+    multiplier = vbv.get("periodic_multiplier", vbv["multiplier"]) if periodic_keyframes else vbv["multiplier"]
+    # Size the buffer to the frame time, either in bits of the bitrate (kbit) or in milliseconds (ms)
+    numerator = bitrate if vbv.get("unit", "kbit") == "kbit" else 1000
+    return int((numerator + framerate - 1) // framerate * multiplier)
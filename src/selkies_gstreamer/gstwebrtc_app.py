@@ -21,12 +21,21 @@
 
 import asyncio
 import base64
+import collections
+import io
+import itertools
 import json
 import logging
 import os
 import re
+import struct
 import sys
+import threading
 import time
+import zlib
+
+from encoder_profiles import load_encoder_profiles, gst_minor_matches, resolve_threads, vbv_buffer_size
+from bulk_transfer import TRANSFER_KIND_CLIPBOARD_TEXT, TRANSFER_KIND_FILE, transfer_messages, abort_message
 
 logger = logging.getLogger("gstwebrtc_app")
 logger.setLevel(logging.INFO)
@@ -61,11 +70,46 @@ Replace "x86_64-linux-gnu" in other architectures manually or use "$(gcc -print-
     sys.exit(1)
 logger.info("GStreamer-Python install looks OK")
 
+# Binary server messages, sent instead of JSON once the client accepted the binary protocol.
+# Every message is a one byte opcode followed by a fixed little-endian layout and an optional payload.
+DATA_OP_CURSOR = 0x81
+DATA_OP_CLIPBOARD = 0x82
+DATA_OP_SYSTEM_STATS = 0x83
+DATA_OP_GPU_STATS = 0x84
+DATA_OP_CURSOR_PRELOAD = 0x85
+
+# Buffered bytes of the transfer data channel above which sending waits until it drained to the low threshold
+TRANSFER_BUFFER_HIGH = 1024 * 1024
+TRANSFER_BUFFER_LOW = 256 * 1024
+
+# Number of serialized cursor messages kept for resending known cursors
+CURSOR_MESSAGE_CACHE_SIZE = 64
+
+# Captured frames are compared on every n-th row, starting at the next row each frame,
+# so a change anywhere on the screen is detected within this many frames
+CAPTURE_HASH_ROW_STEP = 8
+
+# opcode, handle, hotspot x, hotspot y, hidden cursor, followed by the PNG image
+DATA_CURSOR_STRUCT = struct.Struct("<BIhhB")
+# opcode, followed by DATA_CURSOR_PRELOAD_ENTRY_STRUCT and the PNG image of each cursor
+DATA_CURSOR_PRELOAD_STRUCT = struct.Struct("<B")
+# handle, PNG image length
+DATA_CURSOR_PRELOAD_ENTRY_STRUCT = struct.Struct("<II")
+# Size preload batches are split at, within the default SCTP message size limit of webrtcbin
+DATA_CURSOR_PRELOAD_MAX_SIZE = 60 * 1024
+# opcode, followed by the UTF-8 text
+DATA_CLIPBOARD_STRUCT = struct.Struct("<B")
+# opcode, cpu percent, memory total, memory used
+DATA_SYSTEM_STATS_STRUCT = struct.Struct("<BdQQ")
+# opcode, load, memory total, memory used
+DATA_GPU_STATS_STRUCT = struct.Struct("<Bddd")
+
+
 class GSTWebRTCAppError(Exception):
     pass
 
 class GSTWebRTCApp:
-    def __init__(self, async_event_loop, stun_servers=None, turn_servers=None, audio_channels=2, framerate=30, encoder=None, gpu_id=0, video_bitrate=2000, audio_bitrate=96000, keyframe_distance=-1.0, congestion_control=False, video_packetloss_percent=0.0, audio_packetloss_percent=0.0):
+    def __init__(self, async_event_loop, stun_servers=None, turn_servers=None, audio_channels=2, framerate=30, encoder=None, gpu_id=0, video_bitrate=2000, audio_bitrate=96000, keyframe_distance=-1.0, congestion_control=False, video_packetloss_percent=0.0, audio_packetloss_percent=0.0, fanout=False, source_app=None, encoder_profiles=None, keep_alive=False, keep_alive_timeout_s=0, latency_tracing=False, video_queue_max_time_ms=0, video_max_latency_ms=0, capture_idle_timeout_ms=0, capture_keepalive_ms=1000, video_resize_scaling=False, video_coded_size=None):
         """Initialize GStreamer WebRTC app.
 
         Initializes GObjects and checks for required plugins.
@@ -75,6 +119,18 @@ class GSTWebRTCApp:
                                     stun:<host>:<port>
             turn_servers {[list of strings]} -- Optional TURN server uris in the form of:
                                     turn://<user>:<password>@<host>:<port>
+            fanout {bool} -- Build the capture and encode section once and attach each viewer's webrtcbin to it through a tee.
+            source_app {GSTWebRTCApp} -- Optional app owning the shared capture and encode section this viewer attaches to, implies fanout.
+            encoder_profiles {dict} -- Optional encoder profile registry from load_encoder_profiles(), defaults to the built-in profiles.
+            keep_alive {bool} -- Keep the shared capture and encode section running while no viewer is attached, so reconnecting viewers only replace their webrtcbin.
+            keep_alive_timeout_s {float} -- Stop the kept alive section when no viewer attached within this time after the last one left, 0 keeps it running.
+            latency_tracing {bool} -- Add pad probes reporting the processing time of each pipeline element with on_element_latency.
+            video_queue_max_time_ms {float} -- Maximum time of frames held in the leaky queues between capture, conversion and encoding, 0 links the stages without queues.
+            video_max_latency_ms {float} -- Drop frames older than this budget before encoding, 0 disables the budget.
+            capture_idle_timeout_ms {float} -- Stop encoding captured frames after the screen did not change for this time, 0 encodes every frame.
+            capture_keepalive_ms {float} -- Interval of frames still encoded while the screen is idle, 0 encodes no frames until the screen changes.
+            video_resize_scaling {bool} -- Scale captured frames to a fixed coded size, so display resizes only restart the capture and never renegotiate the encoder.
+            video_coded_size {tuple} -- Optional (width, height) of the encoded video when scaling, defaults to the display size when the pipeline is built.
         """
 
         self.async_event_loop = async_event_loop
@@ -84,11 +140,74 @@ class GSTWebRTCApp:
         self.pipeline = None
         self.webrtcbin = None
         self.data_channel = None
+        self.motion_data_channel = None
+        self.transfer_data_channel = None
+        # Set when the transfer data channel drained below TRANSFER_BUFFER_LOW
+        self.transfer_buffer_low = asyncio.Event()
+        self.transfer_ids = itertools.count(2, 2)
+        self.outgoing_transfers = set()
         self.rtpgccbwe = None
         self.congestion_control = congestion_control
         self.encoder = encoder
+        self.encoder_profiles = encoder_profiles if encoder_profiles is not None else load_encoder_profiles()
+        self.encoder_profile = self.encoder_profiles.get(self.encoder)
+
+        # Shared capture and encode section for multiple viewers,
+        # the app owning the section is its own source app.
+        self.source_app = source_app if source_app is not None else (self if fanout else None)
+        self.shared_pipeline = None
+        # Task switching a reset section to NULL, off the event loop
+        self.shared_pipeline_teardown = None
+        self.fanout_tee = None
+        self.fanout_viewers = set()
+        self.fanout_queue = None
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout_s = keep_alive_timeout_s
+        self.keep_alive_stop_handle = None
+        self.latency_tracing = latency_tracing
+        self.video_queue_max_time_ms = video_queue_max_time_ms
+        self.video_max_latency_ms = video_max_latency_ms
+
+        # Idle capture, screen changes come from notify_damage() when capture_damage_events
+        # is set and are otherwise detected by comparing the captured frames. Frames are
+        # also compared while the pointer is drawn, DAMAGE does not report pointer motion.
+        self.capture_idle_timeout_ms = capture_idle_timeout_ms
+        self.capture_keepalive_ms = capture_keepalive_ms
+        self.capture_damage_events = False
+        self.capture_damage_time = 0
+        # Hash of the sampled rows by starting row
+        self.capture_frame_hashes = [None] * CAPTURE_HASH_ROW_STEP
+        self.capture_hash_phase = 0
+        self.capture_idle = False
+        self.capture_last_frame_time = 0
+        self.capture_last_push_time = 0
+        self.video_encoder = None
+
+        # Resizing, frames are scaled to video_scale_size before encoding when resize scaling is enabled
+        self.video_resize_scaling = video_resize_scaling
+        self.video_coded_size = video_coded_size
+        self.video_scale_size = None
+        self.display_size = None
+        # State of the last resize until its first encoded frame, None when no resize is pending
+        self.pending_resize_frame = None
+
+        # Set when the shared section must be rebuilt before the next viewer attaches
+        self.shared_pipeline_stale = False
         self.gpu_id = gpu_id
 
+        # Outgoing SDP and ICE messages posted from GStreamer threads
+        self.signalling_messages = []
+        self.signalling_messages_lock = threading.Lock()
+        self.signalling_flush_pending = False
+        self.signalling_send_lock = asyncio.Lock()
+
+        # Bus message dispatch, pipeline_started is set once the pipeline is PLAYING
+        self.pipeline_started = asyncio.Event()
+        self.bus_watch = None
+        # Time each pending bus message was posted, by message seqnum
+        self.bus_post_times = {}
+        self.handling_bus_calls = False
+
         self.framerate = framerate
         self.video_bitrate = video_bitrate
         self.audio_bitrate = audio_bitrate
@@ -98,11 +217,6 @@ class GSTWebRTCApp:
         # Enforce minimum keyframe interval to 60 frames
         self.min_keyframe_frame_distance = 60
         self.keyframe_frame_distance = -1 if self.keyframe_distance == -1.0 else max(self.min_keyframe_frame_distance, int(self.framerate * self.keyframe_distance))
-        # Set VBV/HRD buffer multiplier to frame time, set 1.5x when optimal (no keyframes/GOP) to prevent quality degradation in encoders, relax 2x when keyframe/GOP is periodic
-        self.vbv_multiplier_nv = 1.5 if self.keyframe_distance == -1.0 else 3
-        self.vbv_multiplier_va = 1.5 if self.keyframe_distance == -1.0 else 3
-        self.vbv_multiplier_vp = 1.5 if self.keyframe_distance == -1.0 else 3
-        self.vbv_multiplier_sw = 1.5 if self.keyframe_distance == -1.0 else 3
         # Packet loss base percentage
         self.video_packetloss_percent = video_packetloss_percent
         self.audio_packetloss_percent = audio_packetloss_percent
@@ -122,6 +236,30 @@ class GSTWebRTCApp:
         self.on_data_error = lambda: logger.warning('unhandled on_data_error')
         self.on_data_message = lambda msg: logger.warning(
             'unhandled on_data_message')
+        self.on_data_binary_message = lambda data, receive_time: logger.warning(
+            'unhandled on_data_binary_message')
+        self.on_transfer_message = lambda data: logger.warning(
+            'unhandled on_transfer_message')
+        self.on_transfer_close = lambda: logger.warning(
+            'unhandled on_transfer_close')
+
+        # Bus message dispatch delay in milliseconds, fired for every message so metrics are optional
+        self.on_bus_dispatch_delay = lambda delay_ms: None
+
+        # Element processing time in milliseconds, fired from streaming threads when latency tracing is enabled
+        self.on_element_latency = lambda pipeline_name, stage, latency_ms: None
+
+        # Video frames dropped by the leaky queues or the latency budget, fired from streaming threads
+        self.on_frames_dropped = lambda stage: None
+
+        # Every captured frame when idle capture is enabled, with the seconds since the previous frame, fired from the capture thread
+        self.on_capture_frame = lambda idle, skipped, interval: None
+
+        # Time in milliseconds from a display resize to the first encoded frame at the new size, fired from the encoder thread
+        self.on_resize_first_frame = lambda latency_ms: None
+
+        # Size of the encoded video and of the display when either changed, video_size is None when frames are not scaled
+        self.on_video_size = lambda video_size, display_size: None
 
         Gst.init(None)
 
@@ -130,6 +268,16 @@ class GSTWebRTCApp:
         self.ximagesrc = None
         self.ximagesrc_caps = None
         self.last_cursor_sent = None
+        # Map of (cursor handle, binary) to the serialized cursor message, least recently used first
+        self.cursor_messages = collections.OrderedDict()
+        # Handles of the cursor images the client has, their changes are sent without the image
+        self.cursor_handles_sent = set()
+
+        # Send server messages in the binary protocol, set when the client accepted it
+        self.binary_messages = False
+        # Last stats sent to the client, unchanged stats are not sent again
+        self.last_system_stats = None
+        self.last_gpu_stats = None
 
     def stop_ximagesrc(self):
         """Helper function to stop the ximagesrc, useful when resizing
@@ -155,8 +303,9 @@ class GSTWebRTCApp:
         # Reference configuration for webrtcbin including congestion control:
         #   https://gitlab.freedesktop.org/gstreamer/gst-plugins-rs/-/blob/main/net/webrtc/src/webrtcsink/imp.rs
 
-        # Create webrtcbin element named app
-        self.webrtcbin = Gst.ElementFactory.make("webrtcbin", "app")
+        # Create webrtcbin element named app, viewers sharing a pipeline
+        # need unique element names so GStreamer generates them instead.
+        self.webrtcbin = Gst.ElementFactory.make("webrtcbin", None if self.source_app is not None else "app")
 
         # The bundle policy affects how the SDP is generated.
         # This will ultimately determine how many tracks the browser receives.
@@ -169,7 +318,8 @@ class GSTWebRTCApp:
         self.webrtcbin.set_property("latency", 0)
 
         # Connect signal handlers
-        if self.congestion_control and not audio_only:
+        # With a shared encoder, only the viewer owning it drives congestion control
+        if self.congestion_control and not audio_only and self.source_app in (None, self):
             self.webrtcbin.connect(
                 'request-aux-sender', lambda webrtcbin, dtls_transport: self.__request_aux_sender_gcc(webrtcbin, dtls_transport))
         self.webrtcbin.connect(
@@ -254,538 +404,20 @@ class GSTWebRTCApp:
         self.ximagesrc_capsfilter = Gst.ElementFactory.make("capsfilter")
         self.ximagesrc_capsfilter.set_property("caps", self.ximagesrc_caps)
 
-        # ADD_ENCODER: Add new encoder to this list and modify all locations with "ADD_ENCODER:"
-        # Reference configuration for fixing when something is broken in web browsers:
-        #   https://gitlab.freedesktop.org/gstreamer/gst-plugins-rs/-/blob/main/net/webrtc/src/webrtcsink/imp.rs
-        if self.encoder in ["nvh264enc"]:
-            # Upload buffers from ximagesrc directly to CUDA memory where
-            # the colorspace conversion will be performed.
-            cudaupload = Gst.ElementFactory.make("cudaupload")
-            if self.gpu_id >= 0:
-                cudaupload.set_property("cuda-device-id", self.gpu_id)
-
-            # Convert the colorspace from BGRx to NVENC compatible format.
-            # This is performed with CUDA which reduces the overall CPU load
-            # compared to using the software videoconvert element.
-            cudaconvert = Gst.ElementFactory.make("cudaconvert")
-            if self.gpu_id >= 0:
-                cudaconvert.set_property("cuda-device-id", self.gpu_id)
-
-            # Instructs cudaconvert to handle Quality of Service (QOS) events
-            # from the rest of the pipeline. Setting this value increases
-            # encoder stability.
-            cudaconvert.set_property("qos", True)
-
-            # Convert ximagesrc BGRx format to NV12 using cudaconvert.
-            # This is a more compatible format for client-side software decoders.
-            cudaconvert_caps = Gst.caps_from_string("video/x-raw(memory:CUDAMemory)")
-            cudaconvert_caps.set_value("format", "NV12")
-            cudaconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            cudaconvert_capsfilter.set_property("caps", cudaconvert_caps)
-
-            # Create the nvh264enc element named nvenc.
-            # This is the heart of the video pipeline that converts the raw
-            # frame buffers to an H.264 encoded byte-stream on the GPU.
-            if self.gpu_id > 0:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvh264enc = Gst.ElementFactory.make("nvcudah264device{}enc".format(self.gpu_id), "nvenc")
-                else:
-                    nvh264enc = Gst.ElementFactory.make("nvh264device{}enc".format(self.gpu_id), "nvenc")
-            else:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvh264enc = Gst.ElementFactory.make("nvcudah264enc", "nvenc")
-                else:
-                    nvh264enc = Gst.ElementFactory.make("nvh264enc", "nvenc")
-
-            # The initial bitrate of the encoder in bits per second.
-            # Setting this to 0 will use the bitrate from the NVENC preset.
-            # This parameter can be set while the pipeline is running using the
-            # set_video_bitrate() method. This helps to match the available
-            # bandwidth. If set too high, the cliend side jitter buffer will
-            # not be unable to lock on to the stream and it will fail to render.
-            nvh264enc.set_property("bitrate", self.fec_video_bitrate)
-
-            # Rate control mode tells the encoder how to compress the frames to
-            # reach the target bitrate. A Constant Bit Rate (CBR) setting is best
-            # for streaming use cases as bitrate is the most important factor.
-            # A Variable Bit Rate (VBR) setting tells the encoder to adjust the
-            # compression level based on scene complexity, something not needed
-            # when streaming in real-time.
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                nvh264enc.set_property("rate-control", "cbr")
-            else:
-                nvh264enc.set_property("rc-mode", "cbr")
-
-            # Group of Pictures (GOP) size is the distance between I-Frames that
-            # contain the full frame data needed to render a whole frame.
-            # A negative consequence when using infinite GOP size is that
-            # when packets are lost, the decoder may never recover.
-            # NVENC supports infinite GOP by setting this to -1.
-            nvh264enc.set_property("gop-size", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            # Minimize GOP-to-GOP rate fluctuations
-            nvh264enc.set_property("strict-gop", True)
-
-            # The NVENC encoder supports a limited number of encoding presets.
-            # These presets are different than the open x264 standard.
-            # The presets control the picture coding technique, bitrate,
-            # and encoding quality.
-            #
-            # See this link for details on NVENC parameters recommended for
-            # low-latency streaming (also a setting reference for other encoders):
-            #   https://docs.nvidia.com/video-technologies/video-codec-sdk/12.2/nvenc-video-encoder-api-prog-guide/index.html#recommended-nvenc-settings
-            #
-            # See this link for details on each preset:
-            #   https://docs.nvidia.com/video-technologies/video-codec-sdk/12.2/nvenc-preset-migration-guide/index.html
-            nvh264enc.set_property("aud", False)
-            # Do not automatically add b-frames
-            nvh264enc.set_property("b-adapt", False)
-            # Disable lookahead
-            nvh264enc.set_property("rc-lookahead", 0)
-            # Set VBV/HRD buffer size (kbits) to optimize for live streaming
-            nvh264enc.set_property("vbv-buffer-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_nv))
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                nvh264enc.set_property("b-frames", 0)
-                # Zero-latency operation mode (no reordering delay)
-                nvh264enc.set_property("zero-reorder-delay", True)
-            else:
-                nvh264enc.set_property("bframes", 0)
-                # Zero-latency operation mode (no reordering delay)
-                nvh264enc.set_property("zerolatency", True)
-            if Gst.version().major == 1 and Gst.version().minor > 20:
-                # CABAC is more bandwidth-efficient compared to CAVLC at a tradeoff of slight increase (<= 1 ms) in decoding time
-                nvh264enc.set_property("cabac", True)
-                # Insert sequence headers (SPS/PPS) per IDR
-                nvh264enc.set_property("repeat-sequence-header", True)
-            if Gst.version().major == 1 and Gst.version().minor > 22:
-                nvh264enc.set_property("preset", "p4")
-                nvh264enc.set_property("tune", "ultra-low-latency")
-                # Two-pass mode allows to detect more motion vectors,
-                # better distribute bitrate across the frame
-                # and more strictly adhere to bitrate limits.
-                nvh264enc.set_property("multi-pass", "two-pass-quarter")
-            else:
-                nvh264enc.set_property("preset", "low-latency-hq")
-
-        elif self.encoder in ["nvh265enc"]:
-            cudaupload = Gst.ElementFactory.make("cudaupload")
-            if self.gpu_id >= 0:
-                cudaupload.set_property("cuda-device-id", self.gpu_id)
-            cudaconvert = Gst.ElementFactory.make("cudaconvert")
-            if self.gpu_id >= 0:
-                cudaconvert.set_property("cuda-device-id", self.gpu_id)
-            cudaconvert.set_property("qos", True)
-            cudaconvert_caps = Gst.caps_from_string("video/x-raw(memory:CUDAMemory)")
-            cudaconvert_caps.set_value("format", "NV12")
-            cudaconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            cudaconvert_capsfilter.set_property("caps", cudaconvert_caps)
-
-            if self.gpu_id > 0:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvh265enc = Gst.ElementFactory.make("nvcudah265device{}enc".format(self.gpu_id), "nvenc")
-                else:
-                    nvh265enc = Gst.ElementFactory.make("nvh265device{}enc".format(self.gpu_id), "nvenc")
-            else:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvh265enc = Gst.ElementFactory.make("nvcudah265enc", "nvenc")
-                else:
-                    nvh265enc = Gst.ElementFactory.make("nvh265enc", "nvenc")
-
-            nvh265enc.set_property("bitrate", self.fec_video_bitrate)
-
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                nvh265enc.set_property("rate-control", "cbr")
-            else:
-                nvh265enc.set_property("rc-mode", "cbr")
-
-            nvh265enc.set_property("gop-size", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            nvh265enc.set_property("strict-gop", True)
-            nvh265enc.set_property("aud", False)
-            # B-frames in H.265 are only provided with newer GPUs
-            nvenc_properties = [nvenc_property.name for nvenc_property in nvh265enc.list_properties()]
-            if "b-adapt" in nvenc_properties:
-                nvh265enc.set_property("b-adapt", False)
-            nvh265enc.set_property("rc-lookahead", 0)
-            nvh265enc.set_property("vbv-buffer-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_nv))
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                if "b-frames" in nvenc_properties:
-                    nvh265enc.set_property("b-frames", 0)
-                nvh265enc.set_property("zero-reorder-delay", True)
-            else:
-                if "bframes" in nvenc_properties:
-                    nvh265enc.set_property("bframes", 0)
-                nvh265enc.set_property("zerolatency", True)
-            if Gst.version().major == 1 and Gst.version().minor > 20:
-                nvh265enc.set_property("repeat-sequence-header", True)
-            if Gst.version().major == 1 and Gst.version().minor > 22:
-                nvh265enc.set_property("preset", "p4")
-                nvh265enc.set_property("tune", "ultra-low-latency")
-                nvh265enc.set_property("multi-pass", "two-pass-quarter")
-            else:
-                nvh265enc.set_property("preset", "low-latency-hq")
-
-        elif self.encoder in ["nvav1enc"]:
-            cudaupload = Gst.ElementFactory.make("cudaupload")
-            if self.gpu_id >= 0:
-                cudaupload.set_property("cuda-device-id", self.gpu_id)
-            cudaconvert = Gst.ElementFactory.make("cudaconvert")
-            if self.gpu_id >= 0:
-                cudaconvert.set_property("cuda-device-id", self.gpu_id)
-            cudaconvert.set_property("qos", True)
-            cudaconvert_caps = Gst.caps_from_string("video/x-raw(memory:CUDAMemory)")
-            cudaconvert_caps.set_value("format", "NV12")
-            cudaconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            cudaconvert_capsfilter.set_property("caps", cudaconvert_caps)
-
-            if self.gpu_id > 0:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvav1enc = Gst.ElementFactory.make("nvcudaav1device{}enc".format(self.gpu_id), "nvenc")
-                else:
-                    nvav1enc = Gst.ElementFactory.make("nvav1device{}enc".format(self.gpu_id), "nvenc")
-            else:
-                if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                    nvav1enc = Gst.ElementFactory.make("nvcudaav1enc", "nvenc")
-                else:
-                    nvav1enc = Gst.ElementFactory.make("nvav1enc", "nvenc")
-
-            nvav1enc.set_property("bitrate", self.fec_video_bitrate)
-
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                nvav1enc.set_property("rate-control", "cbr")
-            else:
-                nvav1enc.set_property("rc-mode", "cbr")
-
-            nvav1enc.set_property("gop-size", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            nvav1enc.set_property("strict-gop", True)
-            nvav1enc.set_property("b-adapt", False)
-            nvav1enc.set_property("rc-lookahead", 0)
-            nvav1enc.set_property("vbv-buffer-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_nv))
-            if Gst.version().major == 1 and 20 < Gst.version().minor <= 24:
-                nvav1enc.set_property("b-frames", 0)
-                nvav1enc.set_property("zero-reorder-delay", True)
-            else:
-                nvav1enc.set_property("bframes", 0)
-                nvav1enc.set_property("zerolatency", True)
-            if Gst.version().major == 1 and Gst.version().minor > 22:
-                nvav1enc.set_property("preset", "p4")
-                nvav1enc.set_property("tune", "ultra-low-latency")
-                nvav1enc.set_property("multi-pass", "two-pass-quarter")
-            else:
-                nvav1enc.set_property("preset", "low-latency-hq")
-
-        elif self.encoder in ["vah264enc"]:
-            # colorspace conversion
-            if self.gpu_id > 0:
-                vapostproc = Gst.ElementFactory.make("varenderD{}postproc".format(128 + self.gpu_id), "vapostproc")
-            else:
-                vapostproc = Gst.ElementFactory.make("vapostproc")
-            vapostproc.set_property("scale-method", "fast")
-            vapostproc.set_property("qos", True)
-            vapostproc_caps = Gst.caps_from_string("video/x-raw(memory:VAMemory)")
-            vapostproc_caps.set_value("format", "NV12")
-            vapostproc_capsfilter = Gst.ElementFactory.make("capsfilter")
-            vapostproc_capsfilter.set_property("caps", vapostproc_caps)
-
-            # encoder
-            if self.gpu_id > 0:
-                vah264enc = Gst.ElementFactory.make("varenderD{}h264enc".format(128 + self.gpu_id), "vaenc")
-                if vah264enc is None:
-                    vah264enc = Gst.ElementFactory.make("varenderD{}h264lpenc".format(128 + self.gpu_id), "vaenc")
-            else:
-                vah264enc = Gst.ElementFactory.make("vah264enc", "vaenc")
-                if vah264enc is None:
-                    vah264enc = Gst.ElementFactory.make("vah264lpenc", "vaenc")
-            vah264enc.set_property("aud", False)
-            vah264enc.set_property("b-frames", 0)
-            # Set VBV/HRD buffer size (kbits) to optimize for live streaming
-            vah264enc.set_property("cpb-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-            vah264enc.set_property("dct8x8", False)
-            vah264enc.set_property("key-int-max", 1024 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            vah264enc.set_property("mbbrc", "disabled")
-            vah264enc.set_property("num-slices", 4)
-            vah264enc.set_property("ref-frames", 1)
-            vah264enc.set_property("rate-control", "cbr")
-            vah264enc.set_property("target-usage", 6)
-            vah264enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["vah265enc"]:
-            # colorspace conversion
-            if self.gpu_id > 0:
-                vapostproc = Gst.ElementFactory.make("varenderD{}postproc".format(128 + self.gpu_id), "vapostproc")
-            else:
-                vapostproc = Gst.ElementFactory.make("vapostproc")
-            vapostproc.set_property("scale-method", "fast")
-            vapostproc.set_property("qos", True)
-            vapostproc_caps = Gst.caps_from_string("video/x-raw(memory:VAMemory)")
-            vapostproc_caps.set_value("format", "NV12")
-            vapostproc_capsfilter = Gst.ElementFactory.make("capsfilter")
-            vapostproc_capsfilter.set_property("caps", vapostproc_caps)
-
-            # encoder
-            if self.gpu_id > 0:
-                vah265enc = Gst.ElementFactory.make("varenderD{}h265enc".format(128 + self.gpu_id), "vaenc")
-                if vah265enc is None:
-                    vah265enc = Gst.ElementFactory.make("varenderD{}h265lpenc".format(128 + self.gpu_id), "vaenc")
-            else:
-                vah265enc = Gst.ElementFactory.make("vah265enc", "vaenc")
-                if vah265enc is None:
-                    vah265enc = Gst.ElementFactory.make("vah265lpenc", "vaenc")
-            vah265enc.set_property("aud", False)
-            vah265enc.set_property("b-frames", 0)
-            # Set VBV/HRD buffer size (kbits) to optimize for live streaming
-            vah265enc.set_property("cpb-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-            vah265enc.set_property("key-int-max", 1024 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            vah265enc.set_property("mbbrc", "disabled")
-            vah265enc.set_property("num-slices", 4)
-            vah265enc.set_property("ref-frames", 1)
-            vah265enc.set_property("rate-control", "cbr")
-            vah265enc.set_property("target-usage", 6)
-            vah265enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["vavp9enc"]:
-            # colorspace conversion
-            if self.gpu_id > 0:
-                vapostproc = Gst.ElementFactory.make("varenderD{}postproc".format(128 + self.gpu_id), "vapostproc")
-            else:
-                vapostproc = Gst.ElementFactory.make("vapostproc")
-            vapostproc.set_property("scale-method", "fast")
-            vapostproc.set_property("qos", True)
-            vapostproc_caps = Gst.caps_from_string("video/x-raw(memory:VAMemory)")
-            vapostproc_caps.set_value("format", "NV12")
-            vapostproc_capsfilter = Gst.ElementFactory.make("capsfilter")
-            vapostproc_capsfilter.set_property("caps", vapostproc_caps)
-
-            # encoder
-            if self.gpu_id > 0:
-                vavp9enc = Gst.ElementFactory.make("varenderD{}vp9enc".format(128 + self.gpu_id), "vaenc")
-                if vavp9enc is None:
-                    vavp9enc = Gst.ElementFactory.make("varenderD{}vp9lpenc".format(128 + self.gpu_id), "vaenc")
-            else:
-                vavp9enc = Gst.ElementFactory.make("vavp9enc", "vaenc")
-                if vavp9enc is None:
-                    vavp9enc = Gst.ElementFactory.make("vavp9lpenc", "vaenc")
-            # Set VBV/HRD buffer size (kbits) to optimize for live streaming
-            vavp9enc.set_property("cpb-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-            vavp9enc.set_property("hierarchical-level", 1)
-            vavp9enc.set_property("key-int-max", 1024 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            vavp9enc.set_property("mbbrc", "disabled")
-            vavp9enc.set_property("ref-frames", 1)
-            vavp9enc.set_property("rate-control", "cbr")
-            vavp9enc.set_property("target-usage", 6)
-            vavp9enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["vaav1enc"]:
-            # colorspace conversion
-            if self.gpu_id > 0:
-                vapostproc = Gst.ElementFactory.make("varenderD{}postproc".format(128 + self.gpu_id), "vapostproc")
-            else:
-                vapostproc = Gst.ElementFactory.make("vapostproc")
-            vapostproc.set_property("scale-method", "fast")
-            vapostproc.set_property("qos", True)
-            vapostproc_caps = Gst.caps_from_string("video/x-raw(memory:VAMemory)")
-            vapostproc_caps.set_value("format", "NV12")
-            vapostproc_capsfilter = Gst.ElementFactory.make("capsfilter")
-            vapostproc_capsfilter.set_property("caps", vapostproc_caps)
-
-            # encoder
-            if self.gpu_id > 0:
-                vaav1enc = Gst.ElementFactory.make("varenderD{}av1enc".format(128 + self.gpu_id), "vaenc")
-                if vaav1enc is None:
-                    vaav1enc = Gst.ElementFactory.make("varenderD{}av1lpenc".format(128 + self.gpu_id), "vaenc")
+        # Build the colorspace conversion stage and the encoder from the encoder profile,
+        # see encoder_profiles.py to add new encoders or tune their properties.
+        self.video_scale_size = None
+        if self.video_resize_scaling:
+            self.video_scale_size = self.video_coded_size or self.display_size
+            if self.video_scale_size is None:
+                logger.warning("display size is unknown, encoding video at the captured size")
             else:
-                vaav1enc = Gst.ElementFactory.make("vaav1enc", "vaenc")
-                if vaav1enc is None:
-                    vaav1enc = Gst.ElementFactory.make("vaav1lpenc", "vaenc")
-            # Set VBV/HRD buffer size (kbits) to optimize for live streaming
-            vaav1enc.set_property("cpb-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-            vaav1enc.set_property("hierarchical-level", 1)
-            vaav1enc.set_property("key-int-max", 1024 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            vaav1enc.set_property("mbbrc", "disabled")
-            vaav1enc.set_property("ref-frames", 1)
-            vaav1enc.set_property("tile-groups", 16)
-            vaav1enc.set_property("rate-control", "cbr")
-            vaav1enc.set_property("target-usage", 6)
-            vaav1enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["x264enc"]:
-            # Videoconvert for colorspace conversion
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "NV12")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            # encoder
-            x264enc = Gst.ElementFactory.make("x264enc", "x264enc")
-            # Chromium has issues with more than four encoding slices
-            x264enc.set_property("threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            x264enc.set_property("aud", False)
-            x264enc.set_property("b-adapt", False)
-            x264enc.set_property("bframes", 0)
-            x264enc.set_property("dct8x8", False)
-            x264enc.set_property("insert-vui", True)
-            x264enc.set_property("key-int-max", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            x264enc.set_property("mb-tree", False)
-            x264enc.set_property("rc-lookahead", 0)
-            x264enc.set_property("sync-lookahead", 0)
-            # Set VBV/HRD buffer size (milliseconds) to optimize for live streaming
-            x264enc.set_property("vbv-buf-capacity", int((1000 + self.framerate - 1) // self.framerate * self.vbv_multiplier_sw))
-            x264enc.set_property("sliced-threads", True)
-            x264enc.set_property("byte-stream", True)
-            x264enc.set_property("pass", "cbr")
-            x264enc.set_property("speed-preset", "ultrafast")
-            x264enc.set_property("tune", "zerolatency")
-            x264enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["openh264enc"]:
-            # Videoconvert for colorspace conversion
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            # encoder
-            openh264enc = Gst.ElementFactory.make("openh264enc", "openh264enc")
-            openh264enc.set_property("adaptive-quantization", False)
-            openh264enc.set_property("background-detection", False)
-            openh264enc.set_property("enable-frame-skip", False)
-            openh264enc.set_property("scene-change-detection", False)
-            openh264enc.set_property("usage-type", "screen")
-            openh264enc.set_property("complexity", "low")
-            openh264enc.set_property("gop-size", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            openh264enc.set_property("multi-thread", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            openh264enc.set_property("slice-mode", "n-slices")
-            # Chromium has issues with more than four encoding slices
-            openh264enc.set_property("num-slices", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            openh264enc.set_property("rate-control", "bitrate")
-            openh264enc.set_property("bitrate", self.fec_video_bitrate * 1000)
-
-        elif self.encoder in ["x265enc"]:
-            # Videoconvert for colorspace conversion
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            # encoder
-            x265enc = Gst.ElementFactory.make("x265enc", "x265enc")
-            x265enc.set_property("option-string", "b-adapt=0:bframes=0:rc-lookahead=0:repeat-headers:pmode:wpp")
-            x265enc.set_property("key-int-max", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            x265enc.set_property("speed-preset", "ultrafast")
-            x265enc.set_property("tune", "zerolatency")
-            x265enc.set_property("bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["vp8enc", "vp9enc"]:
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            if self.encoder == "vp8enc":
-                vpenc = Gst.ElementFactory.make("vp8enc", "vpenc")
-
-            elif self.encoder == "vp9enc":
-                vpenc = Gst.ElementFactory.make("vp9enc", "vpenc")
-                vpenc.set_property("frame-parallel-decoding", True)
-                vpenc.set_property("row-mt", True)
-
-            # VPX Parameters
-            vpenc.set_property("threads", min(16, max(1, len(os.sched_getaffinity(0)) - 1)))
-            # Set VBV/HRD buffer size (milliseconds) to optimize for live streaming
-            vbv_buffer_size = int((1000 + self.framerate - 1) // self.framerate * self.vbv_multiplier_vp)
-            vpenc.set_property("buffer-initial-size", vbv_buffer_size)
-            vpenc.set_property("buffer-optimal-size", vbv_buffer_size)
-            vpenc.set_property("buffer-size", vbv_buffer_size)
-            vpenc.set_property("cpu-used", -16)
-            vpenc.set_property("deadline", 1)
-            vpenc.set_property("end-usage", "cbr")
-            vpenc.set_property("error-resilient", "default")
-            vpenc.set_property("keyframe-mode", "disabled")
-            vpenc.set_property("keyframe-max-dist", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            vpenc.set_property("lag-in-frames", 0)
-            vpenc.set_property("max-intra-bitrate", 250)
-            vpenc.set_property("multipass-mode", "first-pass")
-            vpenc.set_property("overshoot", 10)
-            vpenc.set_property("undershoot", 25)
-            vpenc.set_property("static-threshold", 0)
-            vpenc.set_property("tuning", "psnr")
-            vpenc.set_property("target-bitrate", self.fec_video_bitrate * 1000)
-
-        elif self.encoder in ["svtav1enc"]:
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            svtav1enc = Gst.ElementFactory.make("svtav1enc", "svtav1enc")
-            svtav1enc.set_property("intra-period-length", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            # svtav1enc.set_property("maximum-buffer-size", 150)
-            svtav1enc.set_property("preset", 10)
-            svtav1enc.set_property("logical-processors", min(24, max(1, len(os.sched_getaffinity(0)) - 1)))
-            svtav1enc.set_property("parameters-string", "rc=2:fast-decode=1:buf-initial-sz=100:buf-optimal-sz=120:maxsection-pct=250:lookahead=0:pred-struct=1")
-            svtav1enc.set_property("target-bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["av1enc"]:
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            av1enc = Gst.ElementFactory.make("av1enc", "av1enc")
-            # av1enc.set_property("buf-initial-sz", 100)
-            # av1enc.set_property("buf-optimal-sz", 120)
-            # av1enc.set_property("buf-sz", 150)
-            av1enc.set_property("cpu-used", 10)
-            av1enc.set_property("end-usage", "cbr")
-            av1enc.set_property("keyframe-max-dist", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            av1enc.set_property("lag-in-frames", 0)
-            av1enc.set_property("overshoot-pct", 10)
-            av1enc.set_property("row-mt", True)
-            av1enc.set_property("usage-profile", "realtime")
-            av1enc.set_property("tile-columns", 2)
-            av1enc.set_property("tile-rows", 2)
-            av1enc.set_property("threads", min(24, max(1, len(os.sched_getaffinity(0)) - 1)))
-            av1enc.set_property("target-bitrate", self.fec_video_bitrate)
-
-        elif self.encoder in ["rav1enc"]:
-            videoconvert = Gst.ElementFactory.make("videoconvert")
-            videoconvert.set_property("n-threads", min(4, max(1, len(os.sched_getaffinity(0)) - 1)))
-            videoconvert.set_property("qos", True)
-            videoconvert_caps = Gst.caps_from_string("video/x-raw")
-            videoconvert_caps.set_value("format", "I420")
-            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
-            videoconvert_capsfilter.set_property("caps", videoconvert_caps)
-
-            rav1enc = Gst.ElementFactory.make("rav1enc", "rav1enc")
-            rav1enc.set_property("low-latency", True)
-            rav1enc.set_property("max-key-frame-interval", 715827882 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            rav1enc.set_property("rdo-lookahead-frames", 0)
-            rav1enc.set_property("reservoir-frame-delay", 12)
-            rav1enc.set_property("speed-preset", 10)
-            rav1enc.set_property("tiles", 16)
-            rav1enc.set_property("threads", min(24, max(1, len(os.sched_getaffinity(0)) - 1)))
-            rav1enc.set_property("bitrate", self.fec_video_bitrate * 1000)
-
-        else:
-            raise GSTWebRTCAppError("Unsupported encoder for pipeline: %s" % self.encoder)
+                logger.info("scaling video to coded size %dx%d" % self.video_scale_size)
+        converter_elements = self.build_video_converter(self.encoder_profile["converter"], self.video_scale_size)
+        encoder = self.build_video_encoder()
+        codec = self.encoder_profile["codec"]
 
-        if "h264" in self.encoder or "x264" in self.encoder:
+        if codec == "h264":
             # Set the capabilities for the H.264 codec.
             h264enc_caps = Gst.caps_from_string("video/x-h264")
 
@@ -805,7 +437,7 @@ class GSTWebRTCApp:
 
             # Create the rtph264pay element to convert buffers into
             # RTP packets that are sent over the connection transport.
-            rtph264pay = Gst.ElementFactory.make("rtph264pay")
+            rtph264pay = Gst.ElementFactory.make("rtph264pay", "rtph264pay")
             rtph264pay.set_property("mtu", 1200)
 
             # Default aggregate mode for WebRTC
@@ -844,15 +476,16 @@ class GSTWebRTCApp:
             # Create a capability filter for the rtph264pay_caps.
             rtph264pay_capsfilter = Gst.ElementFactory.make("capsfilter")
             rtph264pay_capsfilter.set_property("caps", rtph264pay_caps)
+            codec_elements = [h264enc_capsfilter, rtph264pay, rtph264pay_capsfilter]
 
-        elif "h265" in self.encoder or "x265" in self.encoder:
+        elif codec == "h265":
             h265enc_caps = Gst.caps_from_string("video/x-h265")
             h265enc_caps.set_value("profile", "main")
             h265enc_caps.set_value("stream-format", "byte-stream")
             h265enc_capsfilter = Gst.ElementFactory.make("capsfilter")
             h265enc_capsfilter.set_property("caps", h265enc_caps)
 
-            rtph265pay = Gst.ElementFactory.make("rtph265pay")
+            rtph265pay = Gst.ElementFactory.make("rtph265pay", "rtph265pay")
             rtph265pay.set_property("mtu", 1200)
             rtph265pay.set_property("aggregate-mode", "zero-latency")
             rtph265pay.set_property("config-interval", -1)
@@ -869,8 +502,9 @@ class GSTWebRTCApp:
             rtph265pay_caps.set_value("rtcp-fb-x-gstreamer-fir-as-repair", True)
             rtph265pay_capsfilter = Gst.ElementFactory.make("capsfilter")
             rtph265pay_capsfilter.set_property("caps", rtph265pay_caps)
+            codec_elements = [h265enc_capsfilter, rtph265pay, rtph265pay_capsfilter]
 
-        elif "vp8" in self.encoder:
+        elif codec == "vp8":
             vpenc_caps = Gst.caps_from_string("video/x-vp8")
             vpenc_capsfilter = Gst.ElementFactory.make("capsfilter")
             vpenc_capsfilter.set_property("caps", vpenc_caps)
@@ -891,8 +525,9 @@ class GSTWebRTCApp:
             rtpvppay_caps.set_value("rtcp-fb-x-gstreamer-fir-as-repair", True)
             rtpvppay_capsfilter = Gst.ElementFactory.make("capsfilter")
             rtpvppay_capsfilter.set_property("caps", rtpvppay_caps)
+            codec_elements = [vpenc_capsfilter, rtpvppay, rtpvppay_capsfilter]
 
-        elif "vp9" in self.encoder:
+        elif codec == "vp9":
             vpenc_caps = Gst.caps_from_string("video/x-vp9")
             vpenc_capsfilter = Gst.ElementFactory.make("capsfilter")
             vpenc_capsfilter.set_property("caps", vpenc_caps)
@@ -913,15 +548,16 @@ class GSTWebRTCApp:
             rtpvppay_caps.set_value("rtcp-fb-x-gstreamer-fir-as-repair", True)
             rtpvppay_capsfilter = Gst.ElementFactory.make("capsfilter")
             rtpvppay_capsfilter.set_property("caps", rtpvppay_caps)
+            codec_elements = [vpenc_capsfilter, rtpvppay, rtpvppay_capsfilter]
 
-        elif "av1" in self.encoder:
+        elif codec == "av1":
             av1enc_caps = Gst.caps_from_string("video/x-av1")
             av1enc_caps.set_value("parsed", True)
             av1enc_caps.set_value("stream-format", "obu-stream")
             av1enc_capsfilter = Gst.ElementFactory.make("capsfilter")
             av1enc_capsfilter.set_property("caps", av1enc_caps)
 
-            rtpav1pay = Gst.ElementFactory.make("rtpav1pay")
+            rtpav1pay = Gst.ElementFactory.make("rtpav1pay", "rtpav1pay")
             rtpav1pay.set_property("mtu", 1200)
             extensions_return = self.rtp_add_extensions(rtpav1pay)
             if not extensions_return:
@@ -936,69 +572,426 @@ class GSTWebRTCApp:
             rtpav1pay_caps.set_value("rtcp-fb-x-gstreamer-fir-as-repair", True)
             rtpav1pay_capsfilter = Gst.ElementFactory.make("capsfilter")
             rtpav1pay_capsfilter.set_property("caps", rtpav1pay_caps)
+            codec_elements = [av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+
+        else:
+            raise GSTWebRTCAppError("Unsupported codec for pipeline: %s" % codec)
+
+        # Decouple capture, conversion and encoding into separate streaming threads with
+        # time-bounded leaky queues, old frames are dropped instead of building up delay.
+        capture_queue_elements = []
+        encode_queue_elements = []
+        if self.video_queue_max_time_ms > 0:
+            capture_queue_elements = [self.build_leaky_video_queue("capture_queue")]
+            encode_queue_elements = [self.build_leaky_video_queue("encode_queue")]
+
+        # Skip frames while the screen is idle, before they are queued for conversion.
+        self.video_encoder = encoder
+        if self.capture_idle_timeout_ms > 0:
+            self.capture_damage_time = Gst.util_get_timestamp()
+            self.capture_frame_hashes = [None] * CAPTURE_HASH_ROW_STEP
+            self.capture_idle = False
+            self.ximagesrc_capsfilter.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.__on_capture_buffer_probe)
+
+        # Drop frames that are already older than the latency budget before spending time encoding them.
+        if self.video_max_latency_ms > 0:
+            encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.__on_encoder_buffer_probe, encoder)
 
         # Add all elements to the pipeline.
-        pipeline_elements = [self.ximagesrc, self.ximagesrc_capsfilter]
+        pipeline_elements = [self.ximagesrc, self.ximagesrc_capsfilter] + capture_queue_elements + converter_elements + encode_queue_elements + [encoder] + codec_elements
 
-        # ADD_ENCODER: add new encoder elements to this list
-        if self.encoder in ["nvh264enc"]:
-            pipeline_elements += [cudaupload, cudaconvert, cudaconvert_capsfilter, nvh264enc, h264enc_capsfilter, rtph264pay, rtph264pay_capsfilter]
+        for pipeline_element in pipeline_elements:
+            self.pipeline.add(pipeline_element)
 
-        elif self.encoder in ["nvh265enc"]:
-            pipeline_elements += [cudaupload, cudaconvert, cudaconvert_capsfilter, nvh265enc, h265enc_capsfilter, rtph265pay, rtph265pay_capsfilter]
+        # Link the pipeline elements and raise exception of linking fails
+        # due to incompatible element pad capabilities.
+        # When fanning out, the payloaded stream ends in the tee where viewers attach.
+        if self.fanout_tee is not None:
+            self.pipeline.add(self.fanout_tee)
+            pipeline_elements += [self.fanout_tee]
+        else:
+            pipeline_elements += [self.webrtcbin]
+        for i in range(len(pipeline_elements) - 1):
+            if not Gst.Element.link(pipeline_elements[i], pipeline_elements[i + 1]):
+                raise GSTWebRTCAppError("Failed to link {} -> {}".format(pipeline_elements[i].get_name(), pipeline_elements[i + 1].get_name()))
 
-        elif self.encoder in ["nvav1enc"]:
-            pipeline_elements += [cudaupload, cudaconvert, cudaconvert_capsfilter, nvav1enc, av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+        if self.latency_tracing:
+            self.add_latency_probes(pipeline_elements, "video")
 
-        elif self.encoder in ["vah264enc"]:
-            pipeline_elements += [vapostproc, vapostproc_capsfilter, vah264enc, h264enc_capsfilter, rtph264pay, rtph264pay_capsfilter]
+        if self.fanout_tee is None:
+            self.configure_video_transceiver()
 
-        elif self.encoder in ["vah265enc"]:
-            pipeline_elements += [vapostproc, vapostproc_capsfilter, vah265enc, h265enc_capsfilter, rtph265pay, rtph265pay_capsfilter]
+        self.on_video_size(self.video_scale_size, self.display_size)
+    # [END build_video_pipeline]
 
-        elif self.encoder in ["vavp9enc"]:
-            pipeline_elements += [vapostproc, vapostproc_capsfilter, vavp9enc, vpenc_capsfilter, rtpvppay, rtpvppay_capsfilter]
+    def build_leaky_video_queue(self, name):
+        """Creates a queue between video stages holding at most video_queue_max_time_ms of frames
 
-        elif self.encoder in ["vaav1enc"]:
-            pipeline_elements += [vapostproc, vapostproc_capsfilter, vaav1enc, av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+        The queue leaks the oldest frames when full, dropped frames are reported with on_frames_dropped.
 
-        elif self.encoder in ["x264enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, x264enc, h264enc_capsfilter, rtph264pay, rtph264pay_capsfilter]
+        Arguments:
+            name {string} -- element name of the queue, also used as the stage of dropped frames
 
-        elif self.encoder in ["openh264enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, openh264enc, h264enc_capsfilter, rtph264pay, rtph264pay_capsfilter]
+        Returns:
+            Gst.Element -- the queue element
+        """
 
-        elif self.encoder in ["x265enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, x265enc, h265enc_capsfilter, rtph265pay, rtph265pay_capsfilter]
+        queue = Gst.ElementFactory.make("queue", name)
+        queue.set_property("leaky", "downstream")
+        queue.set_property("flush-on-eos", True)
+        queue.set_property("max-size-time", int(self.video_queue_max_time_ms * Gst.MSECOND))
+        # Set the other queue sizes to 0 to make it only time-based.
+        queue.set_property("max-size-buffers", 0)
+        queue.set_property("max-size-bytes", 0)
+        # Overrun is emitted for each buffer leaked from a full queue
+        queue.connect("overrun", lambda _: self.on_frames_dropped(name))
+        return queue
 
-        elif self.encoder in ["vp8enc", "vp9enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, vpenc, vpenc_capsfilter, rtpvppay, rtpvppay_capsfilter]
+    def notify_damage(self):
+        """Marks the screen as changed, called by the damage monitor
 
-        elif self.encoder in ["svtav1enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, svtav1enc, av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+        Resumes encoding with the next captured frame when the capture is idle.
+        """
 
-        elif self.encoder in ["av1enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, av1enc, av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+        self.capture_damage_time = Gst.util_get_timestamp()
 
-        elif self.encoder in ["rav1enc"]:
-            pipeline_elements += [videoconvert, videoconvert_capsfilter, rav1enc, av1enc_capsfilter, rtpav1pay, rtpav1pay_capsfilter]
+    def force_video_keyframe(self):
+        """Asks the video encoder to make the next frame a keyframe with headers
+        """
 
-        for pipeline_element in pipeline_elements:
-            self.pipeline.add(pipeline_element)
+        if self.video_encoder is None:
+            return
 
-        # Link the pipeline elements and raise exception of linking fails
-        # due to incompatible element pad capabilities.
-        pipeline_elements += [self.webrtcbin]
-        for i in range(len(pipeline_elements) - 1):
-            if not Gst.Element.link(pipeline_elements[i], pipeline_elements[i + 1]):
-                raise GSTWebRTCAppError("Failed to link {} -> {}".format(pipeline_elements[i].get_name(), pipeline_elements[i + 1].get_name()))
+        structure = Gst.Structure.new_from_string("GstForceKeyUnit, all-headers=(boolean)true")
+        event = Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM, structure)
+        if not self.video_encoder.send_event(event):
+            logger.warning("failed to request keyframe from video encoder")
+
+    def set_display_size(self, width, height):
+        """Sets the display size without touching the capture, e.g. at startup
+
+        Arguments:
+            width {integer} -- display width in pixels
+            height {integer} -- display height in pixels
+        """
+
+        self.display_size = (width, height)
+        self.on_video_size(self.video_scale_size, self.display_size)
+
+    def resize_capture(self, width, height):
+        """Restarts the capture after the display was resized
+
+        When scaling to a fixed coded size, only ximagesrc and the scaler see the new size
+        and the encoder keeps its session. The time until the first encoded frame at
+        the new size is reported with on_resize_first_frame.
+
+        Arguments:
+            width {integer} -- new display width in pixels
+            height {integer} -- new display height in pixels
+        """
+
+        self.set_display_size(width, height)
+        if self.pipeline is None or self.ximagesrc is None or self.video_encoder is None:
+            return
+
+        # Probes of an earlier resize still waiting for their frame remove themselves
+        self.pending_resize_frame = {"start_time": Gst.util_get_timestamp(), "size": (width, height), "caps": False}
+        self.ximagesrc_capsfilter.get_static_pad("src").add_probe(
+            Gst.PadProbeType.EVENT_DOWNSTREAM | Gst.PadProbeType.BUFFER, self.__on_resize_capture_probe, self.pending_resize_frame)
+        self.stop_ximagesrc()
+        self.start_ximagesrc()
+
+    def __on_resize_capture_probe(self, pad, info, resize):
+        if resize is not self.pending_resize_frame:
+            return Gst.PadProbeReturn.REMOVE
+
+        if info.type & Gst.PadProbeType.BUFFER:
+            if not resize["caps"]:
+                return Gst.PadProbeReturn.OK
+            # Wait for this frame to leave the encoder, frames queued before the resize are still ahead of it
+            self.video_encoder.get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER, self.__on_resize_encoded_probe, resize, info.get_buffer().pts)
+            return Gst.PadProbeReturn.REMOVE
+
+        event = info.get_event()
+        if event.type == Gst.EventType.CAPS:
+            structure = event.parse_caps().get_structure(0)
+            resize["caps"] = (structure.get_value("width"), structure.get_value("height")) == resize["size"]
+        return Gst.PadProbeReturn.OK
+
+    def __on_resize_encoded_probe(self, pad, info, resize, pts):
+        if resize is not self.pending_resize_frame:
+            return Gst.PadProbeReturn.REMOVE
+        buffer = info.get_buffer()
+        if pts != Gst.CLOCK_TIME_NONE and buffer.pts != Gst.CLOCK_TIME_NONE and buffer.pts < pts:
+            return Gst.PadProbeReturn.OK
+
+        self.pending_resize_frame = None
+        latency_ms = (Gst.util_get_timestamp() - resize["start_time"]) / Gst.MSECOND
+        logger.info("first frame at %dx%d encoded %.1f ms after resize" % (resize["size"] + (latency_ms,)))
+        self.on_resize_first_frame(latency_ms)
+        return Gst.PadProbeReturn.REMOVE
+
+    def __frame_changed(self, pad, buffer):
+        """Compares every CAPTURE_HASH_ROW_STEP-th row of the frame with the frame that sampled the same rows
+        """
+
+        caps = pad.get_current_caps()
+        height = caps.get_structure(0).get_value("height") if caps is not None else 0
+        success, map_info = buffer.map(Gst.MapFlags.READ)
+        if not success:
+            return True
+        try:
+            data = memoryview(map_info.data)
+            phase = self.capture_hash_phase
+            self.capture_hash_phase = (phase + 1) % CAPTURE_HASH_ROW_STEP
+            # Rows of ximagesrc frames are the frame size divided by the height, including padding
+            stride = len(data) // height if height else 0
+            if stride <= 0:
+                frame_hash = zlib.crc32(data)
+            else:
+                frame_hash = 0
+                for offset in range(phase * stride, len(data), stride * CAPTURE_HASH_ROW_STEP):
+                    frame_hash = zlib.crc32(data[offset:offset + stride], frame_hash)
+        finally:
+            buffer.unmap(map_info)
+        changed = frame_hash != self.capture_frame_hashes[phase]
+        self.capture_frame_hashes[phase] = frame_hash
+        return changed
+
+    def __on_capture_buffer_probe(self, pad, info):
+        now = Gst.util_get_timestamp()
+        damage_events = self.capture_damage_events and not self.ximagesrc.get_property("show-pointer")
+        if not damage_events and self.__frame_changed(pad, info.get_buffer()):
+            self.capture_damage_time = now
+
+        interval = (now - self.capture_last_frame_time) / Gst.SECOND if self.capture_last_frame_time else 0
+        self.capture_last_frame_time = now
+
+        idle = now - self.capture_damage_time > self.capture_idle_timeout_ms * Gst.MSECOND
+        if idle:
+            if not self.capture_idle:
+                logger.info("screen is idle, skipping captured frames")
+                self.capture_idle = True
+            if self.capture_keepalive_ms <= 0 or now - self.capture_last_push_time < self.capture_keepalive_ms * Gst.MSECOND:
+                self.on_capture_frame(True, True, interval)
+                return Gst.PadProbeReturn.DROP
+        elif self.capture_idle:
+            logger.info("screen changed, resuming capture")
+            self.capture_idle = False
+            # Frames were skipped, restart the stream with a full picture
+            self.force_video_keyframe()
+
+        self.capture_last_push_time = now
+        self.on_capture_frame(idle, False, interval)
+        return Gst.PadProbeReturn.OK
+
+    def __on_encoder_buffer_probe(self, pad, info, encoder):
+        buffer = info.get_buffer()
+        clock = encoder.get_clock()
+        if buffer is not None and clock is not None and buffer.pts != Gst.CLOCK_TIME_NONE:
+            age = clock.get_time() - encoder.get_base_time() - buffer.pts
+            if age > self.video_max_latency_ms * Gst.MSECOND:
+                self.on_frames_dropped("latency_budget")
+                return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+    def build_video_converter(self, converter, scale_size=None):
+        """Creates the colorspace conversion elements between ximagesrc and the encoder.
+
+        Arguments:
+            converter {dict} -- converter section of the encoder profile
+            scale_size {tuple} -- Optional (width, height) frames are scaled to, keeping the aspect ratio with borders
+
+        Returns:
+            [list of Gst.Element] -- conversion elements in linking order
+        """
+
+        if converter["type"] == "cuda":
+            # Upload buffers from ximagesrc directly to CUDA memory where
+            # the colorspace conversion will be performed.
+            cudaupload = Gst.ElementFactory.make("cudaupload", "cudaupload")
+            if self.gpu_id >= 0:
+                cudaupload.set_property("cuda-device-id", self.gpu_id)
+
+            # Convert the colorspace from BGRx to NVENC compatible format.
+            # This is performed with CUDA which reduces the overall CPU load
+            # compared to using the software videoconvert element.
+            cudaconvert = Gst.ElementFactory.make("cudaconvert", "cudaconvert")
+            if self.gpu_id >= 0:
+                cudaconvert.set_property("cuda-device-id", self.gpu_id)
+
+            # Instructs cudaconvert to handle Quality of Service (QOS) events
+            # from the rest of the pipeline. Setting this value increases
+            # encoder stability.
+            cudaconvert.set_property("qos", True)
+
+            # Convert ximagesrc BGRx format to NV12 using cudaconvert.
+            # This is a more compatible format for client-side software decoders.
+            cudaconvert_caps = Gst.caps_from_string("video/x-raw(memory:CUDAMemory)")
+            cudaconvert_caps.set_value("format", converter["format"])
+            cudaconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
+            if scale_size is None:
+                cudaconvert_capsfilter.set_property("caps", cudaconvert_caps)
+                return [cudaupload, cudaconvert, cudaconvert_capsfilter]
+
+            # Scale after the conversion, where frames are smaller
+            cudascale = Gst.ElementFactory.make("cudascale", "cudascale")
+            if self.gpu_id >= 0:
+                cudascale.set_property("cuda-device-id", self.gpu_id)
+            self.set_scaler_add_borders(cudascale)
+            cudaconvert_capsfilter.set_property("caps", self.scaled_caps(cudaconvert_caps, scale_size))
+            return [cudaupload, cudaconvert, cudascale, cudaconvert_capsfilter]
+
+        elif converter["type"] == "va":
+            if self.gpu_id > 0:
+                vapostproc = Gst.ElementFactory.make("varenderD{}postproc".format(128 + self.gpu_id), "vapostproc")
+            else:
+                vapostproc = Gst.ElementFactory.make("vapostproc", "vapostproc")
+            vapostproc.set_property("scale-method", "fast")
+            vapostproc.set_property("qos", True)
+            vapostproc_caps = Gst.caps_from_string("video/x-raw(memory:VAMemory)")
+            vapostproc_caps.set_value("format", converter["format"])
+            if scale_size is not None:
+                # vapostproc scales in the same pass as the conversion
+                self.set_scaler_add_borders(vapostproc)
+                vapostproc_caps = self.scaled_caps(vapostproc_caps, scale_size)
+            vapostproc_capsfilter = Gst.ElementFactory.make("capsfilter")
+            vapostproc_capsfilter.set_property("caps", vapostproc_caps)
+            return [vapostproc, vapostproc_capsfilter]
+
+        elif converter["type"] == "videoconvert":
+            # Videoconvert for colorspace conversion
+            videoconvert = Gst.ElementFactory.make("videoconvert", "videoconvert")
+            videoconvert.set_property("n-threads", resolve_threads({"threads": converter.get("threads", 4)}))
+            videoconvert.set_property("qos", True)
+            videoconvert_caps = Gst.caps_from_string("video/x-raw")
+            videoconvert_caps.set_value("format", converter["format"])
+            videoconvert_capsfilter = Gst.ElementFactory.make("capsfilter")
+            if scale_size is None:
+                videoconvert_capsfilter.set_property("caps", videoconvert_caps)
+                return [videoconvert, videoconvert_capsfilter]
+
+            # Scale after the conversion, where frames are smaller
+            videoscale = Gst.ElementFactory.make("videoscale", "videoscale")
+            videoscale.set_property("qos", True)
+            self.set_scaler_add_borders(videoscale)
+            videoconvert_capsfilter.set_property("caps", self.scaled_caps(videoconvert_caps, scale_size))
+            return [videoconvert, videoscale, videoconvert_capsfilter]
+
+        raise GSTWebRTCAppError("Unsupported converter for pipeline: %s" % converter["type"])
+
+    def scaled_caps(self, caps, scale_size):
+        """Returns a copy of the caps fixed to the coded size with square pixels
 
+        Arguments:
+            caps {Gst.Caps} -- caps of the converter output
+            scale_size {tuple} -- (width, height) of the coded video
+        """
+
+        caps = caps.copy()
+        caps.set_value("width", scale_size[0])
+        caps.set_value("height", scale_size[1])
+        caps.set_value("pixel-aspect-ratio", Gst.Fraction(1, 1))
+        return caps
+
+    def set_scaler_add_borders(self, element):
+        """Makes the scaler keep the aspect ratio of the display by adding borders, if the element supports it
+
+        Arguments:
+            element {Gst.Element} -- the scaling element
+        """
+
+        if "add-borders" in [element_property.name for element_property in element.list_properties()]:
+            element.set_property("add-borders", True)
+        else:
+            logger.warning("%s cannot add borders, the video is stretched to the coded size" % element.get_name())
+
+    def build_video_encoder(self):
+        """Creates the encoder element and applies the properties of the encoder profile.
+
+        Raises:
+            GSTWebRTCAppError -- thrown if none of the element factories of the profile are available.
+
+        Returns:
+            Gst.Element -- the encoder element
+        """
+
+        profile = self.encoder_profile
+        gst_minor = Gst.version().minor
+
+        # Pick the first available element factory matching the GPU and GStreamer version
+        encoder = None
+        for factory in profile["factories"]:
+            if "gpu" in factory and factory["gpu"] != (self.gpu_id > 0):
+                continue
+            if not gst_minor_matches(gst_minor, factory.get("gst_minor")):
+                continue
+            encoder = Gst.ElementFactory.make(factory["name"].format(gpu_id=self.gpu_id, render_node=128 + self.gpu_id), profile["name"])
+            if encoder is not None:
+                break
+        if encoder is None:
+            raise GSTWebRTCAppError("Failed to create encoder element for: %s" % self.encoder)
+
+        properties = dict(profile.get("properties", {}))
+        for version_properties in profile.get("version_properties", []):
+            if gst_minor_matches(gst_minor, version_properties.get("gst_minor")):
+                properties.update(version_properties["properties"])
+
+        optional_properties = profile.get("optional_properties", [])
+        encoder_properties = [encoder_property.name for encoder_property in encoder.list_properties()]
+        for name, value in properties.items():
+            if name in optional_properties and name not in encoder_properties:
+                continue
+            encoder.set_property(name, resolve_threads(value))
+
+        self.set_encoder_keyframe_distance(encoder)
+        self.set_encoder_vbv_buffer_size(encoder, self.fec_video_bitrate)
+        self.set_encoder_bitrate(encoder, self.fec_video_bitrate)
+        return encoder
+
+    def set_encoder_keyframe_distance(self, element):
+        """Sets the keyframe distance property of the encoder profile on the encoder element.
+
+        Arguments:
+            element {Gst.Element} -- the encoder element
+        """
+
+        keyframe = self.encoder_profile.get("keyframe")
+        if keyframe:
+            element.set_property(keyframe["property"], keyframe["infinite"] if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
+
+    def set_encoder_vbv_buffer_size(self, element, bitrate):
+        """Sets the VBV/HRD buffer properties of the encoder profile on the encoder element.
+
+        Arguments:
+            element {Gst.Element} -- the encoder element
+            bitrate {integer} -- encoder target bitrate in kbps
+        """
+
+        buffer_size = vbv_buffer_size(self.encoder_profile, bitrate, self.framerate, self.keyframe_distance != -1.0)
+        if buffer_size is not None:
+            for vbv_property in self.encoder_profile["vbv"]["properties"]:
+                element.set_property(vbv_property, buffer_size)
+
+    def set_encoder_bitrate(self, element, bitrate):
+        """Sets the bitrate property of the encoder profile on the encoder element.
+
+        Arguments:
+            element {Gst.Element} -- the encoder element
+            bitrate {integer} -- encoder target bitrate in kbps
+        """
+
+        element.set_property(self.encoder_profile["bitrate"]["property"], int(bitrate * self.encoder_profile["bitrate"].get("scale", 1)))
+
+    def configure_video_transceiver(self):
+        """Configures the video transceiver of webrtcbin after the video stream is linked.
+        """
         # Enable NACKs on the transceiver with video streams, helps with retransmissions and freezing when packets are dropped.
         transceiver = self.webrtcbin.emit("get-transceiver", 0)
         transceiver.set_property("do-nack", True)
         transceiver.set_property("fec-type", GstWebRTC.WebRTCFECType.ULP_RED if self.video_packetloss_percent > 0 else GstWebRTC.WebRTCFECType.NONE)
         transceiver.set_property("fec-percentage", self.video_packetloss_percent)
-    # [END build_video_pipeline]
 
     # [START build_audio_pipeline]
     def build_audio_pipeline(self):
@@ -1054,7 +1047,7 @@ class GSTWebRTCApp:
 
         # Create the rtpopuspay element to convert buffers into
         # RTP packets that are sent over the connection transport.
-        rtpopuspay = Gst.ElementFactory.make("rtpopuspay")
+        rtpopuspay = Gst.ElementFactory.make("rtpopuspay", "rtpopuspay")
         rtpopuspay.set_property("mtu", 1200)
 
         # Add WebRTC RTP extensions
@@ -1109,17 +1102,100 @@ class GSTWebRTCApp:
 
         # Link the pipeline elements and raise exception of linking fails
         # due to incompatible element pad capabilities.
-        pipeline_elements += [self.webrtcbin]
+        if self.fanout_tee is not None:
+            self.pipeline.add(self.fanout_tee)
+            pipeline_elements += [self.fanout_tee]
+        else:
+            pipeline_elements += [self.webrtcbin]
         for i in range(len(pipeline_elements) - 1):
             if not Gst.Element.link(pipeline_elements[i], pipeline_elements[i + 1]):
                 raise GSTWebRTCAppError("Failed to link {} -> {}".format(pipeline_elements[i].get_name(), pipeline_elements[i + 1].get_name()))
 
+        if self.latency_tracing:
+            self.add_latency_probes(pipeline_elements, "audio")
+
         # Enable redundancy (RED) in the audio stream, does not currently work
         # transceiver = self.webrtcbin.emit("get-transceiver", 0)
         # transceiver.set_property("fec-type", GstWebRTC.WebRTCFECType.ULP_RED if self.audio_packetloss_percent > 0 else GstWebRTC.WebRTCFECType.NONE)
         # transceiver.set_property("fec-percentage", self.audio_packetloss_percent)
     # [END build_audio_pipeline]
 
+    def add_latency_probes(self, elements, pipeline_name):
+        """Adds buffer probes measuring the processing time of each element of the stream
+
+        The time between a buffer entering the sink pad and leaving the source pad is reported
+        for each element, and the time from capture to leaving the element for sources.
+        Elements are labelled by name, stream elements are named after their role so the
+        labels stay the same when the pipeline is rebuilt. Capsfilters, tees and bins are skipped. The probes run on GStreamer streaming threads
+        and call on_element_latency from there.
+
+        Arguments:
+            elements {[list of Gst.Element]} -- linked stream elements in order
+            pipeline_name {string} -- label of the stream, video or audio
+        """
+
+        for element in elements:
+            factory = element.get_factory()
+            if factory is None or factory.get_name() in ["capsfilter", "tee"] or isinstance(element, Gst.Bin):
+                continue
+            stage = element.get_name()
+            sinkpad = element.get_static_pad("sink")
+            srcpad = element.get_static_pad("src")
+            if srcpad is None:
+                continue
+            if sinkpad is None:
+                srcpad.add_probe(Gst.PadProbeType.BUFFER, self.__on_source_buffer_probe, element, pipeline_name, stage)
+            else:
+                # Buffer timestamps are kept across the element, payloaders split a frame into packets with the same timestamp
+                entry_times = {}
+                sinkpad.add_probe(Gst.PadProbeType.BUFFER, self.__on_element_sink_probe, entry_times)
+                srcpad.add_probe(Gst.PadProbeType.BUFFER, self.__on_element_src_probe, entry_times, pipeline_name, stage)
+
+    def __on_source_buffer_probe(self, pad, info, element, pipeline_name, stage):
+        buffer = info.get_buffer()
+        clock = element.get_clock()
+        if buffer is not None and clock is not None and buffer.pts != Gst.CLOCK_TIME_NONE:
+            running_time = clock.get_time() - element.get_base_time()
+            self.on_element_latency(pipeline_name, stage, (running_time - buffer.pts) / Gst.MSECOND)
+        return Gst.PadProbeReturn.OK
+
+    def __on_element_sink_probe(self, pad, info, entry_times):
+        buffer = info.get_buffer()
+        if buffer is not None and buffer.pts != Gst.CLOCK_TIME_NONE:
+            # Bound the pending timestamps of elements dropping buffers
+            if len(entry_times) > 64:
+                entry_times.clear()
+            entry_times[buffer.pts] = Gst.util_get_timestamp()
+        return Gst.PadProbeReturn.OK
+
+    def __on_element_src_probe(self, pad, info, entry_times, pipeline_name, stage):
+        buffer = info.get_buffer()
+        if buffer is not None:
+            entry_time = entry_times.pop(buffer.pts, None)
+            if entry_time is not None:
+                self.on_element_latency(pipeline_name, stage, (Gst.util_get_timestamp() - entry_time) / Gst.MSECOND)
+        return Gst.PadProbeReturn.OK
+
+    def get_queue_levels(self):
+        """Returns the number of buffers waiting in each queue of the pipeline
+
+        Returns:
+            dict -- queue element name to current level in buffers
+        """
+
+        levels = {}
+        if self.pipeline is None:
+            return levels
+        iterator = self.pipeline.iterate_recurse()
+        while True:
+            res, element = iterator.next()
+            if res != Gst.IteratorResult.OK:
+                break
+            factory = element.get_factory()
+            if factory is not None and factory.get_name() == "queue":
+                levels[element.get_name()] = element.get_property("current-level-buffers")
+        return levels
+
     def check_plugins(self):
         """Check for required gstreamer plugins.
 
@@ -1129,42 +1205,15 @@ class GSTWebRTCApp:
 
         required = ["opus", "nice", "webrtc", "app", "dtls", "srtp", "rtp", "sctp", "rtpmanager", "ximagesrc"]
 
-        # ADD_ENCODER: add new encoder to this list
-        supported = ["nvh264enc", "nvh265enc", "nvav1enc", "vah264enc", "vah265enc", "vavp9enc", "vaav1enc", "x264enc", "openh264enc", "x265enc", "vp8enc", "vp9enc", "svtav1enc", "av1enc", "rav1enc"]
-        if self.encoder not in supported:
-            raise GSTWebRTCAppError('Unsupported encoder, must be one of: ' + ','.join(supported))
+        # Encoders are defined by the encoder profile registry, each profile names the GStreamer plugin it requires
+        if self.encoder_profile is None:
+            raise GSTWebRTCAppError('Unsupported encoder, must be one of: ' + ','.join(self.encoder_profiles.keys()))
 
-        # ADD_ENCODER: add new encoder to this list with required GStreamer plugin
-        if "av1" in self.encoder or self.congestion_control:
+        if self.encoder_profile["codec"] == "av1" or self.congestion_control:
             # rtpav1pay and rtpgccbwe are in gst-plugins-rs
             required.append("rsrtp")
 
-        if self.encoder.startswith("nv"):
-            required.append("nvcodec")
-
-        elif self.encoder.startswith("va"):
-            required.append("va")
-
-        elif self.encoder in ["x264enc"]:
-            required.append("x264")
-
-        elif self.encoder in ["openh264enc"]:
-            required.append("openh264")
-
-        elif self.encoder in ["x265enc"]:
-            required.append("x265")
-
-        elif self.encoder in ["vp8enc", "vp9enc"]:
-            required.append("vpx")
-
-        elif self.encoder in ["svtav1enc"]:
-            required.append("svtav1")
-
-        elif self.encoder in ["av1enc"]:
-            required.append("aom")
-
-        elif self.encoder in ["rav1enc"]:
-            required.append("rav1e")
+        required.append(self.encoder_profile["plugin"])
 
         missing = list(
             filter(lambda p: Gst.Registry.get().find_plugin(p) is None, required))
@@ -1222,42 +1271,12 @@ class GSTWebRTCApp:
         """
         if self.pipeline:
             self.framerate = framerate
-            # ADD_ENCODER: GOP/IDR Keyframe distance to keep the stream from freezing (in keyframe_dist seconds) and set vbv-buffer-size
+            # GOP/IDR Keyframe distance to keep the stream from freezing (in keyframe_dist seconds) and set vbv-buffer-size
             self.keyframe_frame_distance = -1 if self.keyframe_distance == -1.0 else max(self.min_keyframe_frame_distance, int(self.framerate * self.keyframe_distance))
-            if self.encoder.startswith("nv"):
-                element = Gst.Bin.get_by_name(self.pipeline, "nvenc")
-                element.set_property("gop-size", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-                element.set_property("vbv-buffer-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_nv))
-            elif self.encoder.startswith("va"):
-                element = Gst.Bin.get_by_name(self.pipeline, "vaenc")
-                element.set_property("key-int-max", 1024 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-                element.set_property("cpb-size", int((self.fec_video_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-            elif self.encoder in ["x264enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "x264enc")
-                element.set_property("key-int-max", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-                element.set_property("vbv-buf-capacity", int((1000 + self.framerate - 1) // self.framerate * self.vbv_multiplier_sw))
-            elif self.encoder in ["openh264enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "openh264enc")
-                element.set_property("gop-size", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            elif self.encoder in ["x265enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "x265enc")
-                element.set_property("key-int-max", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            elif self.encoder.startswith("vp"):
-                element = Gst.Bin.get_by_name(self.pipeline, "vpenc")
-                element.set_property("keyframe-max-dist", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-                vbv_buffer_size = int((1000 + self.framerate - 1) // self.framerate * self.vbv_multiplier_vp)
-                element.set_property("buffer-initial-size", vbv_buffer_size)
-                element.set_property("buffer-optimal-size", vbv_buffer_size)
-                element.set_property("buffer-size", vbv_buffer_size)
-            elif self.encoder in ["svtav1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "svtav1enc")
-                element.set_property("intra-period-length", -1 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            elif self.encoder in ["av1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "av1enc")
-                element.set_property("keyframe-max-dist", 2147483647 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
-            elif self.encoder in ["rav1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "rav1enc")
-                element.set_property("max-key-frame-interval", 715827882 if self.keyframe_distance == -1.0 else self.keyframe_frame_distance)
+            element = Gst.Bin.get_by_name(self.pipeline, self.encoder_profile["name"])
+            if element is not None:
+                self.set_encoder_keyframe_distance(element)
+                self.set_encoder_vbv_buffer_size(element, self.fec_video_bitrate)
             else:
                 logger.warning("setting keyframe interval (GOP size) not supported with encoder: %s" % self.encoder)
 
@@ -1283,38 +1302,12 @@ class GSTWebRTCApp:
                 self.rtpgccbwe.set_property("min-bitrate", max(100000 + self.fec_audio_bitrate, int(bitrate * 1000 * 0.1 + self.fec_audio_bitrate)))
                 self.rtpgccbwe.set_property("max-bitrate", int(bitrate * 1000 + self.fec_audio_bitrate))
                 self.rtpgccbwe.set_property("estimated-bitrate", int(bitrate * 1000 + self.fec_audio_bitrate))
-            # ADD_ENCODER: add new encoder to this list and set vbv-buffer-size if unit is bytes instead of milliseconds
-            if self.encoder.startswith("nv"):
-                element = Gst.Bin.get_by_name(self.pipeline, "nvenc")
-                if not cc:
-                    element.set_property("vbv-buffer-size", int((fec_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_nv))
-                element.set_property("bitrate", fec_bitrate)
-            elif self.encoder.startswith("va"):
-                element = Gst.Bin.get_by_name(self.pipeline, "vaenc")
-                if not cc:
-                    element.set_property("cpb-size", int((fec_bitrate + self.framerate - 1) // self.framerate * self.vbv_multiplier_va))
-                element.set_property("bitrate", fec_bitrate)
-            elif self.encoder in ["x264enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "x264enc")
-                element.set_property("bitrate", fec_bitrate)
-            elif self.encoder in ["openh264enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "openh264enc")
-                element.set_property("bitrate", fec_bitrate * 1000)
-            elif self.encoder in ["x265enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "x265enc")
-                element.set_property("bitrate", fec_bitrate)
-            elif self.encoder in ["vp8enc", "vp9enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "vpenc")
-                element.set_property("target-bitrate", fec_bitrate * 1000)
-            elif self.encoder in ["svtav1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "svtav1enc")
-                element.set_property("target-bitrate", fec_bitrate)
-            elif self.encoder in ["av1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "av1enc")
-                element.set_property("target-bitrate", fec_bitrate)
-            elif self.encoder in ["rav1enc"]:
-                element = Gst.Bin.get_by_name(self.pipeline, "rav1enc")
-                element.set_property("bitrate", fec_bitrate * 1000)
+            element = Gst.Bin.get_by_name(self.pipeline, self.encoder_profile["name"])
+            if element is not None:
+                # VBV/HRD buffer sizes in kbit follow the bitrate, sizes in milliseconds only follow the framerate
+                if (not cc) and self.encoder_profile.get("vbv", {}).get("unit", "kbit") == "kbit":
+                    self.set_encoder_vbv_buffer_size(element, fec_bitrate)
+                self.set_encoder_bitrate(element, fec_bitrate)
             else:
                 logger.warning("set_video_bitrate not supported with encoder: %s" % self.encoder)
 
@@ -1369,8 +1362,20 @@ class GSTWebRTCApp:
             "pipeline", {"status": "Set pointer visibility to: %d" % visible})
 
     def send_clipboard_data(self, data):
-        # TODO: WebRTC DataChannel accepts a maximum length of 65489 (= 65535 - 46 for '{"type": "clipboard", "data": {"content": ""}}'), remove this restriction after implementing DataChannel chunking
+        # WebRTC DataChannel accepts a maximum length of 65489 (= 65535 - 46 for '{"type": "clipboard", "data": {"content": ""}}'),
+        # larger clipboard contents are streamed through the transfer data channel.
         CLIPBOARD_RESTRICTION = 65400
+        if self.binary_messages:
+            clipboard_data = data.encode()
+            if len(clipboard_data) <= CLIPBOARD_RESTRICTION:
+                self.__send_data_channel_binary("clipboard", DATA_CLIPBOARD_STRUCT.pack(DATA_OP_CLIPBOARD) + clipboard_data)
+            elif self.is_transfer_channel_ready():
+                asyncio.create_task(self.send_transfer(
+                    TRANSFER_KIND_CLIPBOARD_TEXT, "text/plain;charset=utf-8", len(clipboard_data), io.BytesIO(clipboard_data).read))
+            else:
+                logger.warning("clipboard may not be sent to the client because the message length {} is above the maximum length of {}".format(len(clipboard_data), CLIPBOARD_RESTRICTION))
+            return
+
         clipboard_message = base64.b64encode(data.encode()).decode("utf-8")
         clipboard_length = len(clipboard_message)
         if clipboard_length <= CLIPBOARD_RESTRICTION:
@@ -1380,9 +1385,82 @@ class GSTWebRTCApp:
             logger.warning("clipboard may not be sent to the client because the base64 message length {} is above the maximum length of {}".format(clipboard_length, CLIPBOARD_RESTRICTION))
 
     def send_cursor_data(self, data):
+        """Sends the cursor image from WebRTCInput.cursor_to_msg()
+
+        The PNG image is sent as raw bytes with the binary protocol and base64 encoded otherwise.
+
+        Arguments:
+            data {dict} -- cursor with png, handle, override and hotspot
+        """
+
         self.last_cursor_sent = data
-        self.__send_data_channel_message(
-            "cursor", data)
+        if data is None:
+            self.__send_data_channel_message("cursor", data)
+            return
+
+        # Handles identify the cursor image, so known cursors are resent without serializing them again.
+        # Only messages with the image are cached, the client of a new channel may not have it.
+        cache_key = (data["handle"], self.binary_messages)
+        msg = self.cursor_messages.get(cache_key)
+        if self.binary_messages and data["handle"] in self.cursor_handles_sent:
+            msg = GLib.Bytes.new(DATA_CURSOR_STRUCT.pack(
+                DATA_OP_CURSOR, data["handle"], data["hotspot"]["x"], data["hotspot"]["y"], data["override"] == "none"))
+            cache_key = None
+        elif msg is not None:
+            self.cursor_messages.move_to_end(cache_key)
+        elif self.binary_messages:
+            header = DATA_CURSOR_STRUCT.pack(
+                DATA_OP_CURSOR, data["handle"], data["hotspot"]["x"], data["hotspot"]["y"], data["override"] == "none")
+            msg = GLib.Bytes.new(header + data["png"])
+        else:
+            msg = json.dumps({
+                "type": "cursor",
+                "data": {
+                    "curdata": base64.b64encode(data["png"]).decode(),
+                    "handle": data["handle"],
+                    "override": data["override"],
+                    "hotspot": data["hotspot"],
+                },
+            })
+        if cache_key is not None and cache_key not in self.cursor_messages:
+            self.cursor_messages[cache_key] = msg
+            if len(self.cursor_messages) > CURSOR_MESSAGE_CACHE_SIZE:
+                self.cursor_messages.popitem(last=False)
+
+        if not self.is_data_channel_ready():
+            logger.debug("skipping message because data channel is not ready: cursor")
+            return
+        self.data_channel.emit("send-data" if self.binary_messages else "send-string", msg)
+        if self.binary_messages:
+            self.cursor_handles_sent.add(data["handle"])
+
+    def send_cursor_preload(self, cursors):
+        """Sends cursor images in batches, later changes to them only send their handle
+
+        Requires the binary protocol. Batches are split to stay within the SCTP message size limit.
+
+        Arguments:
+            cursors {list} -- cursors from WebRTCInput.cursor_to_msg()
+        """
+
+        if not self.binary_messages or not self.is_data_channel_ready():
+            return
+
+        batch = [DATA_CURSOR_PRELOAD_STRUCT.pack(DATA_OP_CURSOR_PRELOAD)]
+        batch_size = DATA_CURSOR_PRELOAD_STRUCT.size
+        for data in cursors:
+            entry_size = DATA_CURSOR_PRELOAD_ENTRY_STRUCT.size + len(data["png"])
+            if len(batch) > 1 and batch_size + entry_size > DATA_CURSOR_PRELOAD_MAX_SIZE:
+                self.__send_data_channel_binary("cursor_preload", b"".join(batch))
+                batch = batch[:1]
+                batch_size = DATA_CURSOR_PRELOAD_STRUCT.size
+            batch.append(DATA_CURSOR_PRELOAD_ENTRY_STRUCT.pack(data["handle"], len(data["png"])))
+            batch.append(data["png"])
+            batch_size += entry_size
+        if len(batch) > 1:
+            self.__send_data_channel_binary("cursor_preload", b"".join(batch))
+        self.cursor_handles_sent.update(data["handle"] for data in cursors)
+        logger.info("sent %d preloaded cursors" % len(cursors))
 
     def send_gpu_stats(self, load, memory_total, memory_used):
         """Sends GPU stats to the data channel
@@ -1393,11 +1471,30 @@ class GSTWebRTCApp:
             memory_used {float} -- memory used on GPU in MB
         """
 
-        self.__send_data_channel_message("gpu_stats", {
-            "load": load,
-            "memory_total": memory_total,
-            "memory_used": memory_used,
-        })
+        # Unchanged stats are skipped, only stats the client received count as sent
+        stats = (load, memory_total, memory_used)
+        if stats == self.last_gpu_stats or not self.is_data_channel_ready():
+            return
+
+        if self.binary_messages:
+            self.__send_data_channel_binary("gpu_stats", DATA_GPU_STATS_STRUCT.pack(DATA_OP_GPU_STATS, *stats))
+        else:
+            self.__send_data_channel_message("gpu_stats", {
+                "load": load,
+                "memory_total": memory_total,
+                "memory_used": memory_used,
+            })
+        self.last_gpu_stats = stats
+
+    def send_input_protocol(self, version, timestamps=False):
+        """Announces the binary input protocol version supported by the server
+
+        Arguments:
+            version {integer} -- version of the binary input protocol
+            timestamps {bool} -- ask the client to append its time to binary input messages
+        """
+        self.__send_data_channel_message(
+            "input_protocol", {"version": version, "timestamps": timestamps})
 
     def send_reload_window(self):
         """Sends reload window command to the data channel
@@ -1463,12 +1560,108 @@ class GSTWebRTCApp:
     def send_system_stats(self, cpu_percent, mem_total, mem_used):
         """Sends system stats
         """
-        self.__send_data_channel_message(
-            "system_stats", {
-                "cpu_percent": cpu_percent,
-                "mem_total": mem_total,
-                "mem_used": mem_used,
-            })
+
+        # Unchanged stats are skipped, only stats the client received count as sent
+        stats = (cpu_percent, mem_total, mem_used)
+        if stats == self.last_system_stats or not self.is_data_channel_ready():
+            return
+
+        if self.binary_messages:
+            self.__send_data_channel_binary("system_stats", DATA_SYSTEM_STATS_STRUCT.pack(DATA_OP_SYSTEM_STATS, *stats))
+        else:
+            self.__send_data_channel_message(
+                "system_stats", {
+                    "cpu_percent": cpu_percent,
+                    "mem_total": mem_total,
+                    "mem_used": mem_used,
+                })
+        self.last_system_stats = stats
+
+    async def send_transfer(self, kind, name, size, read):
+        """Streams data to the client through the transfer data channel
+
+        Chunks are sent while the buffered amount of the channel is below TRANSFER_BUFFER_HIGH,
+        then sending waits until the channel drained to TRANSFER_BUFFER_LOW.
+
+        Arguments:
+            kind {integer} -- one of bulk_transfer.TRANSFER_KIND_*
+            name {string} -- file name or MIME type
+            size {integer} -- total size of the data
+            read {function} -- returns up to the given number of bytes of the data
+
+        Returns:
+            bool -- true if the transfer completed
+        """
+
+        if not self.binary_messages or not self.is_transfer_channel_ready():
+            logger.warning("skipping transfer because the transfer data channel is not ready: %s" % name)
+            return False
+
+        transfer_id = next(self.transfer_ids)
+        self.outgoing_transfers.add(transfer_id)
+        logger.info("sending transfer %d: %s, %d bytes" % (transfer_id, name, size))
+        try:
+            for msg in transfer_messages(transfer_id, kind, name, size, read):
+                while self.is_transfer_channel_ready() and self.transfer_data_channel.get_property("buffered-amount") > TRANSFER_BUFFER_HIGH:
+                    self.transfer_buffer_low.clear()
+                    if self.transfer_data_channel.get_property("buffered-amount") > TRANSFER_BUFFER_HIGH:
+                        await self.transfer_buffer_low.wait()
+                if transfer_id not in self.outgoing_transfers:
+                    logger.info("client aborted transfer %d" % transfer_id)
+                    return False
+                if not self.is_transfer_channel_ready():
+                    logger.warning("transfer data channel closed during transfer %d" % transfer_id)
+                    return False
+                self.transfer_data_channel.emit("send-data", GLib.Bytes.new(msg))
+        except Exception as e:
+            logger.error("failed to send transfer %d: %s" % (transfer_id, e))
+            if self.is_transfer_channel_ready():
+                self.transfer_data_channel.emit("send-data", GLib.Bytes.new(abort_message(transfer_id, str(e))))
+            return False
+        finally:
+            self.outgoing_transfers.discard(transfer_id)
+        return True
+
+    async def send_file(self, path):
+        """Streams a file to the client through the transfer data channel
+
+        Arguments:
+            path {string} -- path of the file
+
+        Returns:
+            bool -- true if the transfer completed
+        """
+
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            logger.warning("failed to open file for transfer: %s" % e)
+            self.send_transfer_error("failed to open %s: %s" % (os.path.basename(path), e.strerror))
+            return False
+        with f:
+            return await self.send_transfer(TRANSFER_KIND_FILE, os.path.basename(path), os.fstat(f.fileno()).st_size, f.read)
+
+    def abort_transfer(self, transfer_id):
+        """Stops sending a transfer, e.g. when the client aborted it
+        """
+
+        self.outgoing_transfers.discard(transfer_id)
+
+    def send_transfer_abort(self, transfer_id, reason):
+        """Tells the client a transfer it sent was aborted
+        """
+
+        if self.is_transfer_channel_ready():
+            self.transfer_data_channel.emit("send-data", GLib.Bytes.new(abort_message(transfer_id, reason)))
+
+    def send_transfer_error(self, reason):
+        """Tells the client a transfer it requested failed before it started, with an abort of an unused transfer id
+        """
+
+        self.send_transfer_abort(next(self.transfer_ids), reason)
+
+    def is_transfer_channel_ready(self):
+        return self.transfer_data_channel and self.transfer_data_channel.get_property("ready-state") == GstWebRTC.WebRTCDataChannelState.OPEN
 
     def is_data_channel_ready(self):
         """Checks to see if the data channel is open.
@@ -1495,6 +1688,22 @@ class GSTWebRTCApp:
         msg = {"type": msg_type, "data": data}
         self.data_channel.emit("send-string", json.dumps(msg))
 
+    def __send_data_channel_binary(self, msg_type, data):
+        """Sends binary message to the peer through the data channel
+
+        Message is dropped if the channel is not open.
+
+        Arguments:
+            msg_type {string} -- the type of message being sent, for logging
+            data {bytes} -- the packed message starting with its opcode
+        """
+        if not self.is_data_channel_ready():
+            logger.debug(
+                "skipping message because data channel is not ready: %s" % msg_type)
+            return
+
+        self.data_channel.emit("send-data", GLib.Bytes.new(data))
+
     def __on_offer_created(self, promise, _, __):
         """Handles on-offer-created promise resolution
 
@@ -1511,9 +1720,6 @@ class GSTWebRTCApp:
         promise.wait()
         reply = promise.get_reply()
         offer = reply.get_value('offer')
-        promise = Gst.Promise.new()
-        self.webrtcbin.emit('set-local-description', offer, promise)
-        promise.interrupt()
         sdp_text = offer.sdp.as_text()
         # rtx-time needs to be set to 125 milliseconds for optimal performance
         if 'rtx-time' not in sdp_text:
@@ -1525,7 +1731,7 @@ class GSTWebRTCApp:
         # Firefox needs profile-level-id=42e01f in the offer, but webrtcbin does not add this.
         # TODO: Remove when fixed in webrtcbin.
         #   https://gitlab.freedesktop.org/gstreamer/gstreamer/-/issues/1106
-        if "h264" in self.encoder or "x264" in self.encoder:
+        if self.encoder_profile["codec"] == "h264":
             if 'profile-level-id' not in sdp_text:
                 logger.warning("injecting profile-level-id to SDP")
                 sdp_text = sdp_text.replace('packetization-mode=', 'profile-level-id=42e01f;packetization-mode=')
@@ -1539,7 +1745,7 @@ class GSTWebRTCApp:
                 logger.warning("injecting modified level-asymmetry-allowed to SDP")
                 sdp_text = re.sub(r'level-asymmetry-allowed=\d+', r'level-asymmetry-allowed=1', sdp_text)
         # Enable sps-pps-idr-in-keyframe=1 in H.264 and H.265
-        if "h264" in self.encoder or "x264" in self.encoder or "h265" in self.encoder or "x265" in self.encoder:
+        if self.encoder_profile["codec"] in ["h264", "h265"]:
             if 'sps-pps-idr-in-keyframe' not in sdp_text:
                 logger.warning("injecting sps-pps-idr-in-keyframe to SDP")
                 sdp_text = sdp_text.replace('packetization-mode=', 'sps-pps-idr-in-keyframe=1;packetization-mode=')
@@ -1550,7 +1756,12 @@ class GSTWebRTCApp:
             # OPUS_FRAME: Add ptime explicitly to SDP offer
             sdp_text = re.sub(r'([^-]sprop-[^\r\n]+)', r'\1\r\na=ptime:10', sdp_text)
         # Set final SDP offer
-        asyncio.run(self.on_sdp('offer', sdp_text))
+        self.__post_signalling_message(self.on_sdp, 'offer', sdp_text)
+
+        # ICE gathering starts with the local description, queue the offer first so it always precedes its candidates
+        promise = Gst.Promise.new()
+        self.webrtcbin.emit('set-local-description', offer, promise)
+        promise.interrupt()
 
     def __request_aux_sender_gcc(self, webrtcbin, dtls_transport):
         """Handles request-aux-header signal, initializing the rtpgccbwe element for WebRTC
@@ -1649,16 +1860,53 @@ class GSTWebRTCApp:
             candidate {string} -- ice candidate string
         """
         logger.debug("received ICE candidate: %d %s", mlineindex, candidate)
-        asyncio.run(self.on_ice(mlineindex, candidate))
+        self.__post_signalling_message(self.on_ice, mlineindex, candidate)
+
+    def __post_signalling_message(self, handler, *args):
+        """Hands an outgoing SDP or ICE message from a GStreamer thread to the event loop
+
+        Messages posted before the loop picks them up are sent as one batch,
+        so a burst of trickle ICE candidates costs a single loop handoff.
+
+        Arguments:
+            handler {coroutine function} -- on_sdp or on_ice
+            args {tuple} -- handler arguments
+        """
+
+        with self.signalling_messages_lock:
+            self.signalling_messages.append((handler, args))
+            if self.signalling_flush_pending:
+                return
+            self.signalling_flush_pending = True
+        asyncio.run_coroutine_threadsafe(self.__flush_signalling_messages(), loop=self.async_event_loop)
+
+    async def __flush_signalling_messages(self):
+        """Sends the posted SDP and ICE messages in order on the event loop
+        """
+
+        # Batches are sent one after another to keep the offer ahead of its candidates
+        async with self.signalling_send_lock:
+            with self.signalling_messages_lock:
+                messages = self.signalling_messages
+                self.signalling_messages = []
+                self.signalling_flush_pending = False
+            logger.debug("sending %d signalling messages" % len(messages))
+            for handler, args in messages:
+                try:
+                    await handler(*args)
+                except Exception as e:
+                    logger.error("failed to send signalling message: %s" % e)
 
     def bus_call(self, message):
         t = message.type
         if t == Gst.MessageType.EOS:
             logger.error("End-of-stream\n")
+            self.invalidate_shared_pipeline()
             return False
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             logger.error("Error: %s: %s\n" % (err, debug))
+            self.invalidate_shared_pipeline()
             return False
         elif t == Gst.MessageType.STATE_CHANGED:
             if isinstance(message.src, Gst.Pipeline):
@@ -1673,65 +1921,372 @@ class GSTWebRTCApp:
                 self.webrtcbin.set_property("latency", 0)
         return True
 
-    def start_pipeline(self, audio_only=False):
-        """Starts the GStreamer pipeline
+    def start_shared_pipeline(self, audio_only=False):
+        """Starts the capture and encode section shared by all viewers
+
+        The section ends in a tee where each viewer attaches its own webrtcbin.
+        It is only built once and kept running while viewers are attached.
         """
 
-        logger.info("starting pipeline")
+        self.cancel_keep_alive_stop()
+        if self.shared_pipeline is not None:
+            if not (self.shared_pipeline_stale and self.reset_shared_pipeline()):
+                return
+
+        logger.info("starting shared {} pipeline".format("audio" if audio_only else "video"))
 
         self.pipeline = Gst.Pipeline.new()
 
-        # Construct the webrtcbin pipeline
-        self.build_webrtcbin_pipeline(audio_only)
+        # Do not stall the shared encoder when no viewer is attached yet.
+        self.fanout_tee = Gst.ElementFactory.make("tee", "fanout_tee")
+        self.fanout_tee.set_property("allow-not-linked", True)
 
         if audio_only:
             self.build_audio_pipeline()
         else:
             self.build_video_pipeline()
 
-        # Advance the state of the pipeline to PLAYING.
         res = self.pipeline.set_state(Gst.State.PLAYING)
-        if res != Gst.StateChangeReturn.SUCCESS:
+        if res == Gst.StateChangeReturn.FAILURE:
             raise GSTWebRTCAppError(
-                "Failed to transition pipeline to PLAYING: %s" % res)
+                "Failed to transition shared pipeline to PLAYING: %s" % res)
+
+        self.shared_pipeline = self.pipeline
+        self.shared_pipeline_stale = False
+        self.pipeline_started.set()
+
+    async def stop_shared_pipeline(self):
+        """Stops the shared capture and encode section once no viewer is attached
+        """
+
+        self.cancel_keep_alive_stop()
+        if self.shared_pipeline_teardown is not None:
+            await self.shared_pipeline_teardown
+        if self.shared_pipeline is None:
+            return
+
+        logger.info("setting shared pipeline state to NULL")
+        self.stop_bus_calls()
+        await asyncio.to_thread(self.shared_pipeline.set_state, Gst.State.NULL)
+        self.shared_pipeline = None
+        self.pipeline = None
+        self.fanout_tee = None
+        logger.info("shared pipeline stopped")
+
+    def schedule_keep_alive_stop(self):
+        """Stops the kept alive section after keep_alive_timeout_s unless a viewer attached by then
+        """
+
+        self.cancel_keep_alive_stop()
+        if self.keep_alive_timeout_s <= 0 or self.shared_pipeline is None:
+            return
+
+        def on_timeout():
+            self.keep_alive_stop_handle = None
+            if not self.fanout_viewers:
+                logger.info("no viewer attached for %.0f seconds, stopping kept alive pipeline" % self.keep_alive_timeout_s)
+                self.async_event_loop.create_task(self.stop_shared_pipeline())
+        self.keep_alive_stop_handle = self.async_event_loop.call_later(self.keep_alive_timeout_s, on_timeout)
+
+    def cancel_keep_alive_stop(self):
+        if self.keep_alive_stop_handle is not None:
+            self.keep_alive_stop_handle.cancel()
+            self.keep_alive_stop_handle = None
+
+    def reset_shared_pipeline(self):
+        """Tears down the shared capture and encode section if no viewer is attached
+
+        Used when a kept alive section no longer matches the display, the next viewer rebuilds it.
+        The section is detached right away and set to NULL in a thread like in stop_shared_pipeline(),
+        waiting for its streaming threads would block the event loop.
+
+        Returns:
+            bool -- True if the section was torn down
+        """
+
+        if self.shared_pipeline is None or self.fanout_viewers:
+            return False
+
+        logger.info("resetting idle shared pipeline")
+        # The bus task of the session watches the bus of the rebuilt section next
+        self.stop_bus_calls(rewatch=True)
+        pipeline = self.shared_pipeline
+        self.shared_pipeline = None
+        self.pipeline = None
+        self.fanout_tee = None
+
+        async def teardown():
+            await asyncio.to_thread(pipeline.set_state, Gst.State.NULL)
+            if self.shared_pipeline_teardown is asyncio.current_task():
+                self.shared_pipeline_teardown = None
+            logger.info("idle shared pipeline stopped")
+        self.shared_pipeline_teardown = self.async_event_loop.create_task(teardown())
+        return True
+
+    def invalidate_shared_pipeline(self):
+        """Marks the shared capture and encode section for rebuilding, for example after the display was resized
+
+        The section is rebuilt as soon as no viewer is attached to it.
+        """
+
+        if self.shared_pipeline is not None:
+            self.shared_pipeline_stale = True
+
+    def request_keyframe(self):
+        """Asks the upstream encoder for a keyframe with headers
+
+        A viewer joining a running stream cannot decode until the next keyframe,
+        which never comes on its own with an infinite keyframe distance.
+        """
+
+        if self.fanout_queue is None:
+            return
+
+        structure = Gst.Structure.new_from_string("GstForceKeyUnit, all-headers=(boolean)true")
+        event = Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM, structure)
+        if not self.fanout_queue.get_static_pad("sink").push_event(event):
+            logger.warning("failed to request keyframe for new viewer")
+
+    def __attach_webrtcbin(self, audio_only=False):
+        """Attaches a new webrtcbin of this viewer to the tee of the shared pipeline
+        """
+
+        source = self.source_app
+        source.start_shared_pipeline(audio_only)
+        self.pipeline = source.shared_pipeline
+
+        self.build_webrtcbin_pipeline(audio_only)
+
+        # Drop packets for a slow viewer instead of blocking the tee and every other viewer.
+        # Queues are named by the lowest free viewer slot, keeping the names reported by get_queue_levels() bounded.
+        slot = 0
+        while self.pipeline.get_by_name("fanout_queue_%d" % slot) is not None:
+            slot += 1
+        self.fanout_queue = Gst.ElementFactory.make("queue", "fanout_queue_%d" % slot)
+        self.fanout_queue.set_property("leaky", "downstream")
+        self.fanout_queue.set_property("flush-on-eos", True)
+        self.pipeline.add(self.fanout_queue)
+        if not Gst.Element.link(self.fanout_queue, self.webrtcbin):
+            raise GSTWebRTCAppError("Failed to link {} -> {}".format(self.fanout_queue.get_name(), self.webrtcbin.get_name()))
+
+        if not audio_only:
+            self.configure_video_transceiver()
+
+        self.webrtcbin.sync_state_with_parent()
+        self.fanout_queue.sync_state_with_parent()
+
+        if hasattr(source.fanout_tee, "request_pad_simple"):
+            tee_pad = source.fanout_tee.request_pad_simple("src_%u")
+        else:
+            tee_pad = source.fanout_tee.get_request_pad("src_%u")
+        res = tee_pad.link(self.fanout_queue.get_static_pad("sink"))
+        if res != Gst.PadLinkReturn.OK:
+            raise GSTWebRTCAppError("Failed to link shared pipeline tee to viewer: %s" % res)
+
+        source.fanout_viewers.add(self)
+        logger.info("attached viewer to shared pipeline, viewers: %d" % len(source.fanout_viewers))
+
+        if not audio_only:
+            self.request_keyframe()
+
+    def __detach_webrtcbin(self):
+        """Detaches the webrtcbin of this viewer from the tee of the shared pipeline
+
+        Called from a worker thread, the tee pad is unlinked from an idle probe
+        so a buffer is never pushed into a half-removed branch.
+        """
+
+        source = self.source_app
+        queue_sinkpad = self.fanout_queue.get_static_pad("sink")
+        tee_pad = queue_sinkpad.get_peer()
+        if tee_pad is not None:
+            unlinked = threading.Event()
+
+            def on_tee_pad_idle(pad, info):
+                pad.unlink(queue_sinkpad)
+                source.fanout_tee.release_request_pad(pad)
+                unlinked.set()
+                return Gst.PadProbeReturn.REMOVE
+
+            tee_pad.add_probe(Gst.PadProbeType.IDLE, on_tee_pad_idle)
+            if not unlinked.wait(1.0):
+                logger.warning("timed out waiting for shared pipeline tee to become idle")
+
+        for element in [self.webrtcbin, self.fanout_queue]:
+            element.set_state(Gst.State.NULL)
+            self.pipeline.remove(element)
+        self.fanout_queue = None
+        source.fanout_viewers.discard(self)
+        logger.info("detached viewer from shared pipeline, viewers: %d" % len(source.fanout_viewers))
+
+    def start_pipeline(self, audio_only=False):
+        """Starts the GStreamer pipeline
+        """
+
+        logger.info("starting pipeline")
+
+        if self.source_app is not None:
+            # Encode once and attach this viewer to the running stream.
+            self.__attach_webrtcbin(audio_only)
+        else:
+            self.pipeline = Gst.Pipeline.new()
+
+            # Construct the webrtcbin pipeline
+            self.build_webrtcbin_pipeline(audio_only)
+
+            if audio_only:
+                self.build_audio_pipeline()
+            else:
+                self.build_video_pipeline()
+
+            # Advance the state of the pipeline to PLAYING.
+            res = self.pipeline.set_state(Gst.State.PLAYING)
+            if res != Gst.StateChangeReturn.SUCCESS:
+                raise GSTWebRTCAppError(
+                    "Failed to transition pipeline to PLAYING: %s" % res)
+            self.pipeline_started.set()
 
         if not audio_only:
             # Create the data channel, this has to be done after the pipeline is PLAYING.
+            # Keys, buttons, clipboard and control messages are delivered reliably and in order.
             options = Gst.Structure("application/data-channel")
             options.set_value("ordered", True)
             options.set_value("priority", "high")
-            options.set_value("max-retransmits", 0)
             self.data_channel = self.webrtcbin.emit('create-data-channel', "input", options)
+            # The new client negotiates the protocol again and receives all stats
+            self.binary_messages = False
+            self.cursor_handles_sent = set()
+            self.last_system_stats = None
+            self.last_gpu_stats = None
             self.data_channel.connect('on-open', lambda _: self.on_data_open())
             self.data_channel.connect('on-close', lambda _: self.on_data_close())
             self.data_channel.connect('on-error', lambda _: self.on_data_error())
             self.data_channel.connect(
                 'on-message-string', lambda _, msg: asyncio.run_coroutine_threadsafe(self.on_data_message(msg), loop=self.async_event_loop))
+            self.data_channel.connect(
+                'on-message-data', lambda _, data: self.async_event_loop.call_soon_threadsafe(self.on_data_binary_message, data.get_data(), time.monotonic()))
+
+            # Pointer motion and gamepad axes from binary protocol clients are sent without retransmits or ordering,
+            # a lost or late update is superseded by the next one and cannot block key releases.
+            motion_options = Gst.Structure("application/data-channel")
+            motion_options.set_value("ordered", False)
+            motion_options.set_value("priority", "high")
+            motion_options.set_value("max-retransmits", 0)
+            self.motion_data_channel = self.webrtcbin.emit('create-data-channel', "motion", motion_options)
+            self.motion_data_channel.connect(
+                'on-message-data', lambda _, data: self.async_event_loop.call_soon_threadsafe(self.on_data_binary_message, data.get_data(), time.monotonic()))
+
+            # Clipboard contents and files are streamed in chunks at a lower priority than input.
+            transfer_options = Gst.Structure("application/data-channel")
+            transfer_options.set_value("ordered", True)
+            transfer_options.set_value("priority", "low")
+            self.transfer_data_channel = self.webrtcbin.emit('create-data-channel', "transfer", transfer_options)
+            self.transfer_data_channel.set_property("buffered-amount-low-threshold", TRANSFER_BUFFER_LOW)
+            self.transfer_data_channel.connect(
+                'on-buffered-amount-low', lambda _: self.async_event_loop.call_soon_threadsafe(self.transfer_buffer_low.set))
+            self.transfer_data_channel.connect(
+                'on-message-data', lambda _, data: self.async_event_loop.call_soon_threadsafe(self.on_transfer_message, data.get_data()))
+            self.transfer_data_channel.connect(
+                'on-close', lambda _: self.async_event_loop.call_soon_threadsafe(self.on_transfer_close))
 
         logger.info("{} pipeline started".format("audio" if audio_only else "video"))
 
     async def handle_bus_calls(self):
-        # Start bus call task
-        running = True
-        bus = None
-        while running:
-            if self.pipeline is not None:
-                bus = await asyncio.to_thread(self.pipeline.get_bus)
-            if bus is not None:
-                while await asyncio.to_thread(bus.have_pending):
-                    msg = bus.pop()
-                    if not await asyncio.to_thread(self.bus_call, msg):
-                        running = False
-            await asyncio.sleep(0.1)
+        """Dispatches pipeline bus messages as they arrive
+
+        The bus file descriptor is readable while messages are pending, it is watched
+        by the event loop so messages are handled on the loop without polling.
+        Returns when bus_call() stops the task or the pipeline is stopped,
+        a rebuilt shared pipeline is watched by the same task.
+        """
+
+        # Only one task watches the bus, the fd reader would be replaced otherwise
+        if self.handling_bus_calls:
+            return
+        self.handling_bus_calls = True
+
+        try:
+            rewatch = True
+            while rewatch:
+                # Start bus call task once the pipeline exists
+                await self.pipeline_started.wait()
+                bus = self.pipeline.get_bus()
+                bus_fd = bus.get_pollfd().fd
+                bus_watch = self.bus_watch = self.async_event_loop.create_future()
+                self.bus_post_times = {}
+
+                # Messages carry no timestamp, record the time they are posted in the posting thread
+                def on_bus_post(bus, msg):
+                    self.bus_post_times[msg.seqnum] = Gst.util_get_timestamp()
+                    return Gst.BusSyncReply.PASS
+
+                def on_bus_readable(bus=bus, bus_watch=bus_watch):
+                    while not bus_watch.done():
+                        msg = bus.pop()
+                        if msg is None:
+                            break
+                        # Messages posted before the sync handler was set have no post time
+                        post_time = self.bus_post_times.pop(msg.seqnum, None)
+                        if post_time is not None:
+                            self.on_bus_dispatch_delay((Gst.util_get_timestamp() - post_time) / Gst.MSECOND)
+                        if not self.bus_call(msg):
+                            bus_watch.set_result(False)
+
+                bus.set_sync_handler(on_bus_post)
+                self.async_event_loop.add_reader(bus_fd, on_bus_readable)
+                try:
+                    # Messages posted before the reader was added
+                    on_bus_readable()
+                    rewatch = await bus_watch
+                finally:
+                    self.async_event_loop.remove_reader(bus_fd)
+                    bus.set_sync_handler(None)
+                    self.bus_post_times = {}
+        finally:
+            self.handling_bus_calls = False
+
+    def stop_bus_calls(self, rewatch=False):
+        """Ends the running bus call task, if any
+
+        Arguments:
+            rewatch {bool} -- keep the task running to watch the bus of the next started pipeline
+        """
+
+        self.pipeline_started.clear()
+        if self.bus_watch is not None and not self.bus_watch.done():
+            self.bus_watch.set_result(rewatch)
 
     async def stop_pipeline(self):
         logger.info("stopping pipeline")
         if self.data_channel:
             await asyncio.to_thread(self.data_channel.emit, 'close')
             self.data_channel = None
+            if self.motion_data_channel:
+                await asyncio.to_thread(self.motion_data_channel.emit, 'close')
+                self.motion_data_channel = None
+            if self.transfer_data_channel:
+                await asyncio.to_thread(self.transfer_data_channel.emit, 'close')
+                self.transfer_data_channel = None
+                # Wake up transfers waiting for the channel to drain
+                self.transfer_buffer_low.set()
             logger.info("data channel closed")
+        if self.source_app is not None:
+            if self.fanout_queue is not None:
+                await asyncio.to_thread(self.__detach_webrtcbin)
+                self.webrtcbin = None
+            if self.source_app is not self:
+                self.pipeline = None
+            # Keep the capture and encode section warm for the next viewer unless it has to be rebuilt
+            if not self.source_app.fanout_viewers:
+                if not self.source_app.keep_alive or self.source_app.shared_pipeline_stale:
+                    await self.source_app.stop_shared_pipeline()
+                else:
+                    self.source_app.schedule_keep_alive_stop()
+            logger.info("pipeline stopped")
+            return
         if self.pipeline:
             logger.info("setting pipeline state to NULL")
+            self.stop_bus_calls()
             await asyncio.to_thread(self.pipeline.set_state, Gst.State.NULL)
             self.pipeline = None
             logger.info("pipeline set to state NULL")
@@ -20,7 +20,7 @@
 #   limitations under the License.
 
 from prometheus_client import start_http_server
-from prometheus_client import Gauge, Histogram, Info
+from prometheus_client import Counter, Gauge, Histogram, Info
 from datetime import datetime
 import asyncio
 import csv
@@ -35,6 +35,10 @@ logger = logging.getLogger("metrics")
 logger.setLevel(logging.INFO)
 
 FPS_HIST_BUCKETS = (0, 20, 40, 60)
+DELAY_MS_HIST_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100)
+SESSION_START_MS_HIST_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+ELEMENT_LATENCY_MS_HIST_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 33, 66)
+RESIZE_MS_HIST_BUCKETS = (16, 33, 50, 100, 250, 500, 1000, 2500, 5000)
 
 class Metrics:
     def __init__(self, port=8000, using_webrtc_csv=False):
@@ -45,6 +49,19 @@ class Metrics:
         self.gpu_utilization = Gauge('gpu_utilization', 'Utilization percentage reported by GPU')
         self.latency = Gauge('latency', 'Latency observed by client')
         self.webrtc_statistics = Info('webrtc_statistics', 'WebRTC Statistics from the client')
+        self.session_start_time = Histogram('session_start_time_ms', 'Time from browser HELLO to pipeline start in milliseconds', ['pipeline'], buckets=SESSION_START_MS_HIST_BUCKETS)
+        self.element_latency = Histogram('pipeline_element_latency_ms', 'Processing time of each GStreamer pipeline element in milliseconds', ['pipeline', 'element'], buckets=ELEMENT_LATENCY_MS_HIST_BUCKETS)
+        self.dropped_frames = Counter('pipeline_dropped_frames', 'Video frames dropped by leaky queues or the latency budget', ['stage'])
+        self.capture_frames = Counter('capture_frames', 'Captured video frames that were encoded or skipped while the screen was idle', ['state'])
+        self.capture_state_seconds = Counter('capture_state_seconds', 'Seconds of capture while the screen was active or idle', ['state'])
+        self.input_motion_events = Counter('input_motion_events', 'Pointer motion events received from the client and injected into the X server after coalescing', ['state'])
+        self.input_latency = Histogram('input_latency_ms', 'Time in milliseconds client input spent in the network, waiting for the event loop and being injected', ['stage'], buckets=DELAY_MS_HIST_BUCKETS)
+        self.cursor_latency = Histogram('cursor_latency_ms', 'Time in milliseconds from the X server reporting a cursor change to sending the cursor to the clients', buckets=DELAY_MS_HIST_BUCKETS)
+        self.resize_first_frame = Histogram('resize_first_frame_ms', 'Time in milliseconds from a display resize to the first encoded frame at the new size', ['mode'], buckets=RESIZE_MS_HIST_BUCKETS)
+        self.queue_level = Gauge('pipeline_queue_level_buffers', 'Buffers waiting in each GStreamer pipeline queue', ['pipeline', 'queue'])
+        # Queue names last reported by pipeline
+        self.queue_names = {}
+        self.bus_dispatch_delay = Histogram('bus_dispatch_delay_ms', 'Delay between posting and dispatching GStreamer bus messages in milliseconds', ['pipeline'], buckets=DELAY_MS_HIST_BUCKETS)
         self.using_webrtc_csv = using_webrtc_csv
         self.stats_video_file_path = None
         self.stats_audio_file_path = None
@@ -61,6 +78,43 @@ class Metrics:
     def set_latency(self, latency_ms):
         self.latency.set(latency_ms)
 
+    def observe_session_start_time(self, pipeline, start_time_ms):
+        self.session_start_time.labels(pipeline=pipeline).observe(start_time_ms)
+
+    def observe_element_latency(self, pipeline, element, latency_ms):
+        self.element_latency.labels(pipeline=pipeline, element=element).observe(max(0, latency_ms))
+
+    def inc_dropped_frames(self, stage):
+        self.dropped_frames.labels(stage=stage).inc()
+
+    def observe_capture_frame(self, idle, skipped, interval):
+        self.capture_state_seconds.labels(state="idle" if idle else "active").inc(interval)
+        self.capture_frames.labels(state="skipped" if skipped else "encoded").inc()
+
+    def inc_motion_events(self, received):
+        self.input_motion_events.labels(state="received").inc(received)
+        self.input_motion_events.labels(state="injected").inc()
+
+    def observe_input_latency(self, stage, latency_ms):
+        self.input_latency.labels(stage=stage).observe(max(0, latency_ms))
+
+    def observe_cursor_latency(self, latency_ms):
+        self.cursor_latency.observe(latency_ms)
+
+    def observe_resize_first_frame(self, mode, latency_ms):
+        self.resize_first_frame.labels(mode=mode).observe(latency_ms)
+
+    def set_queue_levels(self, pipeline, levels):
+        # Queues of detached viewers are gone, do not keep reporting their last level
+        for queue in self.queue_names.get(pipeline, set()) - levels.keys():
+            self.queue_level.remove(pipeline, queue)
+        self.queue_names[pipeline] = set(levels)
+        for queue, level in levels.items():
+            self.queue_level.labels(pipeline=pipeline, queue=queue).set(level)
+
+    def observe_bus_dispatch_delay(self, pipeline, delay_ms):
+        self.bus_dispatch_delay.labels(pipeline=pipeline).observe(max(0, delay_ms))
+
     async def start_http(self):
         await asyncio.to_thread(start_http_server, self.port)
 
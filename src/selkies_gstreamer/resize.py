@@ -4,146 +4,255 @@
 
 import asyncio
 import logging
-import os
-import re
 import subprocess
 from shutil import which
+from Xlib import display, error
 
 logger = logging.getLogger("gstwebrtc_app_resize")
 logger.setLevel(logging.DEBUG)
 
+# RandR mode flags
+RR_HSYNC_POSITIVE = 0x00000001
+RR_VSYNC_NEGATIVE = 0x00000008
+# SetCrtcConfig status when the configuration changed since it was read
+RR_SET_CONFIG_INVALID_CONFIG_TIME = 1
+
+# CVT reduced blanking timings, blanking in pixels and clock step in MHz
+CVT_RB_H_BLANK = 160
+CVT_RB_H_FRONT_PORCH = 48
+CVT_RB_H_SYNC = 32
+CVT_RB_MIN_V_BLANK_US = 460.0
+CVT_RB_V_FRONT_PORCH = 3
+CVT_RB_MIN_V_BACK_PORCH = 6
+CVT_CLOCK_STEP = 0.25
+
+
+class XRandRError(Exception):
+    pass
+
+
 def fit_res(w, h, max_w, max_h):
     if w < max_w and h < max_h:
         # Input resolution fits
         return w, h
 
-    # Reduce input dimensions until they fit
-    new_w = float(w)
-    new_h = float(h)
-    while new_w > max_w or new_h > max_h:
-        new_w = float(new_w * 0.9999)
-        new_h = float(new_h * 0.9999)
+    # Scale both dimensions by the factor fitting the most oversized one
+    scale = min(max_w / w, max_h / h, 1.0)
 
     # Snap final resolution to be divisible by 2.
-    new_w, new_h = [int(i) + int(i)%2 for i in (new_w, new_h)]
+    new_w, new_h = [int(i) + int(i)%2 for i in (w * scale, h * scale)]
     return new_w, new_h
 
-def get_new_res(res):
-    screen_name = "screen"
-    resolutions = []
-
-    screen_pat = re.compile(r'(.*)? connected.*?')
-    current_pat = re.compile(r'.*current (\d+ x \d+).*')
-    res_pat = re.compile(r'^(\d+x\d+)\s.*$')
-
-    found_screen = False
-    curr_res = new_res = max_res = res
-    with os.popen('xrandr') as pipe:
-        for line in pipe:
-            screen_ma = re.match(screen_pat, line.strip())
-            current_ma = re.match(current_pat, line.strip())
-            if screen_ma:
-                found_screen = True
-                screen_name, = screen_ma.groups()
-            if current_ma:
-                curr_res, = current_ma.groups()
-                curr_res = curr_res.replace(" ", "")
-            if found_screen:
-                res_ma = re.match(res_pat, line.strip())
-                if res_ma:
-                    resolutions += res_ma.groups()
-
-    if not found_screen:
-        logger.error("failed to find screen info in xrandr output")
-        return curr_res, new_res, resolutions, max_res
-
-    w, h = [int(i) for i in res.split('x')]
-
-    if screen_name.startswith("DVI"):
-        # Set max resolution for hardware accelerator.
-        max_res = "2560x1600"
-    else:
-        max_res = "7680x4320"
+def cvt_vsync_lines(width, height):
+    # Vertical sync width encodes the aspect ratio
+    for vsync, (aspect_w, aspect_h) in ((4, (4, 3)), (5, (16, 9)), (6, (16, 10)), (7, (5, 4)), (7, (15, 9))):
+        if width * aspect_h == height * aspect_w:
+            return vsync
+    return 10
 
-    max_w, max_h = [int(i) for i in max_res.split('x')]
-    new_w, new_h = fit_res(w, h, max_w, max_h)
-    new_res = "%dx%d" % (new_w, new_h)
+def generate_cvt_mode(width, height, refresh=60.0):
+    """Computes a CVT reduced blanking mode, like cvt -r
 
-    resolutions.sort()
-    return curr_res, new_res, resolutions, max_res, screen_name
+    The width is kept as is instead of rounding it down to 8 pixels, so any requested size can be set exactly.
 
-def resize_display(res):
-    curr_res, new_res, resolutions, max_res, screen_name = get_new_res(res)
-    if curr_res == new_res:
-        logger.info("target resolution is the same: %s, skipping resize" % res)
-        return False
+    Arguments:
+        width {integer} -- horizontal resolution
+        height {integer} -- vertical resolution
+        refresh {float} -- refresh rate in Hz
 
-    w, h = new_res.split("x")
-    res = mode = new_res
+    Returns:
+        dict -- RandR mode info fields, without id and name length
+    """
 
-    logger.info("resizing display to %s" % res)
-    if res not in resolutions:
-        logger.info("adding mode %s to xrandr screen '%s'" % (res, screen_name))
+    vsync = cvt_vsync_lines(width, height)
+    h_period_est = (1000000.0 / refresh - CVT_RB_MIN_V_BLANK_US) / height
+    v_blank_lines = max(int(CVT_RB_MIN_V_BLANK_US / h_period_est) + 1,
+                        CVT_RB_V_FRONT_PORCH + vsync + CVT_RB_MIN_V_BACK_PORCH)
+    h_total = width + CVT_RB_H_BLANK
+    v_total = height + v_blank_lines
+    clock_mhz = CVT_CLOCK_STEP * int(refresh * v_total * h_total / 1000000.0 / CVT_CLOCK_STEP)
 
-        mode, modeline = generate_xrandr_gtf_modeline(res)
+    return {
+        "width": width,
+        "height": height,
+        "dot_clock": int(clock_mhz * 1000000),
+        "h_sync_start": width + CVT_RB_H_FRONT_PORCH,
+        "h_sync_end": width + CVT_RB_H_FRONT_PORCH + CVT_RB_H_SYNC,
+        "h_total": h_total,
+        "h_skew": 0,
+        "v_sync_start": height + CVT_RB_V_FRONT_PORCH,
+        "v_sync_end": height + CVT_RB_V_FRONT_PORCH + vsync,
+        "v_total": v_total,
+        "flags": RR_HSYNC_POSITIVE | RR_VSYNC_NEGATIVE,
+    }
 
-        # Create new mode from modeline
-        logger.info("creating new xrandr mode: %s %s" % (mode, modeline))
-        cmd = ['xrandr', '--newmode', mode, *re.split('\s+', modeline)]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            logger.error("failed to create new xrandr mode: '%s %s': %s%s" % (mode, modeline, str(stdout), str(stderr)))
+class XRandRResizer:
+    """Resizes the X screen through the RandR extension
+
+    The screen resources are read once and kept with the table of mode names,
+    they are read again when the X server reports the configuration changed
+    since. Missing modes are created from a computed CVT modeline.
+    """
+
+    def __init__(self, display_name=None):
+        self.display_name = display_name
+        self.xdisplay = None
+        self.root = None
+        self.config_timestamp = None
+        self.output = None
+        self.output_name = None
+        self.crtc = None
+        # Map of mode name to mode id, and the ids of the modes added to the output
+        self.modes = {}
+        self.output_modes = set()
+
+    def connect(self):
+        """Connects to the X server and reads the screen resources
+
+        Raises:
+            XRandRError -- if RandR is not supported or no output is connected
+        """
+
+        self.xdisplay = display.Display(self.display_name)
+        if self.xdisplay.query_extension('RANDR') is None:
+            self.xdisplay.close()
+            self.xdisplay = None
+            raise XRandRError("RANDR extension not supported, cannot resize the display")
+        self.root = self.xdisplay.screen().root
+        self.load()
+
+    def close(self):
+        if self.xdisplay is not None:
+            self.xdisplay.close()
+            self.xdisplay = None
+
+    def load(self):
+        """Reads the modes and the first connected output with a CRTC
+        """
+
+        resources = self.root.xrandr_get_screen_resources()
+        self.config_timestamp = resources.config_timestamp
+
+        mode_names = resources.mode_names
+        if isinstance(mode_names, bytes):
+            mode_names = mode_names.decode()
+        self.modes = {}
+        offset = 0
+        for mode in resources.modes:
+            self.modes[mode_names[offset:offset + mode.name_length]] = mode.id
+            offset += mode.name_length
+
+        self.output = None
+        for output in resources.outputs:
+            info = self.xdisplay.xrandr_get_output_info(output, self.config_timestamp)
+            if info.connection == 0 and info.crtc:
+                self.output = output
+                self.output_name = info.name if isinstance(info.name, str) else info.name.decode()
+                self.crtc = info.crtc
+                self.output_modes = set(info.modes)
+                break
+        if self.output is None:
+            raise XRandRError("failed to find a connected RANDR output")
+
+    def get_current_res(self):
+        """Returns the resolution of the output as WxH
+        """
+
+        crtc_info = self.xdisplay.xrandr_get_crtc_info(self.crtc, self.config_timestamp)
+        return "%dx%d" % (crtc_info.width, crtc_info.height)
+
+    def get_max_res(self):
+        if self.output_name.startswith("DVI"):
+            # Set max resolution for hardware accelerator.
+            return "2560x1600"
+        return "7680x4320"
+
+    def get_new_res(self, res):
+        """Returns the current resolution and the requested resolution fitted to the maximum resolution of the output
+
+        Arguments:
+            res {string} -- requested resolution as WxH
+
+        Returns:
+            tuple -- (current resolution, new resolution) as WxH
+        """
+
+        w, h = [int(i) for i in res.split('x')]
+        max_w, max_h = [int(i) for i in self.get_max_res().split('x')]
+        new_w, new_h = fit_res(w, h, max_w, max_h)
+        return self.get_current_res(), "%dx%d" % (new_w, new_h)
+
+    def resize(self, res):
+        """Sets the output to a resolution, creating its mode when missing
+
+        Arguments:
+            res {string} -- requested resolution as WxH
+
+        Returns:
+            bool -- true if the resolution changed
+        """
+
+        curr_res, new_res = self.get_new_res(res)
+        if curr_res == new_res:
+            logger.info("target resolution is the same: %s, skipping resize" % res)
             return False
 
-        # Add the mode to the screen.
-        logger.info("adding xrandr mode '%s' to screen '%s'" % (mode, screen_name))
-        cmd = ['xrandr', '--addmode', screen_name, mode]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            logger.error("failed to add mode '%s' using xrandr: %s%s" % (mode, str(stdout), str(stderr)))
+        logger.info("resizing display to %s" % new_res)
+        try:
+            status = self.__apply(new_res)
+            if status == RR_SET_CONFIG_INVALID_CONFIG_TIME:
+                # The configuration was changed by another client, read it again
+                self.load()
+                status = self.__apply(new_res)
+        except error.XError as e:
+            logger.error("failed to apply RANDR mode %s: %s" % (new_res, e))
+            return False
+        if status != 0:
+            logger.error("failed to apply RANDR mode %s, status: %d" % (new_res, status))
             return False
+        return True
 
-    # Apply the resolution change
-    logger.info("applying xrandr screen '%s' mode: %s" % (screen_name, mode))
-    cmd = ['xrandr', '--output', screen_name, '--mode', mode]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        logger.error("failed to apply xrandr mode '%s': %s%s" % (mode, str(stdout), str(stderr)))
-        return False
+    def __get_mode(self, res):
+        mode = self.modes.get(res)
+        if mode is None:
+            w, h = [int(i) for i in res.split('x')]
+            mode_info = generate_cvt_mode(w, h)
+            logger.info("creating new RANDR mode %s: %s" % (res, mode_info))
+            mode_info["id"] = 0
+            mode_info["name_length"] = len(res)
+            mode = self.root.xrandr_create_mode(mode_info, res).mode
+            self.modes[res] = mode
+        if mode not in self.output_modes:
+            logger.info("adding RANDR mode '%s' to output '%s'" % (res, self.output_name))
+            self.xdisplay.xrandr_add_output_mode(self.output, mode)
+            self.output_modes.add(mode)
+        return mode
 
-    return True
+    def __apply(self, res):
+        w, h = [int(i) for i in res.split('x')]
+        mode = self.__get_mode(res)
+        crtc_info = self.xdisplay.xrandr_get_crtc_info(self.crtc, self.config_timestamp)
 
-def generate_xrandr_gtf_modeline(res):
-    mode = ""
-    modeline = ""
-    modeline_pat = re.compile(r'^.*Modeline\s+"(.*?)"\s+(.*)')
-    if len(res.split("x")) == 2:
-        # have WxH format
-        toks = res.split("x")
-        gtf_res = "{} {} 60".format(toks[0], toks[1])
-        mode = res
-    elif len(res.split(" ")) == 2:
-        # have W H format
-        toks = res.split(" ")
-        gtf_res = "{} {} 60".format(toks[0], toks[1])
-        mode = "{}x{}".format(toks[0], toks[1])
-    elif len(res.split(" ")) == 3:
-        # have W H refresh format
-        toks = res.split(" ")
-        gtf_res = res
-        mode = "{}x{}".format(toks[0], toks[1])
-    else:
-        raise Exception("unsupported input resolution format: {}".format(res))
+        # The screen has to contain the CRTC at all times, so it is grown to fit
+        # both sizes before the CRTC is set and shrunk to the new size afterwards.
+        # The physical size keeps the current DPI.
+        screen = self.xdisplay.screen()
+        geometry = self.root.get_geometry()
+        mm_per_px_w = screen.width_in_mms / max(1, screen.width_in_pixels)
+        mm_per_px_h = screen.height_in_mms / max(1, screen.height_in_pixels)
+        max_w, max_h = max(w, geometry.width), max(h, geometry.height)
+        if (max_w, max_h) != (geometry.width, geometry.height):
+            self.root.xrandr_set_screen_size(max_w, max_h, int(max_w * mm_per_px_w), int(max_h * mm_per_px_h))
+
+        reply = self.xdisplay.xrandr_set_crtc_config(
+            self.crtc, self.config_timestamp, crtc_info.x, crtc_info.y, mode, crtc_info.rotation, [self.output])
+        if reply.status != 0:
+            return reply.status
 
-    with os.popen('cvt -r ' + gtf_res) as pipe:
-        for line in pipe:
-            modeline_ma = re.match(modeline_pat, line.strip())
-            if modeline_ma:
-                _, modeline = modeline_ma.groups()
-    return mode, modeline
+        if (max_w, max_h) != (w, h):
+            self.root.xrandr_set_screen_size(w, h, int(w * mm_per_px_w), int(h * mm_per_px_h))
+        self.xdisplay.sync()
+        return 0
 
 def set_dpi(dpi):
     if which("xfconf-query"):
@@ -183,7 +292,12 @@ async def main():
         print("USAGE: %s WxH" % sys.argv[0])
         sys.exit(1)
     res = sys.argv[1]
-    print(await asyncio.to_thread(resize_display, res))
+    resizer = XRandRResizer()
+    resizer.connect()
+    try:
+        print(await asyncio.to_thread(resizer.resize, res))
+    finally:
+        resizer.close()
 
 def entrypoint():
     asyncio.run(main())
@@ -89,6 +89,59 @@ def generate_rtc_config(turn_host, turn_port, shared_secret, user, protocol='udp
 
     return json.dumps(rtc_config, indent=2)
 
+class LocalWebSocket(object):
+    '''
+    One end of an in-process signalling connection through asyncio queues.
+    Implements the subset of the websockets connection interface used by
+    WebRTCSimpleServer and WebRTCSignalling.
+    '''
+    def __init__(self, remote_address):
+        self.remote_address = remote_address
+        self.queue = asyncio.Queue()
+        self.peer = None
+        self.closed = False
+
+    @classmethod
+    def pair(cls):
+        client = cls(('local', 0))
+        server = cls(('local', 0))
+        client.peer = server
+        server.peer = client
+        return client, server
+
+    async def send(self, msg):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        self.peer.queue.put_nowait(msg)
+
+    async def recv(self):
+        msg = await self.queue.get()
+        if msg is None:
+            # Keep the close marker for any later recv
+            self.queue.put_nowait(None)
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return msg
+
+    async def ping(self):
+        pass
+
+    async def close(self, code=1000, reason=''):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put_nowait(None)
+        self.peer.closed = True
+        self.peer.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except websockets.exceptions.ConnectionClosedOK:
+            raise StopAsyncIteration
+
 class WebRTCSimpleServer(object):
     def __init__(self, options):
         ############### Global data ###############
@@ -102,6 +155,12 @@ class WebRTCSimpleServer(object):
         # Format: {room_id: {peer1_id, peer2_id, peer3_id, ...}}
         # Room dict with a set of peers in each room
         self.rooms = dict()
+        # Format: {callee_uid: caller_uid}
+        # Peers waiting with SESSION_WAIT for the callee to connect
+        self.session_waiters = dict()
+
+        # Fired when a peer registers with HELLO, with the peer uid
+        self.on_peer_hello = lambda uid: None
 
         # Websocket Server Instance
         self.server = None
@@ -304,6 +363,9 @@ class WebRTCSimpleServer(object):
 
     async def remove_peer(self, uid):
         await self.cleanup_session(uid)
+        for callee_id, caller_id in list(self.session_waiters.items()):
+            if uid == caller_id:
+                del self.session_waiters[callee_id]
         if uid in self.peers:
             ws, raddr, status, _ = self.peers[uid]
             if status and status != 'session':
@@ -312,6 +374,35 @@ class WebRTCSimpleServer(object):
             await ws.close()
             logger.info("Disconnected from peer {!r} at {!r}".format(uid, raddr))
 
+    async def start_session(self, uid, callee_id):
+        ws, raddr, _, _ = self.peers[uid]
+        meta = self.peers[callee_id][3]
+        if meta:
+            meta64 = base64.b64encode(bytes(json.dumps(meta).encode())).decode("ascii")
+        else:
+            meta64 = ""
+        await ws.send('SESSION_OK {}'.format(meta64))
+        wsc = self.peers[callee_id][0]
+        logger.info('Session from {!r} ({!r}) to {!r} ({!r})'
+              ''.format(uid, raddr, callee_id, wsc.remote_address))
+        # Register session
+        self.peers[uid][2] = 'session'
+        self.sessions[uid] = callee_id
+        self.peers[callee_id][2] = 'session'
+        self.sessions[callee_id] = uid
+
+    async def notify_session_waiter(self, uid):
+        '''
+        Start the session of a peer waiting for uid to connect
+        '''
+        caller_id = self.session_waiters.pop(uid, None)
+        if caller_id is None or caller_id not in self.peers:
+            return
+        if self.peers[caller_id][2] is not None:
+            return
+        logger.info("Peer {!r} connected, starting session for waiting peer {!r}".format(uid, caller_id))
+        await self.start_session(caller_id, uid)
+
     ############### Handler functions ###############
 
     async def connection_handler(self, ws, uid, meta=None):
@@ -319,6 +410,8 @@ class WebRTCSimpleServer(object):
         peer_status = None
         self.peers[uid] = [ws, raddr, peer_status, meta]
         logger.info("Registered peer {!r} at {!r} with meta: {}".format(uid, raddr, meta))
+        self.on_peer_hello(uid)
+        await self.notify_session_waiter(uid)
         while True:
             # Receive command, wait forever if necessary
             msg = await self.recv_msg_ping(ws, raddr)
@@ -361,6 +454,18 @@ class WebRTCSimpleServer(object):
                         continue
                 else:
                     raise AssertionError('Unknown peer status {!r}'.format(peer_status))
+            # Requested a session with a specific peer, started as soon as the peer connects
+            elif msg.startswith('SESSION_WAIT'):
+                logger.info("{!r} command {!r}".format(uid, msg))
+                _, callee_id = msg.split(maxsplit=1)
+                if callee_id not in self.peers:
+                    self.session_waiters[callee_id] = uid
+                    continue
+                if peer_status is not None:
+                    await ws.send('ERROR peer {!r} busy'.format(callee_id))
+                    continue
+                await self.start_session(uid, callee_id)
+                peer_status = 'session'
             # Requested a session with a specific peer
             elif msg.startswith('SESSION'):
                 logger.info("{!r} command {!r}".format(uid, msg))
@@ -371,20 +476,8 @@ class WebRTCSimpleServer(object):
                 if peer_status is not None:
                     await ws.send('ERROR peer {!r} busy'.format(callee_id))
                     continue
-                meta = self.peers[callee_id][3]
-                if meta:
-                    meta64 = base64.b64encode(bytes(json.dumps(meta).encode())).decode("ascii")
-                else:
-                    meta64 = ""
-                await ws.send('SESSION_OK {}'.format(meta64))
-                wsc = self.peers[callee_id][0]
-                logger.info('Session from {!r} ({!r}) to {!r} ({!r})'
-                      ''.format(uid, raddr, callee_id, wsc.remote_address))
-                # Register session
-                self.peers[uid][2] = peer_status = 'session'
-                self.sessions[uid] = callee_id
-                self.peers[callee_id][2] = 'session'
-                self.sessions[callee_id] = uid
+                await self.start_session(uid, callee_id)
+                peer_status = 'session'
             # Requested joining or creation of a room
             elif msg.startswith('ROOM'):
                 logger.info('{!r} command {!r}'.format(uid, msg))
@@ -462,20 +555,32 @@ class WebRTCSimpleServer(object):
             sys.exit(1)
         return sslctx
 
+    async def handler(self, ws):
+        '''
+        All incoming messages are handled here. @path is unused.
+        '''
+        raddr = ws.remote_address
+        logger.info("Connected to {!r}".format(raddr))
+        peer_id, meta = await self.hello_peer(ws)
+        try:
+            await self.connection_handler(ws, peer_id, meta)
+        except websockets.exceptions.ConnectionClosed:
+            logger.info("Connection to peer {!r} closed, exiting handler".format(raddr))
+        finally:
+            await self.remove_peer(peer_id)
+
+    def connect_local(self):
+        '''
+        Open an in-process connection for a signalling client running in the same
+        process, messages are exchanged through asyncio queues without TLS,
+        websocket framing or authentication.
+        '''
+        client, server = LocalWebSocket.pair()
+        asyncio.create_task(self.handler(server))
+        return client
+
     async def run(self):
-        async def handler(ws):
-            '''
-            All incoming messages are handled here. @path is unused.
-            '''
-            raddr = ws.remote_address
-            logger.info("Connected to {!r}".format(raddr))
-            peer_id, meta = await self.hello_peer(ws)
-            try:
-                await self.connection_handler(ws, peer_id, meta)
-            except websockets.exceptions.ConnectionClosed:
-                logger.info("Connection to peer {!r} closed, exiting handler".format(raddr))
-            finally:
-                await self.remove_peer(peer_id)
+        handler = self.handler
 
         # Initial cache of web_root files
         await asyncio.gather(*[self.cache_file(os.path.realpath(f)) for f in pathlib.Path(self.web_root).rglob('*.*')])
@@ -22,8 +22,11 @@
 import Xlib
 from Xlib import display
 from Xlib.ext import xfixes, xtest
+import array
 import asyncio
 import base64
+import collections
+import hashlib
 import pynput
 import io
 import msgpack
@@ -31,9 +34,15 @@ import re
 import os
 import subprocess
 import socket
+import struct
+import sys
 import time
 from PIL import Image
 from gamepad import SelkiesGamepad
+from clock_offset import ClockOffsetEstimator
+from clipboard_monitor import ClipboardMonitor, ClipboardMonitorError
+from x11_keyboard import X11Keyboard, char_to_keysym
+from xcursor_theme import get_cursor_theme, load_cursor_theme
 
 import logging
 logger = logging.getLogger("webrtc_input")
@@ -51,6 +60,12 @@ MOUSE_BUTTON_LEFT = 41
 MOUSE_BUTTON_MIDDLE = 42
 MOUSE_BUTTON_RIGHT = 43
 
+# Number of converted cursor images and of cursor serials mapped to them kept in the cursor cache
+CURSOR_CACHE_SIZE = 128
+CURSOR_SERIAL_CACHE_SIZE = 256
+# Array type code of the 32 bit cursor pixels
+CURSOR_PIXEL_TYPECODE = "I" if array.array("I").itemsize == 4 else "L"
+
 UINPUT_BTN_LEFT = (0x01, 0x110)
 UINPUT_BTN_MIDDLE = (0x01, 0x112)
 UINPUT_BTN_RIGHT = (0x01, 0x111)
@@ -74,17 +89,83 @@ MOUSE_BUTTON_MAP = {
     },
 }
 
+# Binary input protocol, announced to the client when the data channel opens.
+# Every binary message starts with a one byte opcode followed by a fixed little-endian layout,
+# all other commands keep using the text protocol.
+INPUT_PROTOCOL_VERSION = 1
+
+INPUT_OP_KEY_DOWN = 0x01
+INPUT_OP_KEY_UP = 0x02
+INPUT_OP_MOUSE = 0x03
+INPUT_OP_MOUSE_RELATIVE = 0x04
+INPUT_OP_JS_BUTTON = 0x05
+INPUT_OP_JS_AXIS = 0x06
+# Pointer motion and gamepad axes sent on the unordered "motion" data channel,
+# absolute updates carry a 16 bit sequence number so late packets are dropped.
+INPUT_OP_MOTION = 0x07
+INPUT_OP_MOTION_RELATIVE = 0x08
+INPUT_OP_JS_AXIS_MOTION = 0x09
+# Set on the opcode of messages followed by the client time in seconds, sent when input latency is measured
+INPUT_OP_TIMESTAMP_FLAG = 0x80
+
+# opcode, keysym
+INPUT_KEY_STRUCT = struct.Struct("<BI")
+# opcode, x, y, button mask, scroll magnitude, scrolling is sent as button presses with a magnitude
+INPUT_MOUSE_STRUCT = struct.Struct("<BiiBB")
+# opcode, gamepad number, button or axis number, value
+INPUT_JS_STRUCT = struct.Struct("<BBBf")
+# opcode, sequence, x, y
+INPUT_MOTION_STRUCT = struct.Struct("<BHii")
+# opcode, relative x, relative y
+INPUT_MOTION_RELATIVE_STRUCT = struct.Struct("<Bii")
+# opcode, sequence, gamepad number, axis number, value
+INPUT_JS_AXIS_MOTION_STRUCT = struct.Struct("<BHBBf")
+# client time appended to timestamped messages
+INPUT_TIMESTAMP_STRUCT = struct.Struct("<d")
+
+RESOLUTION_RE = re.compile(r'^\d+x\d+$')
+SCALE_RE = re.compile(r'^\d+(\.\d+)?$')
+
 
 class WebRTCInputError(Exception):
     pass
 
 
+class InputSession:
+    """Input state of the data channel of one viewer
+
+    Each viewer negotiates the binary protocol on its own data channel, the
+    state of one viewer must not change how the input of another is handled.
+    """
+
+    def __init__(self):
+        # Binary input protocol version accepted by the client, 0 until negotiated
+        self.input_protocol_version = 0
+
+        # Last sequence number of absolute motion updates by target
+        self.motion_sequences = {}
+
+        self.ping_start = None
+
+        # Offset of the client clock, estimated from ping round trips
+        self.clock_offset = ClockOffsetEstimator()
+
+        self.on_ping_response = lambda latency: logger.warning(
+            'unhandled on_ping_response')
+
+
 class WebRTCInput:
-    def __init__(self, uinput_mouse_socket_path="", js_socket_path="", enable_clipboard="", enable_cursors=True, cursor_size=16, cursor_scale=1.0, cursor_debug=False):
+    def __init__(self, uinput_mouse_socket_path="", js_socket_path="", enable_clipboard="", enable_cursors=True, cursor_size=16, cursor_scale=1.0, cursor_debug=False, motion_coalesce_ms=0, typing_key_delay_ms=0.1, cursor_preload=False):
         """Initializes WebRTC input instance
+
+        Arguments:
+            motion_coalesce_ms {float} -- Window in milliseconds to merge pointer motion in before injecting it, 0 injects every event.
+            typing_key_delay_ms {float} -- Pacing in milliseconds between keys typed by the "kt" command.
+            cursor_preload {bool} -- Convert the common shapes of the Xcursor theme when the cursor monitor starts.
         """
 
         self.clipboard_running = False
+        self.clipboard_monitor = None
         self.uinput_mouse_socket_path = uinput_mouse_socket_path
         self.uinput_mouse_socket = None
 
@@ -98,7 +179,17 @@ class WebRTCInput:
 
         self.enable_cursors = enable_cursors
         self.cursors_running = False
-        self.cursor_cache = {}
+        self.cursors_stopped = None
+        # Connection of the cursor monitor, separate from the connection injecting input
+        self.cursor_xdisplay = None
+        # Map of cursor image hash, scale and size to its message, least recently used first
+        self.cursor_cache = collections.OrderedDict()
+        # Map of cursor serial to its key in cursor_cache
+        self.cursor_serials = collections.OrderedDict()
+        self.cursor_handle = 0
+        # Messages of the theme cursors converted ahead of their first use
+        self.cursor_preload = cursor_preload
+        self.preloaded_cursors = []
         self.cursor_scale = cursor_scale
         self.cursor_size = cursor_size
         self.cursor_debug = cursor_debug
@@ -109,7 +200,32 @@ class WebRTCInput:
         self.xdisplay = None
         self.button_mask = 0
 
-        self.ping_start = None
+        # Mapping of pointer positions in the scaled video to the display as (scale, offset x, offset y, width, height),
+        # None when the video has the display size
+        self.pointer_transform = None
+
+        # Pointer motion waiting for injection as [relative, x, y, number of merged events]
+        self.motion_coalesce_ms = motion_coalesce_ms
+        self.pending_motion = None
+        self.motion_flush_handle = None
+
+        # Text typed as key presses. Delays up to 1ms only yield to the event loop, keys are sent
+        # in batches with the delay of the whole batch after each. Longer delays pace every key.
+        self.typing_key_delay_ms = typing_key_delay_ms
+        self.typing_batch_size = 64 if typing_key_delay_ms <= 1 else 1
+        self.typing_lock = asyncio.Lock()
+
+        # Binary message handlers indexed by opcode, called with the input session of the viewer
+        self.binary_handlers = [None] * 256
+        self.binary_handlers[INPUT_OP_KEY_DOWN] = (INPUT_KEY_STRUCT, lambda session, op, keysym: self.send_x11_keypress(keysym, down=True))
+        self.binary_handlers[INPUT_OP_KEY_UP] = (INPUT_KEY_STRUCT, lambda session, op, keysym: self.send_x11_keypress(keysym, down=False))
+        self.binary_handlers[INPUT_OP_MOUSE] = (INPUT_MOUSE_STRUCT, lambda session, *values: self.__on_binary_mouse(*values))
+        self.binary_handlers[INPUT_OP_MOUSE_RELATIVE] = (INPUT_MOUSE_STRUCT, lambda session, *values: self.__on_binary_mouse(*values))
+        self.binary_handlers[INPUT_OP_JS_BUTTON] = (INPUT_JS_STRUCT, lambda session, op, js_num, btn_num, btn_val: self.__js_emit_btn(js_num, btn_num, btn_val))
+        self.binary_handlers[INPUT_OP_JS_AXIS] = (INPUT_JS_STRUCT, lambda session, op, js_num, axis_num, axis_val: self.__js_emit_axis(js_num, axis_num, axis_val))
+        self.binary_handlers[INPUT_OP_MOTION] = (INPUT_MOTION_STRUCT, self.__on_binary_motion)
+        self.binary_handlers[INPUT_OP_MOTION_RELATIVE] = (INPUT_MOTION_RELATIVE_STRUCT, self.__on_binary_motion_relative)
+        self.binary_handlers[INPUT_OP_JS_AXIS_MOTION] = (INPUT_JS_AXIS_MOTION_STRUCT, self.__on_binary_js_axis_motion)
 
         self.on_video_encoder_bit_rate = lambda bitrate: logger.warning(
             'unhandled on_video_encoder_bit_rate')
@@ -131,15 +247,25 @@ class WebRTCInput:
             'unhandled on_resize')
         self.on_scaling_ratio = lambda res: logger.warning(
             'unhandled on_scaling_ratio')
-        self.on_ping_response = lambda latency: logger.warning(
-            'unhandled on_ping_response')
         self.on_cursor_change = lambda msg: logger.warning(
             'unhandled on_cursor_change')
         self.on_client_webrtc_stats = lambda webrtc_stat_type, webrtc_stats: logger.warning(
             'unhandled on_client_webrtc_stats')
+        # Number of pointer motion events received for each injected motion, fired for every injection so metrics are optional
+        self.on_motion_injected = lambda received: None
+        # Time in milliseconds timestamped input spent in the network, waiting for the event loop and being injected
+        self.on_input_latency = lambda stage, latency_ms: None
+        # Time in milliseconds from receiving a cursor change to sending it to the clients
+        self.on_cursor_latency = lambda latency_ms: None
 
     def __keyboard_connect(self):
-        self.keyboard = pynput.keyboard.Controller()
+        self.keyboard = X11Keyboard()
+        self.keyboard.connect()
+
+    def __keyboard_disconnect(self):
+        if self.keyboard:
+            self.keyboard.disconnect()
+            self.keyboard = None
 
     def __mouse_connect(self):
         if self.uinput_mouse_socket_path:
@@ -228,8 +354,10 @@ class WebRTCInput:
         self.__mouse_connect()
 
     async def disconnect(self):
+        self.flush_motion()
         await self.__js_disconnect()
         self.__mouse_disconnect()
+        self.__keyboard_disconnect()
 
     def reset_keyboard(self):
         """Resets any stuck modifier keys
@@ -259,12 +387,41 @@ class WebRTCInput:
         for k in [lctrl, lshift, lalt, rctrl, rshift, ralt, lmeta, rmeta, keyf, keyF, keym, keyM, escape]:
             self.send_x11_keypress(k, down=False)
 
+    def set_video_size(self, video_size, display_size):
+        """Sets the size of the video pointer positions are sent in
+
+        The video is the display scaled to fit with borders, positions are mapped back to the display.
+
+        Arguments:
+            video_size {tuple} -- (width, height) of the encoded video, None when it has the display size
+            display_size {tuple} -- (width, height) of the display
+        """
+
+        if video_size is None or display_size is None or video_size == display_size:
+            self.pointer_transform = None
+            return
+        scale = min(video_size[0] / display_size[0], video_size[1] / display_size[1])
+        self.pointer_transform = (
+            scale,
+            (video_size[0] - display_size[0] * scale) / 2.0,
+            (video_size[1] - display_size[1] * scale) / 2.0,
+            display_size[0],
+            display_size[1])
+
+    def __map_position(self, x, y):
+        if self.pointer_transform is None:
+            return x, y
+        scale, offset_x, offset_y, width, height = self.pointer_transform
+        x = int(round((x - offset_x) / scale))
+        y = int(round((y - offset_y) / scale))
+        return min(max(x, 0), width - 1), min(max(y, 0), height - 1)
+
     def send_mouse(self, action, data):
         if action == MOUSE_POSITION:
             # data is a tuple of (x, y)
             # using X11 mouse even when virtual mouse is enabled for non-relative actions.
             if self.mouse:
-                self.mouse.position = data
+                self.mouse.position = self.__map_position(*data)
         elif action == MOUSE_MOVE:
             # data is a tuple of (x, y)
             x, y = data
@@ -312,7 +469,7 @@ class WebRTCInput:
     def send_x11_keypress(self, keysym, down=True):
         """Sends keypress to X server
 
-        The key sym is converted to a keycode using the X server library.
+        The key sym is converted to a keycode with the cached keyboard mapping and sent with XTest.
 
         Arguments:
             keysym {integer} -- the key symbol to send
@@ -321,17 +478,11 @@ class WebRTCInput:
             down {bool} -- toggle key down or up (default: {True})
         """
 
+        # Keep pending pointer motion ahead of the key
+        self.flush_motion()
+
         try:
-            # With the Generic 105-key PC layout (default in Linux without a real keyboard), the key '<' is redirected to keycode 94
-            # Because keycode 94 with Shift pressed is instead the key '>', the keysym for '<' should instead be redirected to ','
-            # Although prevented in most cases, this fix may present issues in some keyboard layouts
-            if keysym == 60 and self.keyboard._display.keysym_to_keycode(keysym) == 94:
-                keysym = 44
-            keycode = pynput.keyboard.KeyCode(keysym)
-            if down:
-                self.keyboard.press(keycode)
-            else:
-                self.keyboard.release(keycode)
+            self.keyboard.send_key(keysym, down)
         except Exception as e:
             logger.error('failed to send keypress: {}'.format(e))
 
@@ -349,6 +500,14 @@ class WebRTCInput:
             button_mask {integer} -- mask of 5 mouse buttons, button 1 is at the LSB.
         """
 
+        # Motion without button changes is merged with the following motion events
+        if self.motion_coalesce_ms > 0 and button_mask == self.button_mask:
+            self.__queue_motion(x, y, relative)
+            return
+
+        # Inject pending motion first to never reorder it with buttons
+        self.flush_motion()
+
         # Mouse motion
         if relative:
             self.send_mouse(MOUSE_MOVE, (x, y))
@@ -398,6 +557,84 @@ class WebRTCInput:
         if not relative:
             self.xdisplay.sync()
 
+    def __queue_motion(self, x, y, relative):
+        """Merges pointer motion until the coalescing window ends
+
+        Relative deltas are summed and the last absolute position is kept.
+        """
+
+        if self.pending_motion is not None and self.pending_motion[0] != relative:
+            self.flush_motion()
+
+        if self.pending_motion is None:
+            self.pending_motion = [relative, x, y, 1]
+            self.motion_flush_handle = asyncio.get_running_loop().call_later(
+                self.motion_coalesce_ms / 1000.0, self.flush_motion)
+        elif relative:
+            self.pending_motion[1] += x
+            self.pending_motion[2] += y
+            self.pending_motion[3] += 1
+        else:
+            self.pending_motion[1] = x
+            self.pending_motion[2] = y
+            self.pending_motion[3] += 1
+
+    def flush_motion(self):
+        """Injects the merged pointer motion with a single X server sync
+        """
+
+        if self.motion_flush_handle is not None:
+            self.motion_flush_handle.cancel()
+            self.motion_flush_handle = None
+        if self.pending_motion is None:
+            return
+
+        relative, x, y, received = self.pending_motion
+        self.pending_motion = None
+        try:
+            if relative:
+                self.send_mouse(MOUSE_MOVE, (x, y))
+            else:
+                self.send_mouse(MOUSE_POSITION, (x, y))
+                self.xdisplay.sync()
+        except Exception as e:
+            logger.warning('failed to set mouse cursor: {}'.format(e))
+        self.on_motion_injected(received)
+
+    async def type_text(self, text):
+        """Types text as key presses
+
+        Keys are sent in batches of typing_batch_size, yielding to the event loop
+        between batches, each key is its own batch when the key delay is above 1ms. Characters missing
+        from the keyboard mapping use scratch keycodes, a batch ends early before a recently used
+        scratch keycode would be rebound and waits until clients had time to handle its keys.
+
+        Arguments:
+            text {string} -- the text to type
+        """
+
+        async with self.typing_lock:
+            self.flush_motion()
+            i = 0
+            while i < len(text):
+                batch_size = 0
+                rebind_delay = 0
+                try:
+                    while i < len(text) and batch_size < self.typing_batch_size:
+                        keysym = char_to_keysym(text[i])
+                        if keysym is not None:
+                            rebind_delay = self.keyboard.rebind_delay(keysym)
+                            if rebind_delay > 0:
+                                break
+                            self.keyboard.type_keysym(keysym)
+                        i += 1
+                        batch_size += 1
+                    self.keyboard.sync()
+                except Exception as e:
+                    logger.error('failed to type text: {}'.format(e))
+                    return
+                await asyncio.sleep(max(batch_size * self.typing_key_delay_ms / 1000.0, rebind_delay))
+
     def read_clipboard(self):
         try:
             result = subprocess.run(('xsel', '--clipboard', '--output'), check=True, text=True, capture_output=True, timeout=3)
@@ -408,99 +645,237 @@ class WebRTCInput:
     def write_clipboard(self, data):
         try:
             subprocess.run(('xsel', '--clipboard', '--input'), input=data.encode(), check=True, timeout=3)
+            # Do not send the text back to the client when xsel takes the selection
+            if self.clipboard_monitor:
+                self.clipboard_monitor.set_last_text(data)
             return True
         except subprocess.SubprocessError as e:
             logger.warning(f"Error while writing to clipboard: {e}")
             return False
 
+    def write_clipboard_image(self, mime_type, data):
+        # xsel only handles text, images are served by xclip
+        try:
+            subprocess.run(('xclip', '-selection', 'clipboard', '-t', mime_type, '-i'), input=data, check=True, timeout=3)
+            logger.info("set clipboard image, type: %s, length: %d" % (mime_type, len(data)))
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Error while writing image to clipboard: {e}")
+            return False
+
     async def start_clipboard(self):
         if self.enable_clipboard in ["true", "out"]:
             logger.info("starting clipboard monitor")
             self.clipboard_running = True
-            last_data = ""
-            while self.clipboard_running:
-                curr_data = self.read_clipboard()
-                if curr_data and curr_data != last_data:
-                    logger.info(
-                        "sending clipboard content, length: %d" % len(curr_data))
-                    self.on_clipboard_read(curr_data)
-                    last_data = curr_data
-                await asyncio.sleep(0.5)
-            logger.info("clipboard monitor stopped")
+            self.clipboard_monitor = ClipboardMonitor()
+            self.clipboard_monitor.on_clipboard = self.__on_clipboard_change
+            try:
+                await self.clipboard_monitor.start()
+            except ClipboardMonitorError as e:
+                logger.warning("%s, polling the clipboard instead" % e)
+                self.clipboard_monitor = None
+                await self.__poll_clipboard()
+            finally:
+                self.clipboard_monitor = None
+                self.clipboard_running = False
         else:
             logger.info("skipping outbound clipboard service.")
 
+    def __on_clipboard_change(self, data):
+        logger.info(
+            "sending clipboard content, length: %d" % len(data))
+        self.on_clipboard_read(data)
+
+    async def __poll_clipboard(self):
+        last_data = ""
+        while self.clipboard_running:
+            curr_data = self.read_clipboard()
+            if curr_data and curr_data != last_data:
+                self.__on_clipboard_change(curr_data)
+                last_data = curr_data
+            await asyncio.sleep(0.5)
+        logger.info("clipboard monitor stopped")
+
     def stop_clipboard(self):
         logger.info("stopping clipboard monitor")
         self.clipboard_running = False
+        if self.clipboard_monitor:
+            self.clipboard_monitor.stop()
 
     async def start_cursor_monitor(self):
-        if not self.xdisplay.has_extension('XFIXES'):
-            if self.xdisplay.query_extension('XFIXES') is None:
-                logger.error(
-                    'XFIXES extension not supported, cannot watch cursor changes')
-                return
+        """Watches for cursor changes until stop_cursor_monitor() is called
 
-        xfixes_version = self.xdisplay.xfixes_query_version()
+        The monitor has its own X connection read from the event loop, so cursor
+        changes are handled as soon as the X server reports them.
+        """
+
+        cursor_xdisplay = display.Display()
+        if cursor_xdisplay.query_extension('XFIXES') is None:
+            logger.error(
+                'XFIXES extension not supported, cannot watch cursor changes')
+            cursor_xdisplay.close()
+            return
+
+        xfixes_version = cursor_xdisplay.xfixes_query_version()
         logger.info('Found XFIXES version %s.%s' % (
             xfixes_version.major_version,
             xfixes_version.minor_version,
         ))
 
         logger.info("starting cursor monitor")
-        self.cursor_cache = {}
+        self.cursor_xdisplay = cursor_xdisplay
+        self.cursor_cache.clear()
+        self.cursor_serials.clear()
         self.cursors_running = True
-        screen = self.xdisplay.screen()
-        self.xdisplay.xfixes_select_cursor_input(
+        screen = cursor_xdisplay.screen()
+        cursor_xdisplay.xfixes_select_cursor_input(
             screen.root, xfixes.XFixesDisplayCursorNotifyMask)
+        cursor_xdisplay.flush()
         logger.info("watching for cursor changes")
 
         # Fetch initial cursor
+        self.__send_cursor(screen.root, None, time.monotonic())
+
+        if self.cursor_preload:
+            self.preload_cursors(cursor_xdisplay)
+
+        loop = asyncio.get_running_loop()
+        self.cursors_stopped = loop.create_future()
+        loop.add_reader(cursor_xdisplay.fileno(), self.__process_cursor_events, screen.root)
         try:
-            image = self.xdisplay.xfixes_get_cursor_image(screen.root)
-            self.cursor_cache[image.cursor_serial] = self.cursor_to_msg(
-                image, self.cursor_scale, self.cursor_size)
-            self.on_cursor_change(self.cursor_cache[image.cursor_serial])
-        except Exception as e:
-            logger.warning("exception from fetching cursor image: %s" % e)
-
-        while self.cursors_running:
-            if self.xdisplay.pending_events() == 0:
-                await asyncio.sleep(0.1)
-                continue
-            event = self.xdisplay.next_event()
-            if (event.type, 0) == self.xdisplay.extension_event.DisplayCursorNotify:
-                cache_key = event.cursor_serial
-                if cache_key in self.cursor_cache:
-                    if self.cursor_debug:
-                        logger.warning(
-                            "cursor changed to cached serial: {}".format(cache_key))
-                else:
-                    try:
-                        # Request the cursor image.
-                        cursor = self.xdisplay.xfixes_get_cursor_image(
-                            screen.root)
+            # Changes read while fetching the initial and preloaded cursors are already queued
+            self.__process_cursor_events(screen.root)
+            await self.cursors_stopped
+        finally:
+            loop.remove_reader(cursor_xdisplay.fileno())
+            self.cursors_running = False
+            self.cursor_xdisplay = None
+            cursor_xdisplay.close()
 
-                        # Convert cursor image and cache.
-                        self.cursor_cache[cache_key] = self.cursor_to_msg(
-                            cursor, self.cursor_scale, self.cursor_size)
+        logger.info("cursor monitor stopped")
 
-                        if self.cursor_debug:
-                            logger.warning("New cursor: position={},{}, size={}x{}, length={}, xyhot={},{}, cursor_serial={}".format(
-                                cursor.x, cursor.y, cursor.width, cursor.height, len(cursor.cursor_image), cursor.xhot, cursor.yhot, cursor.cursor_serial))
-                    except Exception as e:
-                        logger.warning(
-                            "exception from fetching cursor image: %s" % e)
+    def __process_cursor_events(self, root):
+        # Fetching a cursor image reads the events that arrived meanwhile into the queue
+        # of the connection, the socket does not become readable for them again.
+        while self.cursor_xdisplay.pending_events() > 0:
+            notify_time = time.monotonic()
+            cursor_serial = None
+            while self.cursor_xdisplay.pending_events() > 0:
+                event = self.cursor_xdisplay.next_event()
+                if (event.type, 0) == self.cursor_xdisplay.extension_event.DisplayCursorNotify:
+                    # Only the last of several queued changes is shown
+                    cursor_serial = event.cursor_serial
+            if cursor_serial is not None:
+                self.__send_cursor(root, cursor_serial, notify_time)
+
+    def __send_cursor(self, root, cursor_serial, notify_time):
+        """Sends a changed cursor, fetching and converting its image unless cached
 
-                self.on_cursor_change(self.cursor_cache.get(cache_key))
+        Arguments:
+            root {Window} -- root window of the cursor monitor connection
+            cursor_serial {integer} -- serial of the cursor, None to fetch the current cursor
+            notify_time {float} -- monotonic time in seconds the change was received
+        """
 
-        logger.info("cursor monitor stopped")
+        msg = None
+        cache_key = self.cursor_serials.get(cursor_serial)
+        if cache_key in self.cursor_cache:
+            self.cursor_serials.move_to_end(cursor_serial)
+            self.cursor_cache.move_to_end(cache_key)
+            msg = self.cursor_cache[cache_key]
+            if self.cursor_debug:
+                logger.warning(
+                    "cursor changed to cached serial: {}".format(cursor_serial))
+        else:
+            try:
+                # Request the cursor image.
+                cursor = self.cursor_xdisplay.xfixes_get_cursor_image(root)
+                msg = self.__get_cursor_msg(cursor)
+
+                if self.cursor_debug:
+                    logger.warning("New cursor: position={},{}, size={}x{}, length={}, xyhot={},{}, cursor_serial={}, handle={}".format(
+                        cursor.x, cursor.y, cursor.width, cursor.height, len(cursor.cursor_image), cursor.xhot, cursor.yhot, cursor.cursor_serial, msg["handle"]))
+            except Exception as e:
+                logger.warning(
+                    "exception from fetching cursor image: %s" % e)
+                if cursor_serial is None:
+                    return
+
+        self.on_cursor_change(msg)
+        self.on_cursor_latency((time.monotonic() - notify_time) * 1000)
+
+    def __get_cursor_msg(self, cursor):
+        """Returns the message of a cursor image, converting it only for new image contents
+
+        Animated cursors get a new serial for every frame, so messages are cached
+        by a hash of the image and the serials are mapped to it. Both caches drop
+        their least recently used entries.
+
+        Arguments:
+            cursor {GetCursorImage} -- XFIXES cursor image reply
+
+        Returns:
+            dict -- message from cursor_to_msg()
+        """
+
+        pixels = self.cursor_to_pixels(cursor)
+        cache_key = (
+            hashlib.blake2b(pixels, digest_size=16).digest(),
+            cursor.width, cursor.height, cursor.xhot, cursor.yhot,
+            self.cursor_scale, self.cursor_size)
+        msg = self.cursor_cache.get(cache_key)
+        if msg is None:
+            # Handles identify the image in the client cache, 0 is the default cursor
+            self.cursor_handle = self.cursor_handle % 0xffffffff + 1
+            msg = self.cursor_to_msg(
+                cursor, self.cursor_scale, self.cursor_size, handle=self.cursor_handle, pixels=pixels)
+            self.cursor_cache[cache_key] = msg
+            if len(self.cursor_cache) > CURSOR_CACHE_SIZE:
+                self.cursor_cache.popitem(last=False)
+        else:
+            self.cursor_cache.move_to_end(cache_key)
+
+        # Images loaded from the cursor theme have no serial
+        if cursor.cursor_serial:
+            self.cursor_serials[cursor.cursor_serial] = cache_key
+            self.cursor_serials.move_to_end(cursor.cursor_serial)
+            if len(self.cursor_serials) > CURSOR_SERIAL_CACHE_SIZE:
+                self.cursor_serials.popitem(last=False)
+        return msg
+
+    def preload_cursors(self, xdisplay):
+        """Converts the common shapes of the Xcursor theme ahead of their first use
+
+        The converted cursors are added to the cursor cache, where the images reported
+        by XFIXES find them by their contents, and kept in preloaded_cursors to be sent
+        to clients in one batch.
+
+        Arguments:
+            xdisplay {Display} -- X display to read the cursor theme settings from
+        """
+
+        try:
+            theme, size = get_cursor_theme(xdisplay)
+            images = load_cursor_theme(theme, size)
+        except Exception as e:
+            logger.warning("failed to load cursor theme: %s" % e)
+            return
+
+        # Themes link several names to the same image, hidden cursors need no image
+        preloaded = {}
+        for image in images:
+            msg = self.__get_cursor_msg(image)
+            if msg["override"] is None:
+                preloaded[msg["handle"]] = msg
+        self.preloaded_cursors = list(preloaded.values())
 
     def stop_cursor_monitor(self):
         logger.info("stopping cursor monitor")
         self.cursors_running = False
+        if self.cursors_stopped is not None and not self.cursors_stopped.done():
+            self.cursors_stopped.set_result(None)
 
-    def cursor_to_msg(self, cursor, scale=1.0, cursor_size=-1):
+    def cursor_to_msg(self, cursor, scale=1.0, cursor_size=-1, handle=None, pixels=None):
         if cursor_size > -1:
             target_width = cursor_size
             target_height = cursor_size
@@ -512,16 +887,18 @@ class WebRTCInput:
             xhot_scaled = int(cursor.xhot * scale)
             yhot_scaled = int(cursor.yhot * scale)
 
-        png_data_b64 = base64.b64encode(
-            self.cursor_to_png(cursor, target_width, target_height))
+        if pixels is None:
+            pixels = self.cursor_to_pixels(cursor)
+
+        png_data = self.cursor_to_png(cursor, pixels, target_width, target_height)
 
         override = None
-        if sum(cursor.cursor_image) == 0:
+        if pixels.count(0) == len(pixels):
             override = "none"
 
         return {
-            "curdata": png_data_b64.decode(),
-            "handle": cursor.cursor_serial,
+            "png": png_data,
+            "handle": cursor.cursor_serial if handle is None else handle,
             "override": override,
             "hotspot": {
                 "x": xhot_scaled,
@@ -529,15 +906,22 @@ class WebRTCInput:
             },
         }
 
-    def cursor_to_png(self, cursor, resize_width, resize_height):
-        with io.BytesIO() as f:
-            # Extract each component to RGBA bytes.
-            s = [((i >> b) & 0xFF)
-                 for i in cursor.cursor_image for b in [16, 8, 0, 24]]
+    def cursor_to_pixels(self, cursor):
+        """Packs the ARGB pixels of a cursor image in a 32 bit array
+
+        The array is in little endian byte order, its buffer is BGRA bytes.
+        """
 
-            # Create raw image from pixel bytes
+        pixels = array.array(CURSOR_PIXEL_TYPECODE, cursor.cursor_image)
+        if sys.byteorder == "big":
+            pixels.byteswap()
+        return pixels
+
+    def cursor_to_png(self, cursor, pixels, resize_width, resize_height):
+        with io.BytesIO() as f:
+            # Create raw image from the pixel buffer
             im = Image.frombytes(
-                'RGBA', (cursor.width, cursor.height), bytes(s), 'raw')
+                'RGBA', (cursor.width, cursor.height), pixels, 'raw', 'BGRA')
 
             if cursor.width != resize_width or cursor.height != resize_height:
                 # Resize cursor to target size
@@ -555,7 +939,87 @@ class WebRTCInput:
     async def stop_js_server(self):
         await self.__js_disconnect()
 
-    async def on_message(self, msg):
+    def __on_binary_mouse(self, op, x, y, button_mask, scroll_magnitude):
+        try:
+            self.send_x11_mouse(x, y, button_mask, scroll_magnitude, op == INPUT_OP_MOUSE_RELATIVE)
+        except Exception as e:
+            logger.warning('failed to set mouse cursor: {}'.format(e))
+
+    def __is_latest_motion(self, session, target, seq):
+        """Checks that an absolute motion update is newer than the last applied update of its target
+
+        Motion updates arrive unordered, a late update would otherwise move the target back.
+        Sequences are counted by each viewer, they are only compared within its session.
+        """
+
+        last = session.motion_sequences.get(target)
+        if last is not None and not 0 < (seq - last) & 0xFFFF < 0x8000:
+            return False
+        session.motion_sequences[target] = seq
+        return True
+
+    def __on_binary_motion(self, session, op, seq, x, y):
+        if not self.__is_latest_motion(session, op, seq):
+            return
+        # Buttons are sent on the ordered channel, motion keeps the current button state
+        self.__on_binary_mouse(INPUT_OP_MOUSE, x, y, self.button_mask, 0)
+
+    def __on_binary_motion_relative(self, session, op, x, y):
+        self.__on_binary_mouse(INPUT_OP_MOUSE_RELATIVE, x, y, self.button_mask, 0)
+
+    def __on_binary_js_axis_motion(self, session, op, seq, js_num, axis_num, axis_val):
+        if not self.__is_latest_motion(session, (op, js_num, axis_num), seq):
+            return
+        self.__js_emit_axis(js_num, axis_num, axis_val)
+
+    def on_binary_message(self, session, data, receive_time=None):
+        """Handles incoming binary input messages
+
+        Bound to a data channel, handles key, mouse and gamepad events of the
+        binary protocol negotiated with the "_proto" text command.
+        Messages with the timestamp flag are followed by the client time and
+        their latency is reported with on_input_latency.
+
+        Arguments:
+            session {InputSession} -- input state of the viewer sending the message
+            data {bytes} -- the raw data channel message, an opcode followed by its fixed layout.
+            receive_time {float} -- monotonic time the message was received from the data channel
+        """
+
+        if session.input_protocol_version != INPUT_PROTOCOL_VERSION:
+            logger.warning('dropping binary input message, binary protocol was not negotiated')
+            return
+
+        handler = self.binary_handlers[data[0] & ~INPUT_OP_TIMESTAMP_FLAG] if data else None
+        if handler is None:
+            logger.info('unknown binary data channel message: %s' % data[:1].hex())
+            return
+
+        layout, callback = handler
+        if not data[0] & INPUT_OP_TIMESTAMP_FLAG:
+            if len(data) != layout.size:
+                logger.warning('invalid binary data channel message length %d for opcode %d' % (len(data), data[0]))
+                return
+            callback(session, *layout.unpack(data))
+            return
+
+        if len(data) != layout.size + INPUT_TIMESTAMP_STRUCT.size:
+            logger.warning('invalid binary data channel message length %d for opcode %d' % (len(data), data[0]))
+            return
+        start_time = time.monotonic()
+        callback(session, data[0] & ~INPUT_OP_TIMESTAMP_FLAG, *layout.unpack_from(data)[1:])
+        end_time = time.monotonic()
+
+        sent_time = session.clock_offset.to_local(INPUT_TIMESTAMP_STRUCT.unpack_from(data, layout.size)[0])
+        if sent_time is None:
+            return
+        if receive_time is None:
+            receive_time = start_time
+        self.on_input_latency("network", (receive_time - sent_time) * 1000)
+        self.on_input_latency("queue", (start_time - receive_time) * 1000)
+        self.on_input_latency("injection", (end_time - start_time) * 1000)
+
+    async def on_message(self, session, msg):
         """Handles incoming input messages
 
         Bound to a data channel, handles input messages.
@@ -568,27 +1032,39 @@ class WebRTCInput:
           m: mouse event, data is csv of: x,y,button mask
           b: bitrate event, data is the desired encoder bitrate in bps.
           js: joystick connect/disconnect/button/axis event
+          _proto: binary protocol version accepted by the client, data is the version
+          kt: type text as key presses, data is base64 encoded UTF-8 text
 
         Arguments:
+            session {InputSession} -- input state of the viewer sending the message
             msg {string} -- the raw data channel message packed in the <command>,<data> format.
         """
 
         toks = msg.split(",")
         if toks[0] == "pong":
-            if self.ping_start is None:
+            if session.ping_start is None:
                 logger.warning('received pong before ping')
                 return
 
-            roundtrip = time.time() - self.ping_start
+            roundtrip = time.time() - session.ping_start
             latency = (roundtrip / 2) * 1000
             latency = float("%.3f" % latency)
-            self.on_ping_response(latency)
+            session.on_ping_response(latency)
+
+            # The pong carries the client time, relating the client clock to ours
+            if len(toks) > 1:
+                session.clock_offset.add_sample(float(toks[1]), time.monotonic(), roundtrip)
         elif toks[0] == "kd":
             # Key down
             self.send_x11_keypress(int(toks[1]), down=True)
         elif toks[0] == "ku":
             # Key up
             self.send_x11_keypress(int(toks[1]), down=False)
+        elif toks[0] == "kt":
+            # Type text
+            text = base64.b64decode(toks[1]).decode("utf-8")
+            logger.info("typing text, length: %d" % len(text))
+            await self.type_text(text)
         elif toks[0] == "kr":
             # Keyboard reset
             self.reset_keyboard()
@@ -672,7 +1148,7 @@ class WebRTCInput:
         elif toks[0] == "r":
             # resize event
             res = toks[1]
-            if re.match(re.compile(r'^\d+x\d+$'), res):
+            if RESOLUTION_RE.match(res):
                 # Make sure resolution is divisible by 2
                 w, h = [int(i) + int(i) % 2 for i in res.split("x")]
                 self.on_resize("%dx%d" % (w, h))
@@ -682,11 +1158,21 @@ class WebRTCInput:
         elif toks[0] == "s":
             # scaling info
             scale = toks[1]
-            if re.match(re.compile(r'^\d+(\.\d+)?$'), scale):
+            if SCALE_RE.match(scale):
                 self.on_scaling_ratio(float(scale))
             else:
                 logger.warning(
                     "rejecting scaling change, invalid scale ratio: %s" % scale)
+        elif toks[0] == "_proto":
+            # Binary input protocol negotiation
+            version = int(toks[1])
+            if version == INPUT_PROTOCOL_VERSION:
+                logger.info("client accepted binary input protocol version %d" % version)
+                session.input_protocol_version = version
+                session.motion_sequences = {}
+            else:
+                logger.warning("client requested unsupported binary input protocol version %d, using text protocol" % version)
+                session.input_protocol_version = 0
         elif toks[0] == "_arg_fps":
             # Set framerate
             fps = int(toks[1])
@@ -701,7 +1187,7 @@ class WebRTCInput:
                 logger.info("Setting enable_resize to : %s" % str(enabled))
 
                 res = toks[2]
-                if re.match(re.compile(r'^\d+x\d+$'), res):
+                if RESOLUTION_RE.match(res):
                     # Make sure resolution is divisible by 2
                     w, h = [int(i) + int(i) % 2 for i in res.split("x")]
                     enable_res = "%dx%d" % (w, h)
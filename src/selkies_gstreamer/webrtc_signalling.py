@@ -57,13 +57,14 @@ class WebRTCSignallingErrorNoPeer(Exception):
 
 
 class WebRTCSignalling:
-    def __init__(self, server, id, peer_id, enable_https=False, enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None):
+    def __init__(self, server, id, peer_id, enable_https=False, enable_basic_auth=False, basic_auth_user=None, basic_auth_password=None, local_server=None):
         """Initialize the signalling instance
 
         Arguments:
             server {string} -- websocket URI to connect to, example: ws://127.0.0.1:8080
             id {integer} -- ID of this client when registering.
             peer_id {integer} -- ID of peer to connect to.
+            local_server {WebRTCSimpleServer} -- Optional signalling server in the same process, connects through in-process queues instead of server.
         """
 
         self.server = server
@@ -73,6 +74,7 @@ class WebRTCSignalling:
         self.enable_basic_auth = enable_basic_auth
         self.basic_auth_user = basic_auth_user
         self.basic_auth_password = basic_auth_password
+        self.local_server = local_server
         self.conn = None
 
         self.on_ice = lambda mlineindex, candidate: logger.warning(
@@ -88,10 +90,12 @@ class WebRTCSignalling:
         """Creates session with peer
 
         Should be called after HELLO is received.
+        The server starts the session as soon as the peer connects,
+        SESSION_OK is received without retrying while waiting for the peer.
 
         """
         logger.debug("setting up call")
-        await self.conn.send('SESSION %d' % self.peer_id)
+        await self.conn.send('SESSION_WAIT %d' % self.peer_id)
 
     async def connect(self):
         """Connects to and registers id with signalling server
@@ -100,6 +104,11 @@ class WebRTCSignalling:
 
         """
         try:
+            if self.local_server is not None:
+                self.conn = self.local_server.connect_local()
+                await self.conn.send('HELLO %d' % self.id)
+                return
+
             sslctx = None
             if self.enable_https:
                 sslctx = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
@@ -0,0 +1,270 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import collections
+import time
+from Xlib import X, XK, display
+from Xlib.ext import xtest
+
+import logging
+logger = logging.getLogger("x11_keyboard")
+logger.setLevel(logging.INFO)
+
+SHIFT_KEYSYMS = (XK.XK_Shift_L, XK.XK_Shift_R)
+
+# Keysyms of control characters that can be typed
+CHAR_KEYSYMS = {
+    "\n": XK.XK_Return,
+    "\t": XK.XK_Tab,
+    "\b": XK.XK_BackSpace,
+}
+
+
+def char_to_keysym(char):
+    """Returns the keysym typing a character
+
+    Latin-1 characters are their own keysyms, other characters use the Unicode keysym range.
+
+    Arguments:
+        char {string} -- a single character
+
+    Returns:
+        integer -- the keysym, None for control characters that are not typed
+    """
+
+    keysym = CHAR_KEYSYMS.get(char)
+    if keysym is not None:
+        return keysym
+    codepoint = ord(char)
+    if 0x20 <= codepoint <= 0x7e or 0xa0 <= codepoint <= 0xff:
+        return codepoint
+    if codepoint < 0xa0:
+        return None
+    return 0x01000000 + codepoint
+
+
+class X11KeyboardError(Exception):
+    pass
+
+
+class X11Keyboard:
+    """Injects key events with XTest using a cached keysym to keycode table
+
+    The table is built from the keyboard mapping once and rebuilt when the
+    X server reports a MappingNotify. Keysyms missing from the mapping are
+    bound to a pool of unused keycodes, reusing the least recently used.
+    """
+
+    def __init__(self, display_name=None, scratch_keycodes=32, scratch_settle_ms=50):
+        """Initializes the keyboard
+
+        Arguments:
+            display_name {string} -- X display to connect to, defaults to DISPLAY
+            scratch_keycodes {integer} -- number of unused keycodes to bind missing keysyms to
+            scratch_settle_ms {float} -- time in milliseconds clients get to handle a key before its scratch keycode is rebound
+        """
+
+        self.display_name = display_name
+        self.scratch_keycodes = scratch_keycodes
+        self.scratch_settle_ms = scratch_settle_ms
+        self.xdisplay = None
+
+        # Map of keysym to a list of (keycode, shift level) producing it
+        self.keycodes = {}
+        # Map of scratch keycode to its bound keysym, least recently used first
+        self.scratch_pool = collections.OrderedDict()
+        # Monotonic time scratch keycodes were last pressed. The server processing a key
+        # is not enough: clients translate it when they read it, with the mapping they
+        # fetch after a MappingNotify, so a keycode is only rebound once clients had
+        # scratch_settle_ms to handle its keys.
+        self.scratch_used_times = {}
+        # Map of pressed keysym to the keycode it was pressed with
+        self.pressed = {}
+        self.shift_pressed = set()
+
+    def connect(self):
+        """Connects to the X server and watches for keyboard mapping changes from the running event loop
+        """
+
+        self.xdisplay = display.Display(self.display_name)
+        if not self.xdisplay.has_extension('XTEST'):
+            if self.xdisplay.query_extension('XTEST') is None:
+                raise X11KeyboardError('XTEST extension not supported, cannot inject keys')
+        self.load_keymap()
+        asyncio.get_running_loop().add_reader(self.xdisplay.fileno(), self.__process_events)
+
+    def disconnect(self):
+        if self.xdisplay is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.xdisplay.fileno())
+        self.xdisplay.close()
+        self.xdisplay = None
+
+    def load_keymap(self):
+        """Builds the keysym to keycode table from the keyboard mapping of the X server
+        """
+
+        first_keycode = self.xdisplay.display.info.min_keycode
+        count = self.xdisplay.display.info.max_keycode - first_keycode + 1
+        keycodes = {}
+        free_keycodes = []
+        for i, keysyms in enumerate(self.xdisplay.get_keyboard_mapping(first_keycode, count)):
+            keycode = first_keycode + i
+            if not any(keysyms):
+                free_keycodes.append(keycode)
+                continue
+            # Only the unshifted and shifted level of the first group are used
+            for level, keysym in enumerate(keysyms[:2]):
+                if keysym:
+                    keycodes.setdefault(keysym, []).append((keycode, level))
+        self.keycodes = keycodes
+
+        # The pool is taken once, its keycodes are not free anymore after binding keysyms
+        if not self.scratch_pool:
+            for keycode in free_keycodes[-self.scratch_keycodes:]:
+                self.scratch_pool[keycode] = None
+            logger.info("loaded keyboard mapping with %d keysyms and %d scratch keycodes" % (len(keycodes), len(self.scratch_pool)))
+
+    def __process_events(self):
+        mapping_changed = False
+        while self.xdisplay.pending_events() > 0:
+            event = self.xdisplay.next_event()
+            if event.type == X.MappingNotify and event.request == X.MappingKeyboard:
+                mapping_changed = True
+        if mapping_changed:
+            self.load_keymap()
+
+    def __next_scratch_keycode(self):
+        pressed_keycodes = set(self.pressed.values())
+        return next((k for k in self.scratch_pool if k not in pressed_keycodes), None)
+
+    def __bind_scratch_keycode(self, keysym):
+        """Binds a keysym missing from the mapping to the least recently used scratch keycode
+
+        Returns:
+            integer -- the keycode, None when all scratch keycodes are pressed
+        """
+
+        keycode = self.__next_scratch_keycode()
+        if keycode is None:
+            return None
+
+        previous_keysym = self.scratch_pool[keycode]
+        if previous_keysym in self.keycodes:
+            self.keycodes[previous_keysym] = [e for e in self.keycodes[previous_keysym] if e[0] != keycode]
+            if not self.keycodes[previous_keysym]:
+                del self.keycodes[previous_keysym]
+
+        self.xdisplay.change_keyboard_mapping(keycode, [(keysym, keysym)])
+        self.scratch_pool[keycode] = keysym
+        self.keycodes[keysym] = [(keycode, 0)]
+        return keycode
+
+    def lookup(self, keysym, bind=True):
+        """Finds the keycode producing a keysym with the current shift state
+
+        Arguments:
+            keysym {integer} -- the key symbol
+            bind {bool} -- bind missing keysyms to a scratch keycode
+
+        Returns:
+            tuple -- (keycode, shift) where shift is set when shift has to be pressed for the keysym, keycode is None when not found
+        """
+
+        entries = self.keycodes.get(keysym)
+        if entries is None:
+            if not bind:
+                return None, False
+            return self.__bind_scratch_keycode(keysym), False
+
+        keycode = entries[0][0]
+        if keycode in self.scratch_pool:
+            self.scratch_pool.move_to_end(keycode)
+
+        # Prefer the keycode producing the keysym at the current shift level,
+        # e.g. '<' is shift+comma with shift held instead of the unshifted 102nd key.
+        level = 1 if self.shift_pressed else 0
+        for keycode, keysym_level in entries:
+            if keysym_level == level:
+                return keycode, False
+        keycode, keysym_level = entries[0]
+        return keycode, keysym_level == 1 and not self.shift_pressed
+
+    def send_key(self, keysym, down=True, flush=True):
+        """Sends a key press or release
+
+        Releases use the keycode the key was pressed with.
+
+        Arguments:
+            keysym {integer} -- the key symbol
+            down {bool} -- press or release the key
+            flush {bool} -- send the request to the X server, disable when sending a batch of keys
+        """
+
+        if down:
+            keycode, shift = self.lookup(keysym)
+            if keycode is None:
+                logger.warning("no keycode available for keysym %d" % keysym)
+                return
+            shift_keycode = self.lookup(XK.XK_Shift_L, bind=False)[0] if shift else None
+            if shift_keycode is not None:
+                xtest.fake_input(self.xdisplay, X.KeyPress, shift_keycode)
+            xtest.fake_input(self.xdisplay, X.KeyPress, keycode)
+            if shift_keycode is not None:
+                xtest.fake_input(self.xdisplay, X.KeyRelease, shift_keycode)
+            self.pressed[keysym] = keycode
+            if keycode in self.scratch_pool:
+                self.scratch_used_times[keycode] = time.monotonic()
+            if keysym in SHIFT_KEYSYMS:
+                self.shift_pressed.add(keysym)
+        else:
+            keycode = self.pressed.pop(keysym, None)
+            if keycode is None:
+                keycode = self.lookup(keysym, bind=False)[0]
+                if keycode is None:
+                    return
+            xtest.fake_input(self.xdisplay, X.KeyRelease, keycode)
+            self.shift_pressed.discard(keysym)
+
+        if flush:
+            self.xdisplay.flush()
+
+    def type_keysym(self, keysym):
+        """Presses and releases a key without flushing, shift is pressed around it when needed
+
+        Arguments:
+            keysym {integer} -- the key symbol
+        """
+
+        self.send_key(keysym, True, flush=False)
+        self.send_key(keysym, False, flush=False)
+
+    def rebind_delay(self, keysym):
+        """Returns the time to wait before typing a keysym rebinds a recently used scratch keycode
+
+        Arguments:
+            keysym {integer} -- the key symbol
+
+        Returns:
+            float -- time in seconds until the scratch keycode settled, 0 if the keysym can be typed now
+        """
+
+        if keysym in self.keycodes:
+            return 0
+        used_time = self.scratch_used_times.get(self.__next_scratch_keycode())
+        if used_time is None:
+            return 0
+        return max(0, used_time + self.scratch_settle_ms / 1000.0 - time.monotonic())
+
+    def flush(self):
+        self.xdisplay.flush()
+
+    def sync(self):
+        """Waits for the X server to process the sent keys
+
+        Clients may not have handled the keys yet, see rebind_delay() before rebinding scratch keycodes.
+        """
+
+        self.xdisplay.sync()
@@ -0,0 +1,173 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import collections
+import os
+import struct
+from Xlib import Xatom
+
+import logging
+logger = logging.getLogger("xcursor_theme")
+logger.setLevel(logging.INFO)
+
+XCURSOR_MAGIC = b"Xcur"
+XCURSOR_IMAGE_TYPE = 0xfffd0002
+XCURSOR_DEFAULT_PATH = "~/.local/share/icons:~/.icons:/usr/share/icons:/usr/share/pixmaps"
+
+# Shapes shown when hovering common widgets, window edges and busy applications
+PRELOAD_CURSOR_NAMES = (
+    "left_ptr", "default", "hand2", "pointer", "xterm", "text",
+    "watch", "wait", "left_ptr_watch", "progress", "crosshair",
+    "fleur", "move", "not-allowed", "help", "grab", "grabbing",
+    "sb_h_double_arrow", "sb_v_double_arrow", "col-resize", "row-resize",
+    "ew-resize", "ns-resize", "nesw-resize", "nwse-resize",
+    "top_side", "bottom_side", "left_side", "right_side",
+    "top_left_corner", "top_right_corner", "bottom_left_corner", "bottom_right_corner",
+)
+
+# Image of a cursor file with the attributes of an XFIXES cursor image reply
+XcursorImage = collections.namedtuple(
+    "XcursorImage", ["width", "height", "xhot", "yhot", "cursor_image", "cursor_serial"])
+
+
+class XcursorError(Exception):
+    pass
+
+
+def get_cursor_theme(xdisplay):
+    """Returns the Xcursor theme and size used by X clients
+
+    Like libXcursor, the environment takes precedence over the X resources and the
+    size defaults to the Xft.dpi resource or the screen size.
+
+    Arguments:
+        xdisplay {Display} -- X display to read the resources from
+
+    Returns:
+        tuple -- (theme name, nominal cursor size)
+    """
+
+    resources = {}
+    prop = xdisplay.screen().root.get_full_property(
+        xdisplay.intern_atom("RESOURCE_MANAGER"), Xatom.STRING)
+    if prop is not None:
+        value = prop.value.decode() if isinstance(prop.value, bytes) else prop.value
+        for line in value.splitlines():
+            key, _, val = line.partition(":")
+            resources[key.strip()] = val.strip()
+
+    theme = os.environ.get("XCURSOR_THEME") or resources.get("Xcursor.theme") or "default"
+    size = os.environ.get("XCURSOR_SIZE") or resources.get("Xcursor.size")
+    if size:
+        return theme, int(size)
+    if resources.get("Xft.dpi"):
+        return theme, int(float(resources["Xft.dpi"]) * 16 / 72)
+    screen = xdisplay.screen()
+    return theme, min(screen.width_in_pixels, screen.height_in_pixels) // 48
+
+
+def find_cursor_file(theme, name, path=None, visited=None):
+    """Finds the file of a cursor in a theme or the themes it inherits
+
+    Arguments:
+        theme {string} -- theme name
+        name {string} -- cursor name
+        path {list} -- icon directories, defaults to XCURSOR_PATH
+
+    Returns:
+        string -- path of the cursor file, None if not found
+    """
+
+    if path is None:
+        path = [os.path.expanduser(d) for d in os.environ.get("XCURSOR_PATH", XCURSOR_DEFAULT_PATH).split(":")]
+    if visited is None:
+        visited = set()
+    visited.add(theme)
+
+    for d in path:
+        cursor_file = os.path.join(d, theme, "cursors", name)
+        if os.path.isfile(cursor_file):
+            return cursor_file
+
+    for d in path:
+        index_file = os.path.join(d, theme, "index.theme")
+        if not os.path.isfile(index_file):
+            continue
+        with open(index_file) as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() != "Inherits":
+                    continue
+                for parent in value.replace(";", ",").split(","):
+                    parent = parent.strip()
+                    if parent and parent not in visited:
+                        cursor_file = find_cursor_file(parent, name, path, visited)
+                        if cursor_file is not None:
+                            return cursor_file
+    return None
+
+
+def load_cursor_file(cursor_file, size):
+    """Loads the image of an Xcursor file with the nominal size closest to size
+
+    Only the first frame of animated cursors is loaded.
+
+    Arguments:
+        cursor_file {string} -- path of the cursor file
+        size {integer} -- nominal cursor size
+
+    Returns:
+        XcursorImage -- the image, pixels are ARGB integers
+
+    Raises:
+        XcursorError -- if the file is not a valid cursor file
+    """
+
+    with open(cursor_file, "rb") as f:
+        data = f.read()
+
+    try:
+        magic, header_size, _, ntoc = struct.unpack_from("<4sIII", data, 0)
+        if magic != XCURSOR_MAGIC:
+            raise XcursorError("not an Xcursor file: %s" % cursor_file)
+        images = []
+        for i in range(ntoc):
+            chunk_type, nominal_size, position = struct.unpack_from("<III", data, header_size + i * 12)
+            if chunk_type == XCURSOR_IMAGE_TYPE:
+                images.append((abs(nominal_size - size), i, position))
+        if not images:
+            raise XcursorError("no images in Xcursor file: %s" % cursor_file)
+
+        position = min(images)[2]
+        chunk_header, _, _, _, width, height, xhot, yhot, _ = struct.unpack_from("<9I", data, position)
+        pixels = struct.unpack_from("<%dI" % (width * height), data, position + chunk_header)
+    except struct.error as e:
+        raise XcursorError("truncated Xcursor file %s: %s" % (cursor_file, e))
+
+    return XcursorImage(width, height, xhot, yhot, list(pixels), 0)
+
+
+def load_cursor_theme(theme, size, names=PRELOAD_CURSOR_NAMES):
+    """Loads the images of cursors from a theme, skipping missing or invalid ones
+
+    Arguments:
+        theme {string} -- theme name
+        size {integer} -- nominal cursor size
+        names {list} -- cursor names
+
+    Returns:
+        list -- XcursorImage of each cursor found
+    """
+
+    images = []
+    for name in names:
+        cursor_file = find_cursor_file(theme, name)
+        if cursor_file is None:
+            continue
+        try:
+            images.append(load_cursor_file(cursor_file, size))
+        except (OSError, XcursorError) as e:
+            logger.warning("failed to load cursor %s: %s" % (name, e))
+    logger.info("loaded %d of %d cursors from theme %s at size %d" % (len(images), len(names), theme, size))
+    return images
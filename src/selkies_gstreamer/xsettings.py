@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import struct
+from Xlib import X, display, error
+from Xlib.protocol import event
+
+import logging
+logger = logging.getLogger("xsettings")
+logger.setLevel(logging.INFO)
+
+# Setting types of the XSETTINGS protocol
+XSETTINGS_TYPE_INTEGER = 0
+XSETTINGS_TYPE_STRING = 1
+
+# Byte order, serial and number of settings
+XSETTINGS_HEADER_STRUCT = struct.Struct("<B3xII")
+# Type and name length, followed by the name padded to 4 bytes
+XSETTINGS_SETTING_STRUCT = struct.Struct("<BxH")
+# Serial of the last change and the value of an integer setting
+XSETTINGS_INTEGER_STRUCT = struct.Struct("<Ii")
+# Serial of the last change and the length of a string setting, followed by the string padded to 4 bytes
+XSETTINGS_STRING_STRUCT = struct.Struct("<II")
+
+# Xft/DPI is published in 1/1024 of a dot per inch
+XSETTINGS_DPI_SCALE = 1024
+
+
+class XSettingsError(Exception):
+    pass
+
+
+def _pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def serialize_settings(settings, serial):
+    """Serializes settings to the _XSETTINGS_SETTINGS property format
+
+    Arguments:
+        settings {dict} -- map of setting name to (value, serial of the last change), values are integers or strings
+        serial {integer} -- serial of the settings
+    """
+
+    data = [XSETTINGS_HEADER_STRUCT.pack(0, serial, len(settings))]
+    for name, (value, last_change) in sorted(settings.items()):
+        name = name.encode()
+        if isinstance(value, str):
+            value = value.encode()
+            data.append(XSETTINGS_SETTING_STRUCT.pack(XSETTINGS_TYPE_STRING, len(name)) + _pad(name))
+            data.append(XSETTINGS_STRING_STRUCT.pack(last_change, len(value)) + _pad(value))
+        else:
+            data.append(XSETTINGS_SETTING_STRUCT.pack(XSETTINGS_TYPE_INTEGER, len(name)) + _pad(name))
+            data.append(XSETTINGS_INTEGER_STRUCT.pack(last_change, value))
+    return b"".join(data)
+
+
+class XSettingsManager:
+    """Publishes settings to X clients as the XSETTINGS manager of the screen
+
+    The manager selection is only taken while no other settings daemon owns it,
+    e.g. xfsettingsd keeps its selection and publish() returns False so callers
+    can fall back to the settings tool of the desktop. Unchanged settings are not
+    published again.
+    """
+
+    def __init__(self, display_name=None):
+        self.display_name = display_name
+        self.xdisplay = None
+        self.window = None
+        self.atoms = {}
+        self.owned = False
+        self.serial = 0
+        # Map of setting name to (value, serial of the last change)
+        self.settings = {}
+
+    def connect(self):
+        """Opens the connection and the window owning the selection
+
+        Raises:
+            XSettingsError -- if the X server cannot be reached
+        """
+
+        try:
+            self.xdisplay = display.Display(self.display_name)
+        except (error.DisplayError, OSError) as e:
+            raise XSettingsError("failed to connect to X server: %s" % e)
+
+        screen_num = self.xdisplay.get_default_screen()
+        for name in ("_XSETTINGS_S%d" % screen_num, "_XSETTINGS_SETTINGS", "MANAGER"):
+            self.atoms[name] = self.xdisplay.intern_atom(name)
+        self.atoms["selection"] = self.atoms["_XSETTINGS_S%d" % screen_num]
+
+        # Unmapped window, its property changes provide the timestamp to take the selection with
+        root = self.xdisplay.screen().root
+        self.window = root.create_window(0, 0, 1, 1, 0, X.CopyFromParent, event_mask=X.PropertyChangeMask)
+        self.xdisplay.flush()
+
+    def close(self):
+        if self.xdisplay is not None:
+            self.xdisplay.close()
+            self.xdisplay = None
+            self.window = None
+            self.owned = False
+
+    def publish(self, settings):
+        """Sets integer or string settings, published in a single change
+
+        Arguments:
+            settings {dict} -- map of setting name to value, e.g. {"Gtk/CursorThemeSize": 32}
+
+        Returns:
+            bool -- true if the settings are published, false if another settings daemon owns the selection
+        """
+
+        try:
+            if self.xdisplay is None:
+                self.connect()
+            if not self.__acquire():
+                return False
+
+            changed = {name: value for name, value in settings.items() if self.settings.get(name, (None,))[0] != value}
+            if not changed:
+                return True
+            self.serial += 1
+            for name, value in changed.items():
+                self.settings[name] = (value, self.serial)
+            self.__write_settings()
+            self.xdisplay.flush()
+        except (XSettingsError, error.XError, error.ConnectionClosedError) as e:
+            logger.warning("failed to publish XSETTINGS: %s" % e)
+            self.close()
+            return False
+        logger.info("published XSETTINGS: %s" % ", ".join("%s=%s" % item for item in changed.items()))
+        return True
+
+    def set_dpi(self, dpi):
+        return self.publish({"Xft/DPI": dpi * XSETTINGS_DPI_SCALE})
+
+    def set_cursor_size(self, size):
+        return self.publish({"Gtk/CursorThemeSize": size})
+
+    def __write_settings(self):
+        self.window.change_property(
+            self.atoms["_XSETTINGS_SETTINGS"], self.atoms["_XSETTINGS_SETTINGS"], 8,
+            serialize_settings(self.settings, self.serial))
+
+    def __acquire(self):
+        """Takes the manager selection if it is free, keeping the selection of another settings daemon
+        """
+
+        owner = self.xdisplay.get_selection_owner(self.atoms["selection"])
+        if owner != X.NONE and owner.id == self.window.id:
+            return True
+        if self.owned:
+            logger.warning("another XSETTINGS manager replaced this one")
+            self.owned = False
+        if owner != X.NONE:
+            return False
+
+        # The settings must be set before announcing the manager, the notification of
+        # this change provides the timestamp, older notifications are discarded first
+        while self.xdisplay.pending_events() > 0:
+            self.xdisplay.next_event()
+        self.__write_settings()
+        timestamp = self.__server_time()
+        self.window.set_selection_owner(self.atoms["selection"], timestamp)
+        owner = self.xdisplay.get_selection_owner(self.atoms["selection"])
+        if owner == X.NONE or owner.id != self.window.id:
+            return False
+
+        root = self.xdisplay.screen().root
+        root.send_event(event.ClientMessage(
+            window=root,
+            client_type=self.atoms["MANAGER"],
+            data=(32, [timestamp, self.atoms["selection"], self.window.id, 0, 0])),
+            event_mask=X.StructureNotifyMask)
+        self.owned = True
+        logger.info("acting as XSETTINGS manager")
+        return True
+
+    def __server_time(self):
+        """Returns the time of the server from the notification of the last property change of the window
+        """
+
+        self.xdisplay.flush()
+        while True:
+            ev = self.xdisplay.next_event()
+            if ev.type == X.PropertyNotify and ev.window.id == self.window.id:
+                return ev.time